@@ -0,0 +1,122 @@
+# asyncio front end for the interfaces, for use outside nipype workflows.
+# Developer Notes:
+# arun() prepares an interface the same way batch.run_batched() does (command
+# line, generated names, pre-command steps), starts wb_command with
+# asyncio.create_subprocess_exec and collects its outputs with the
+# interface's own aggregate_outputs, so results are the same as from run().
+# Preparing and collecting change the working directory, which is global to
+# the process, so those short steps run one at a time in the default executor
+# rather than on the event loop; the subprocesses themselves need no threads.
+# wb_command is exec'd by the shell and started in its own session, so a
+# cancelled or timed out call kills it (and anything it started) as a group.
+# Interfaces that run in-process (engine='numpy') read and write relative to
+# the working directory throughout their run, so they cannot share the
+# process with other calls without holding the lock for the whole run.
+# They run in a pool of worker processes instead, each with its own working
+# directory; a timed out one is abandoned, not stopped.
+
+import asyncio
+import os
+import threading
+
+from .batch import _Call, _prepare, _finish, _in_process
+
+_cwd_lock = threading.Lock()
+_pool = None
+
+
+def _locked(function, *args):
+    with _cwd_lock:
+        return function(*args)
+
+
+def _run_in_process(interface, cwd):
+    return interface.run(cwd=cwd)
+
+
+def _process_pool():
+    # spawned rather than forked, the event loop's process has threads
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(os.cpu_count() or 1,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _kill(process):
+    import signal
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # it exited in the meantime
+        pass
+
+
+async def arun(interface, cwd=None, timeout=None):
+    """
+    Run ``interface`` (a WBCommand with its inputs set) without blocking the
+    event loop and return its InterfaceResult. Raises asyncio.TimeoutError
+    (after killing wb_command) if it takes longer than ``timeout`` seconds,
+    and RuntimeError if wb_command fails. In-process interfaces run in a
+    worker process (see the notes above).
+    """
+    loop = asyncio.get_running_loop()
+    cwd = cwd or os.getcwd()
+    if _in_process(interface):
+        return await asyncio.wait_for(
+            loop.run_in_executor(_process_pool(), _run_in_process, interface,
+                                 os.path.abspath(cwd)), timeout)
+
+    call = _Call(interface, cwd)
+    await loop.run_in_executor(None, _locked, _prepare, call)
+    runtime = call.runtime
+    process = await asyncio.create_subprocess_exec(
+        '/bin/sh', '-c', 'exec ' + runtime.cmdline, cwd=call.cwd,
+        env=dict(os.environ, **runtime.environ), start_new_session=True,
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # timeout or cancellation: do not leave wb_command running
+        if process.returncode is None:
+            _kill(process)
+            await asyncio.shield(process.wait())
+        raise
+    runtime.stdout = stdout.decode(errors='replace')
+    runtime.stderr = stderr.decode(errors='replace')
+    runtime.returncode = process.returncode
+    if runtime.returncode != 0:
+        raise RuntimeError('Command:\n{}\nStandard output:\n{}\nStandard error:\n{}\n'
+                           'Return code: {}'.format(runtime.cmdline, runtime.stdout,
+                                                    runtime.stderr, runtime.returncode))
+    await loop.run_in_executor(None, _locked, _finish, call)
+    return call.result
+
+
+async def gather_bounded(interfaces, max_concurrency=None, cwd=None, timeout=None,
+                         return_exceptions=False):
+    """
+    arun() every interface with at most ``max_concurrency`` (default: the
+    number of cores) in flight, and return their results in order.
+    ``cwd`` is one directory or one per interface, ``timeout`` applies to
+    each call. With ``return_exceptions`` failed calls give their exception
+    instead of cancelling the others, as in asyncio.gather.
+    """
+    interfaces = list(interfaces)
+    if cwd is None or isinstance(cwd, str):
+        cwd = [cwd] * len(interfaces)
+    if len(cwd) != len(interfaces):
+        raise ValueError('give one cwd or one per interface')
+    semaphore = asyncio.Semaphore(max_concurrency or os.cpu_count() or 1)
+
+    async def _bounded(interface, path):
+        async with semaphore:
+            return await arun(interface, path, timeout)
+
+    return await asyncio.gather(*[_bounded(i, c) for i, c in zip(interfaces, cwd)],
+                                return_exceptions=return_exceptions)
@@ -0,0 +1,168 @@
+# Shared plumbing for interfaces in this package.
+# Developer Notes:
+# Some wb_command operations are cheap enough that forking wb_command and
+# parsing its output costs more than the work itself. Interfaces that have
+# an in-process implementation subclass WBEngineCommand and give their input
+# spec an `engine` trait (by subclassing WBEngineInputSpec). The subprocess
+# path stays the default and is always available as the fallback.
+# wb_command parallelizes with OpenMP and uses every core by default, which
+# oversubscribes the machine when MultiProc runs several nodes at once. Every
+# interface therefore takes num_threads (by subclassing WBInputSpec and
+# WBCommand), which sets OMP_NUM_THREADS for wb_command, bounds the threads of
+# in-process engines, and is what nipype's Node.n_procs reports to the
+# scheduler.
+
+import os
+
+from nipype import logging
+from nipype.interfaces.workbench import base as wb
+from nipype.interfaces.base import (
+    traits,
+    isdefined,
+    CommandLineInputSpec,
+)
+
+iflogger = logging.getLogger('nipype.interface')
+
+
+class WBInputSpec(CommandLineInputSpec):
+    num_threads=traits.Int(
+        nohash=True,
+        desc="number of threads to use. Sets OMP_NUM_THREADS for wb_command. "
+             "Defaults to every core")
+
+
+class WBCommand(wb.WBCommand):
+    """A WBCommand whose thread count follows the num_threads input."""
+
+    def _get_environ(self):
+        # read when the command runs (by nipype, run_batched and arun), so
+        # copies of the interface follow num_threads and environ is left as given
+        environ = dict(super()._get_environ())
+        if isdefined(self.inputs.num_threads):
+            environ['OMP_NUM_THREADS'] = str(self.inputs.num_threads)
+        return environ
+
+    # telemetry (see telemetry.py), only when $NIPYPE_WB_TELEMETRY is set
+
+    def run(self, cwd=None, ignore_exception=None, **inputs):
+        from . import telemetry
+
+        if telemetry.telemetry_file() is None:
+            return super().run(cwd=cwd, ignore_exception=ignore_exception, **inputs)
+        self._recorder = telemetry.Recorder(self)
+        try:
+            result = super().run(cwd=cwd, ignore_exception=ignore_exception, **inputs)
+        except Exception as e:
+            self._record(self._recorder, cwd, e)
+            raise
+        finally:
+            recorder, self._recorder = self._recorder, None
+        self._record(recorder, cwd)
+        return result
+
+    def _record(self, recorder, cwd, error=None):
+        # telemetry must never fail a run or hide the error of a failed one
+        try:
+            recorder.record(os.path.abspath(cwd or os.getcwd()), error)
+        except Exception as e:
+            iflogger.warning('%s: could not record telemetry: %s', self.__class__.__name__, e)
+
+    def _phase(self, name):
+        from contextlib import nullcontext
+
+        recorder = getattr(self, '_recorder', None)
+        return nullcontext() if recorder is None else recorder.phase(name)
+
+    def _check_mandatory_inputs(self):
+        with self._phase('inputs'):
+            return super()._check_mandatory_inputs()
+
+    def _check_version_requirements(self, trait_object, permissive=False):
+        with self._phase('inputs'):
+            return super()._check_version_requirements(trait_object, permissive)
+
+    @property
+    def cmdline(self):
+        with self._phase('cmdline'):
+            return super().cmdline
+
+    def _pre_run_hook(self, runtime):
+        if getattr(self, '_recorder', None) is not None:
+            self._recorder.start_execute()
+        return super()._pre_run_hook(runtime)
+
+    def _post_run_hook(self, runtime):
+        runtime = super()._post_run_hook(runtime)
+        if getattr(self, '_recorder', None) is not None:
+            self._recorder.stop_execute()
+        return runtime
+
+    def _num_threads(self):
+        # for thread pools of in-process engines
+        if isdefined(self.inputs.num_threads):
+            return max(self.inputs.num_threads, 1)
+        return os.cpu_count() or 1
+
+
+class WBEngineInputSpec(WBInputSpec):
+    engine=traits.Enum('wb_command', 'numpy',
+        usedefault=True,
+        desc=("how to run the interface. 'wb_command' calls the workbench binary, "
+              "'numpy' computes the result in-process with nibabel/numpy"))
+
+
+class WBEngineCommand(WBCommand):
+    """
+    A WBCommand that can optionally be evaluated in-process.
+
+    Subclasses implement ``_run_numpy(runtime)``, which must produce the same
+    files (and stdout, where wb_command prints results) as the wb_command call
+    it replaces so that ``_list_outputs`` and ``aggregate_outputs`` work
+    unchanged for either engine.
+    """
+
+    def _use_numpy(self):
+        # subclasses with numpy-only options extend this
+        return self.inputs.engine == 'numpy'
+
+    def _run_interface(self, runtime):
+        if self._use_numpy():
+            runtime.stdout = ''
+            runtime.stderr = ''
+            runtime = self._run_numpy(runtime)
+            runtime.returncode = 0
+            return runtime
+        return super()._run_interface(runtime)
+
+    def _run_numpy(self, runtime):
+        raise NotImplementedError(
+            '{} has no in-process engine, use engine="wb_command"'.format(
+                self.__class__.__name__))
+
+
+def unique_stems(files):
+    """
+    The name of each of ``files`` up to its first '.', for naming the outputs
+    of a batch. Files sharing that name (e.g. the lh.white.surf.gii of several
+    subjects) are prefixed with the directories that tell them apart, and
+    with their position in ``files`` if even those are the same.
+    """
+    paths = [os.path.abspath(f) for f in files]
+    stems = [os.path.basename(p).split('.')[0] for p in paths]
+    names = list(stems)
+    for stem in set(stems):
+        same = [i for i, s in enumerate(stems) if s == stem]
+        if len(same) < 2:
+            continue
+        dirs = [os.path.dirname(paths[i]) for i in same]
+        common = os.path.commonpath(dirs)
+        for i, d in zip(same, dirs):
+            parts = os.path.relpath(d, common).split(os.sep)
+            names[i] = '_'.join([p for p in parts if p != '.'] + [stem])
+    for name in set(names):
+        same = [i for i, n in enumerate(names) if n == name]
+        if len(same) > 1:
+            for count, i in enumerate(same, 1):
+                names[i] = '{}_{}'.format(name, count)
+    return names
@@ -0,0 +1,208 @@
+# Run many small wb_command calls through a pool of long-lived shells.
+# Developer Notes:
+# For small inputs, most of the time of SetMapNames, CiftiStats or
+# VolumeLabelExportTable goes to starting processes: nipype's run() machinery,
+# the python subprocess for every call, and wb_command's own startup.
+# run_batched() prepares every interface in the main thread (command lines,
+# generated names and any pre-command step, e.g. SetMapNames copying its
+# input), then feeds the command lines to ``n_workers`` persistent /bin/sh
+# processes, each running one call at a time with its stdout/stderr captured
+# in files, and finally collects every interface's outputs from its own
+# runtime. wb_command has no server mode, so each call still starts
+# wb_command once; the pool removes everything around that and overlaps the
+# startups. Interfaces that run in-process (engine='numpy') are run directly.
+# Calls that go through the shells skip run() and _run_interface(), so they
+# are neither served from nor added to the result store (store.py) even for
+# interfaces that opt in, and no telemetry is recorded for them (telemetry.py).
+# In-process interfaces go through run() and get both.
+
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+
+from nipype import logging
+
+iflogger = logging.getLogger('nipype.interface')
+
+_DONE = '__nipype_wb_batch_done__'
+
+
+class _Worker(object):
+    """A /bin/sh reading command lines from its stdin."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        universal_newlines=True, bufsize=1)
+
+    def run(self, cmdline, cwd, environ, stdout, stderr):
+        """Run ``cmdline`` in ``cwd`` with stdout/stderr to files, return the exit code."""
+        exports = ''.join('export {}={}; '.format(name, shlex.quote(value))
+                          for name, value in sorted(environ.items()))
+        # a subshell keeps the worker's own directory and environment untouched
+        self.process.stdin.write('( {}cd {} && exec {} ) >{} 2>{} </dev/null; echo {} $?\n'.format(
+            exports, shlex.quote(cwd), cmdline, shlex.quote(stdout), shlex.quote(stderr), _DONE))
+        self.process.stdin.flush()
+        for line in self.process.stdout:
+            if line.startswith(_DONE):
+                return int(line.split()[1])
+        raise RuntimeError('batch worker exited unexpectedly')
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class _Call(object):
+    # one prepared interface run
+    def __init__(self, interface, cwd, directory=None, index=0):
+        self.interface = interface
+        self.cwd = os.path.abspath(cwd)
+        if directory is not None:
+            self.stdout = os.path.join(directory, '{:06d}.out'.format(index))
+            self.stderr = os.path.join(directory, '{:06d}.err'.format(index))
+        self.runtime = None
+        self.result = None
+
+
+def _in_process(interface):
+    return hasattr(interface, '_use_numpy') and interface._use_numpy()
+
+
+def _prepare(call):
+    from nipype.interfaces.base.support import Bunch
+    from nipype.utils.filemanip import indirectory
+
+    interface = call.interface
+    os.makedirs(call.cwd, exist_ok=True)
+    with indirectory(call.cwd):
+        interface._check_mandatory_inputs()
+        if hasattr(interface, '_before_command'):
+            interface._before_command()
+        environ = interface._get_environ()
+        call.runtime = Bunch(cwd=call.cwd, cmdline=interface.cmdline, environ=environ,
+                             returncode=None, stdout=None, stderr=None,
+                             hostname=os.uname()[1], platform=sys.platform)
+        call.inputs = interface.inputs.get_traitsfree()
+
+
+def _finish(call):
+    from nipype.interfaces.base.support import InterfaceResult
+    from nipype.utils.filemanip import indirectory
+
+    # runtime.stdout/stderr and returncode must be set
+    runtime = call.runtime
+    runtime.merged = runtime.stdout + runtime.stderr
+    outputs = None
+    if runtime.returncode == 0:
+        with indirectory(call.cwd):
+            outputs = call.interface.aggregate_outputs(runtime)
+    call.result = InterfaceResult(call.interface.__class__, runtime, inputs=call.inputs,
+                                  outputs=outputs)
+
+
+def _raised(interface, cwd):
+    # InterfaceResult of a call that raised, with the traceback as its stderr
+    import traceback
+    from nipype.interfaces.base.support import Bunch, InterfaceResult
+
+    stderr = traceback.format_exc()
+    runtime = Bunch(cwd=os.path.abspath(cwd), cmdline=interface.__class__.__name__,
+                    environ={}, returncode=1, stdout='', stderr=stderr, merged=stderr,
+                    traceback=stderr, hostname=os.uname()[1], platform=sys.platform)
+    return InterfaceResult(interface.__class__, runtime,
+                           inputs=interface.inputs.get_traitsfree(), outputs=None)
+
+
+def run_batched(interfaces, cwd=None, n_workers=None, raise_on_error=True):
+    """
+    Run ``interfaces`` (instances of WBCommand subclasses, with their inputs
+    set) through ``n_workers`` persistent shells (default: the number of
+    cores) and return their InterfaceResults, in order.
+
+    ``cwd`` is the working directory of every call, or a list with one per
+    interface; it defaults to the current directory. A call that fails, or
+    raises while being prepared or run in-process, gets outputs None (its
+    traceback is its stderr), and a RuntimeError naming every failed call is
+    raised at the end unless ``raise_on_error`` is False. Calls run by the
+    shells do not use the result store or record telemetry.
+    """
+    import queue
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    interfaces = list(interfaces)
+    if cwd is None or isinstance(cwd, str):
+        cwd = [cwd or os.getcwd()] * len(interfaces)
+    if len(cwd) != len(interfaces):
+        raise ValueError('give one cwd or one per interface')
+
+    results = [None] * len(interfaces)
+    directory = tempfile.mkdtemp(prefix='wb_batch_')
+    calls = []
+    try:
+        for i, (interface, path) in enumerate(zip(interfaces, cwd)):
+            try:
+                if _in_process(interface):
+                    results[i] = interface.run(cwd=path)
+                    continue
+                call = _Call(interface, path, directory, i)
+                _prepare(call)
+            except Exception:
+                # reported with the failed shell calls below
+                results[i] = _raised(interface, path)
+                continue
+            calls.append((i, call))
+
+        n_workers = min(n_workers or os.cpu_count() or 1, len(calls))
+        idle = queue.Queue()
+        lock = threading.Lock()
+        workers = []
+
+        def _run(call):
+            try:
+                worker = idle.get_nowait()
+            except queue.Empty:
+                worker = _Worker()
+                with lock:
+                    workers.append(worker)
+            try:
+                call.runtime.returncode = worker.run(call.runtime.cmdline, call.cwd,
+                                                     call.runtime.environ, call.stdout,
+                                                     call.stderr)
+            finally:
+                idle.put(worker)
+
+        try:
+            if calls:
+                with ThreadPoolExecutor(n_workers) as pool:
+                    list(pool.map(_run, [call for _, call in calls]))
+        finally:
+            for worker in workers:
+                worker.close()
+
+        for i, call in calls:
+            with open(call.stdout) as f:
+                call.runtime.stdout = f.read()
+            with open(call.stderr) as f:
+                call.runtime.stderr = f.read()
+            _finish(call)
+            results[i] = call.result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    failed = [(i, r.runtime) for i, r in enumerate(results)
+              if r.runtime.returncode not in (0, None)]
+    for i, runtime in failed:
+        iflogger.error('batch call %d failed (%d): %s\n%s', i, runtime.returncode,
+                       runtime.cmdline, runtime.stderr)
+    if failed and raise_on_error:
+        raise RuntimeError('{} of {} batched calls failed: {}'.format(
+            len(failed), len(results), ', '.join(str(i) for i, _ in failed)))
+    return results
@@ -0,0 +1,221 @@
+# Content-addressed cache for derived arrays (parcel indices, operators, ...).
+# Developer Notes:
+# Anything that is expensive to derive from an input file but only depends on
+# the file's content (not on the subject being processed) belongs here. Entries
+# are dicts of numpy arrays, kept in a small in-process LRU and saved as .npz
+# (or, for entries that are read a lot, as memory-mappable .npy directories)
+# under cache_dir() so other processes and later runs can reuse them. Keys
+# should include a version string so a change in how an entry is built
+# invalidates old entries.
+# On disk, entries are evicted least recently used first (a disk hit touches
+# the entry) once the cache is above $NIPYPE_WB_CACHE_MB (0 for no limit).
+# As in the result store (store.py), which lives in cache_dir()/results and
+# keeps its own budget, each process keeps a running total and only rescans
+# the cache when that passes the budget or every few minutes.
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_MEMORY_ENTRIES = 32
+_DEFAULT_BUDGET_MB = 10240
+_RESCAN_SECONDS = 300
+_memory = OrderedDict()
+_file_hashes = dict()
+# cache dir -> [estimated size in bytes, time of the last scan]
+_disk_sizes = dict()
+
+
+def cache_dir():
+    """Directory for on-disk entries ($NIPYPE_WB_CACHE_DIR or ~/.cache/nipype_workbench_ext)."""
+    return os.environ.get('NIPYPE_WB_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'nipype_workbench_ext'))
+
+
+def file_hash(filename):
+    """sha256 of a file's content. Memoized on (path, size, mtime) within a process."""
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    memo = (filename, stat.st_size, stat.st_mtime_ns)
+    if memo not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(chunk)
+        _file_hashes[memo] = digest.hexdigest()
+    return _file_hashes[memo]
+
+
+def budget_bytes():
+    """Disk budget of the cache from $NIPYPE_WB_CACHE_MB, 0 for no limit."""
+    return int(float(os.environ.get('NIPYPE_WB_CACHE_MB', _DEFAULT_BUDGET_MB)) * 2 ** 20)
+
+
+def hash_key(*parts):
+    """Hash arbitrary reprable parts (strings, numbers, tuples) into a cache key."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def load_or_build(kind, key, build, use_disk=True, mmap=False):
+    """
+    Return the entry ``kind``/``key``, calling ``build()`` to create it if it is
+    neither in memory nor on disk. ``build`` must return a dict of arrays.
+
+    With ``mmap`` the entry is stored as a directory of .npy files and loaded
+    as read-only memmaps, so opening even a large entry costs next to nothing.
+    """
+    if (kind, key) in _memory:
+        _memory.move_to_end((kind, key))
+        return _memory[(kind, key)]
+
+    path = os.path.join(cache_dir(), kind, key if mmap else key + '.npz')
+    entry = None
+    if use_disk and os.path.exists(path):
+        try:
+            if mmap:
+                entry = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+                         for name in os.listdir(path) if name.endswith('.npy')}
+            else:
+                with np.load(path, allow_pickle=False) as npz:
+                    entry = {name: npz[name] for name in npz.files}
+            _touch(path)
+        except (OSError, ValueError):
+            # a truncated or corrupt entry is rebuilt below
+            entry = None
+    if entry is None:
+        entry = {name: np.asarray(value) for name, value in build().items()}
+        if use_disk:
+            if mmap:
+                _save_dir(path, entry)
+            else:
+                _save(path, entry)
+            _grow(_size(path))
+
+    _memory[(kind, key)] = entry
+    if len(_memory) > _MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+    return entry
+
+
+def _save(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so concurrent readers never see a partial file
+    tmp = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez(tmp, **entry)
+    os.replace(tmp, path)
+
+
+def _save_dir(path, entry):
+    import shutil
+    import tempfile
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                           dir=os.path.dirname(path))
+    for name, value in entry.items():
+        np.save(os.path.join(tmp, name + '.npy'), value)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process saved the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def cached_file(kind, key, suffix, build):
+    """
+    Path of the cached file ``kind``/``key`` + ``suffix``, calling
+    ``build(path)`` to write it first if it does not exist. Callers should copy
+    the file rather than hand the cached path out.
+    """
+    path = os.path.join(cache_dir(), kind, key + suffix)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # keep the suffix, writers pick the format from it
+        tmp = '{}.{}.tmp{}'.format(path[:-len(suffix)], os.getpid(), suffix)
+        build(tmp)
+        os.replace(tmp, path)
+        _grow(_size(path))
+    else:
+        _touch(path)
+    return path
+
+
+def _touch(path):
+    # least recently used is least recently touched
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _size(path):
+    try:
+        if os.path.isdir(path):
+            return sum(os.stat(os.path.join(path, name)).st_size for name in os.listdir(path))
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def disk_entries():
+    """[(last used, size in bytes, path)] of every on-disk entry."""
+    out = []
+    root = cache_dir()
+    if not os.path.isdir(root):
+        return out
+    for kind in os.listdir(root):
+        directory = os.path.join(root, kind)
+        # the result store has its own budget
+        if kind == 'results' or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if '.tmp' in name:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                used = os.stat(path).st_mtime
+            except OSError:
+                continue
+            out.append((used, _size(path), path))
+    return out
+
+
+def evict():
+    """Remove least recently used on-disk entries until the cache fits its budget."""
+    import shutil
+
+    budget = budget_bytes()
+    entries = sorted(disk_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if budget <= 0 or total <= budget:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+    _disk_sizes[cache_dir()] = [total, time.time()]
+
+
+def _grow(size):
+    # add size to the running total, scanning the cache only when needed
+    known = _disk_sizes.get(cache_dir())
+    if known is None or time.time() - known[1] > _RESCAN_SECONDS:
+        evict()
+        return
+    known[0] += size
+    if 0 < budget_bytes() < known[0]:
+        evict()
+
+
+def clear_memory():
+    """Drop the in-process entries (on-disk entries are kept)."""
+    _memory.clear()
+    _file_hashes.clear()
@@ -0,0 +1,163 @@
+# Split/apply/merge over time for column-wise cifti interfaces.
+# Developer Notes:
+# CiftiSmoothing (direction COLUMN), CiftiMath and Reduce (direction COLUMN)
+# treat every map of a dtseries independently, so a long run can be cut into
+# blocks of maps, each block processed by its own copy of the interface in a
+# separate process, and the outputs stacked back together. Chunk files are
+# written next to the work directory and removed afterwards. The merged output
+# takes its map axis (e.g. the SeriesAxis with the original start and step)
+# from the full input instead of from the chunks.
+
+import os
+
+import numpy as np
+
+
+def _chunk_ranges(n_maps, n_chunks):
+    edges = np.linspace(0, n_maps, min(n_chunks, n_maps) + 1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _write_chunks(filename, ranges, directory, block_mb=256):
+    # one file per range holding those maps of ``filename``
+    from .cifti_io import load_cifti, create_cifti, rows_per_block, flush
+
+    img, data = load_cifti(filename)
+    map_axis, brain_axis = img.header.get_axis(0), img.header.get_axis(1)
+    base = os.path.basename(filename)
+    paths = []
+    for i, (start, stop) in enumerate(ranges):
+        path = os.path.join(directory, 'chunk{:04d}_{}'.format(i, base))
+        out = create_cifti(path, (map_axis[start:stop], brain_axis))
+        step = rows_per_block(data.shape[1] * 8, block_mb)
+        for row in range(start, stop, step):
+            end = min(row + step, stop)
+            out[row - start:end - start] = data[row:end]
+        flush(out)
+        del out
+        paths.append(path)
+    return paths
+
+
+def _split_inputs(interface, ranges, directory):
+    """Per-chunk input dicts for ``interface``, writing the chunk files."""
+    import shlex
+    from .cifti import CiftiSmoothing, CiftiMath, Reduce
+    from .cifti_io import load_cifti
+    from .mathexpr import parse_var
+
+    # chunks run in their own directories, so relative paths must be resolved here
+    inputs = {name: os.path.abspath(value) if isinstance(value, str) and os.path.exists(value)
+              else value
+              for name, value in interface.inputs.get_traitsfree().items()}
+    inputs.pop('out_file', None)
+    chunks = [dict(inputs) for _ in ranges]
+
+    if isinstance(interface, (CiftiSmoothing, Reduce)):
+        if interface.inputs.direction != 'COLUMN':
+            raise ValueError('{} can only be split over time with direction COLUMN'.format(
+                interface.__class__.__name__))
+        for chunk, path in zip(chunks, _write_chunks(interface.inputs.in_file, ranges, directory)):
+            chunk['in_file'] = path
+        return chunks, interface.inputs.in_file
+
+    if isinstance(interface, CiftiMath):
+        n_maps = ranges[-1][1]
+        split_vars = [[] for _ in ranges]
+        template = None
+        for name, spec in interface.inputs.in_vars:
+            filename, options = parse_var(spec)
+            _, data = load_cifti(filename)
+            modifiers = shlex.split(spec)[1:]
+            # single maps (-select 1 n, -repeat) are used as they are by every chunk
+            if '-select' in options and options['-select'][0] == '1' or data.shape[0] != n_maps:
+                spec = ' '.join(shlex.quote(t) for t in [os.path.abspath(filename)] + modifiers)
+                for chunk_vars in split_vars:
+                    chunk_vars.append((name, spec))
+                continue
+            template = template or filename
+            for chunk_vars, path in zip(split_vars,
+                                        _write_chunks(filename, ranges, directory)):
+                chunk_vars.append((name, ' '.join(shlex.quote(t) for t in [path] + modifiers)))
+        if template is None:
+            raise ValueError('no variable of the expression has more than one map to split')
+        for chunk, chunk_vars in zip(chunks, split_vars):
+            chunk['in_vars'] = chunk_vars
+        return chunks, template
+
+    raise ValueError('{} cannot be split over time'.format(interface.__class__.__name__))
+
+
+def _n_maps(interface):
+    from .cifti import CiftiMath
+    from .cifti_io import load_cifti
+    from .mathexpr import parse_var
+
+    if isinstance(interface, CiftiMath):
+        counts = []
+        for _, spec in interface.inputs.in_vars:
+            filename, options = parse_var(spec)
+            if '-select' in options and options['-select'][0] == '1' or '-repeat' in options:
+                continue
+            counts.append(load_cifti(filename)[1].shape[0])
+        if not counts:
+            return 1
+        return max(counts)
+    return load_cifti(interface.inputs.in_file)[1].shape[0]
+
+
+def _run_chunk(interface_class, inputs, directory):
+    # runs in a worker process
+    interface = interface_class(**inputs)
+    result = interface.run(cwd=directory)
+    return result.outputs.out_file
+
+
+def run_time_chunked(interface, n_chunks=None, n_procs=None, block_mb=256):
+    """
+    Run a column-wise interface on ``n_chunks`` blocks of maps in a pool of
+    ``n_procs`` processes (both default to the number of cores) and merge the
+    results into the file the interface would have written.
+
+    Returns the interface's outputs.
+    """
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from .cifti_io import load_cifti, create_cifti, rows_per_block, flush
+
+    n_procs = n_procs or os.cpu_count() or 1
+    n_chunks = n_chunks or n_procs
+    ranges = _chunk_ranges(_n_maps(interface), n_chunks)
+    out_file = os.path.abspath(interface._list_outputs()['out_file'])
+
+    directory = tempfile.mkdtemp(prefix='chunks_', dir=os.path.dirname(out_file))
+    try:
+        chunks, template = _split_inputs(interface, ranges, directory)
+        workdirs = [os.path.join(directory, 'run{:04d}'.format(i)) for i in range(len(chunks))]
+        for workdir in workdirs:
+            os.makedirs(workdir)
+        with ProcessPoolExecutor(min(n_procs, len(chunks))) as pool:
+            results = list(pool.map(_run_chunk, [interface.__class__] * len(chunks),
+                                    chunks, workdirs))
+
+        first, _ = load_cifti(results[0])
+        map_axis = load_cifti(template)[0].header.get_axis(0)
+        out = create_cifti(out_file, (map_axis, first.header.get_axis(1)))
+        for (start, stop), path in zip(ranges, results):
+            img, data = load_cifti(path)
+            if img.header.get_axis(1) != first.header.get_axis(1) or data.shape[0] != stop - start:
+                raise ValueError('chunk outputs of {} do not line up'.format(
+                    interface.__class__.__name__))
+            step = rows_per_block(data.shape[1] * 8, block_mb)
+            for row in range(0, data.shape[0], step):
+                out[start + row:min(start + row + step, stop)] = data[row:row + step]
+            del data, img
+        flush(out)
+        del out
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    outputs = interface._outputs()
+    outputs.trait_set(**interface._list_outputs())
+    return outputs
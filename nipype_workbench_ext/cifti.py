@@ -5,7 +5,6 @@
 # inteface before implementing your own. Those are also probably better sources for example interfaces
 # than my own relatively amateurish attempts here.
 
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     BaseInterface, 
     BaseInterfaceInputSpec, 
@@ -14,10 +13,13 @@ from nipype.interfaces.base import (
     isdefined, 
     TraitedSpec, 
     CommandLineInputSpec, 
-    Str
+    Str,
+    Directory
 )
 from traits.api import List
 
+from .base import WBInputSpec, WBCommand, WBEngineInputSpec, WBEngineCommand
+
 _valid_cifti_structs = ['CORTEX_LEFT',
                         'CORTEX_RIGHT',
                         'CEREBELLUM',
@@ -55,9 +57,14 @@ _valid_cifti_structs = ['CORTEX_LEFT',
 _valid_cifti_units = ['SECOND', 'HERTZ', 'METER', 'RADIAN']
 
 # This was drafted by chatGPT based on CiftiConvertNifti and NiftiConvertCifti (below)
-class CiftiConvertTextInputSpec(CommandLineInputSpec):
+# engine='numpy' writes the text in blocks of brainordinates formatted by
+# num_threads worker processes, and can also write the same (brainordinates,
+# maps) matrix as .npy, parquet, arrow, hdf5 or zarr (see export.py), which
+# always run in-process. pyarrow, h5py and zarr are only needed for their format.
+class CiftiConvertTextInputSpec(WBEngineInputSpec):
     to_text = traits.Bool(True,
         argstr="-to-text",
+        position=0,
         usedefault=True,
         desc="Convert CIFTI to text")
 
@@ -76,27 +83,72 @@ class CiftiConvertTextInputSpec(CommandLineInputSpec):
         desc="Output text file"
     )
 
+    col_delim = Str(
+        argstr="-col-delim '%s'",
+        position=3,
+        desc="string to put between the values of a row (default tab)"
+    )
+
+    out_format = traits.Enum('text', 'npy', 'parquet', 'arrow', 'hdf5', 'zarr',
+        usedefault=True,
+        desc="output format. Formats other than text always use engine='numpy'"
+    )
+
+    chunks = traits.Tuple(traits.Int, traits.Int,
+        desc="(brainordinates, maps) chunk shape for hdf5 and zarr. For parquet and arrow "
+             "the brainordinates per row group/record batch"
+    )
+
+    compression = Str(
+        desc="compression codec of the writing library, e.g. 'gzip' or 'lzf' for hdf5, "
+             "'zstd', 'snappy' or 'lz4' for parquet/arrow, 'zstd', 'gzip' or 'blosc' for zarr"
+    )
+
+    block_mb = traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the input to hold at once with engine='numpy'"
+    )
+
 
 class CiftiConvertTextOutputSpec(TraitedSpec):
-    out_file = File(
-        exists=True,
-        desc="Converted text output"
+    out_file = traits.Either(
+        File(exists=True),
+        Directory(exists=True),
+        desc="Converted text output (a directory for zarr)"
     )
 
 
-class CiftiConvertText(wb.WBCommand):
+class CiftiConvertText(WBEngineCommand):
     input_spec = CiftiConvertTextInputSpec
     output_spec = CiftiConvertTextOutputSpec
 
     _cmd = 'wb_command -cifti-convert'
 
+    def _use_numpy(self):
+        return super()._use_numpy() or self.inputs.out_format != 'text'
+
+    def _run_numpy(self, runtime):
+        from .export import export_cifti
+
+        def _get(name, default=None):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else default
+
+        export_cifti(self.inputs.in_file, self._gen_filename('out_file'), self.inputs.out_format,
+                     chunks=_get('chunks'), compression=_get('compression'),
+                     col_delim=_get('col_delim', '\t'), block_mb=self.inputs.block_mb,
+                     n_workers=self._num_threads())
+        return runtime
+
     def _gen_filename(self, name):
         import os
+        from .export import FORMATS
+
         if name == 'out_file':
             if not isdefined(self.inputs.out_file):
                 base, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
                 base, _ = os.path.splitext(base)
-                return os.path.join(os.getcwd(), base + '.txt')
+                return os.path.join(os.getcwd(), base + FORMATS[self.inputs.out_format])
             return self.inputs.out_file
 
     def _list_outputs(self):
@@ -106,7 +158,7 @@ class CiftiConvertText(wb.WBCommand):
 
 # convert cifti to nifti and back
 # this interface was drafted by ChatGPT then heavily modified by BP.
-class CiftiConvertNiftiInputSpec(CommandLineInputSpec):
+class CiftiConvertNiftiInputSpec(WBInputSpec):
     to_nifti = traits.Bool(True,
         argstr="-to-nifti",
         position=0,
@@ -149,7 +201,7 @@ class CiftiConvertNiftiOutputSpec(TraitedSpec):
     )
 
 
-class CiftiConvertNifti(wb.WBCommand):
+class CiftiConvertNifti(WBCommand):
     input_spec = CiftiConvertNiftiInputSpec
     output_spec = CiftiConvertNiftiOutputSpec
     _cmd = 'wb_command -cifti-convert'
@@ -184,7 +236,10 @@ class CiftiConvertNifti(wb.WBCommand):
 
 # convert cifti to nifti and back
 # this interface was drafted by ChatGPT then heavily modified by BP.
-class NiftiConvertCiftiInputSpec(CommandLineInputSpec):
+# engine='numpy' takes the template's header from the template index cache (see
+# template.py) instead of parsing it, and copies the nifti's voxels into the
+# output in blocks of maps.
+class NiftiConvertCiftiInputSpec(WBEngineInputSpec):
     from_nifti = traits.Bool(True,
         argstr="-from-nifti",
         position=0,
@@ -220,6 +275,9 @@ class NiftiConvertCiftiInputSpec(CommandLineInputSpec):
         position=-1,
         requires=['from_nifti']
     )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the output to hold at once with engine='numpy'")
 
 class NiftiConvertCiftiOutputSpec(TraitedSpec):
     out_file = File(
@@ -227,11 +285,22 @@ class NiftiConvertCiftiOutputSpec(TraitedSpec):
         exists=True
     )
 
-class NiftiConvertCifti(wb.WBCommand):
+class NiftiConvertCifti(WBEngineCommand):
     input_spec = NiftiConvertCiftiInputSpec
     output_spec = NiftiConvertCiftiOutputSpec
     _cmd = 'wb_command -cifti-convert'
 
+    def _run_numpy(self, runtime):
+        from .template import nifti_to_cifti
+
+        if not isdefined(self.inputs.cifti_template):
+            raise ValueError("cifti_template is required when from_nifti is True")
+        nifti_to_cifti(self.inputs.nifti_in, self.inputs.cifti_template,
+                       self._list_outputs()['out_file'],
+                       reset_scalars=bool(self.inputs.reset_scalars),
+                       block_mb=self.inputs.block_mb)
+        return runtime
+
     def _check_required_inputs(self):
         """Ensure required inputs are in place based on the conversion direction."""
         super(CiftiConvertNifti, self)._check_required_inputs()
@@ -267,17 +336,32 @@ class NiftiConvertCifti(wb.WBCommand):
                     ext2 = '.dscalar'
 
                 return os.path.join(os.getcwd(), fname + ext2 + ext1)
-            return self.inputs.nifti_out
+            return self.inputs.cifti_out
+
+
 
+def _structure_color(key):
+    # distinct, fixed colour of a structure's label
+    import colorsys
+
+    return colorsys.hsv_to_rgb((key * 0.618034) % 1.0, 0.65, 0.9) + (1.0,)
 
 
 # convert cifti to nifti and back
 # Note: this is a quick and dirty implementation. It is not as fexible
 # as the wb_command CLI. It's specifically designed to work with scenarios
-# where an HCP style cifti needs to be separated. If surfaces or volumes differ
-# this could break (e.g. if you have cerebellar surfaces) without additional
-# mods
-class CiftiSeparateInputSpec(CommandLineInputSpec):
+# where an HCP style cifti needs to be separated. Metric and label outputs
+# work for any structure (e.g. cerebellar surfaces); structures other than
+# CORTEX_LEFT/RIGHT get their <STRUCTURE>_out output added when requested.
+# engine='numpy' reads the brain model axis once and writes every requested
+# structure and the volume-all files in one pass over the memory-mapped
+# matrix, each structure being a view of its block of brainordinates. The
+# label volume of volume_all keys each structure by its place in
+# _valid_cifti_structs (plus one) and carries a label table naming them.
+# Compressed volumes are written through an uncompressed temporary file, see
+# volume_io.create_volume. Output names only depend on the inputs, so
+# separate instances can run in threads.
+class CiftiSeparateInputSpec(WBEngineInputSpec):
     in_file=File(
         desc="The cifti to ceparate a component of",
         exists=True,
@@ -314,6 +398,10 @@ class CiftiSeparateInputSpec(CommandLineInputSpec):
         position=4,
         usedefault=True)
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of in_file to hold at once with engine='numpy'")
+
 class CiftiSeparateOutputSpec(TraitedSpec):
     volume_all_out=traits.Either(File(), None)
     volume_all_roi_out=traits.Either(File(), None)
@@ -322,26 +410,48 @@ class CiftiSeparateOutputSpec(TraitedSpec):
     CORTEX_RIGHT_out=traits.Either(File(), None)
 
 
-class CiftiSeparate(wb.WBCommand):
+class CiftiSeparate(WBEngineCommand):
     input_spec = CiftiSeparateInputSpec
     output_spec = CiftiSeparateOutputSpec
 
 
     _cmd = 'wb_command -cifti-separate'
-    metric_files = dict()
-    label_files = dict()
 
-    def _format_arg(self, name, spec, value):
+    def _structures(self):
+        structures = []
+        for name in ('metric', 'label'):
+            value = getattr(self.inputs, name)
+            if isdefined(value):
+                for structure in value:
+                    if structure not in _valid_cifti_structs:
+                        raise ValueError('{} is not a cifti structure'.format(structure))
+                    structures.append((name, structure))
+        return structures
+
+    def _outputs(self):
+        outputs = super()._outputs()
+        # one output per requested structure, whatever the structure
+        for _, structure in self._structures():
+            if structure + '_out' not in outputs.trait_names():
+                outputs.add_trait(structure + '_out', traits.Either(File(), None))
+        return outputs
+
+    def _base_name(self):
         import os
 
+        fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
+        fname, _ = os.path.splitext(fname)
+        return fname
+
+    def _format_arg(self, name, spec, value):
         if name == 'volume_all':
-            cwd = os.getcwd()
-            fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-            fname, _ = os.path.splitext(fname)
+            if not value:
+                return None
+            outputs = self._list_outputs()
             return '-volume-all {0} -roi {1} -label {2}'.format(
-                        os.path.join(cwd, fname + '_volume_all.nii.gz'),
-                        os.path.join(cwd, fname + '_volume_all_roi.nii.gz'),
-                        os.path.join(cwd, fname + '_volume_all_label.nii.gz'))
+                        outputs['volume_all_out'],
+                        outputs['volume_all_roi_out'],
+                        outputs['volume_all_label_out'])
         if name == 'metric':
             return ' '.join(self._format_metric_arg(v) for v in value)
         if name == 'label':
@@ -349,63 +459,118 @@ class CiftiSeparate(wb.WBCommand):
         return super(CiftiSeparate, self)._format_arg(name, spec, value)
 
     def _format_metric_arg(self, structure):
-        import os
-
-        fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-        fname, _ = os.path.splitext(fname)
-
-        filename = os.path.join(os.getcwd(), fname + '_' + structure + '.func.gii')
-        self.metric_files[structure] = filename
+        return "-metric {} {}".format(structure, self._list_outputs()[structure + '_out'])
 
-        return "-metric {} {}".format(structure, filename)
-
-    
     def _format_label_arg(self, structure):
-        import os
-
-        fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-        fname, _ = os.path.splitext(fname)
-
-        filename = os.path.join(os.getcwd(), fname + '_' + structure + '.label.gii')
-        self.label_files[structure] = filename
+        return "-label {} {}".format(structure, self._list_outputs()[structure + '_out'])
+
+    def _run_numpy(self, runtime):
+        import numpy as np
+        import nibabel as nib
+        from nibabel.cifti2 import cifti2_axes
+        from .cifti_io import load_cifti, rows_per_block
+        from .volume_io import create_volume, finish_volume
+
+        img, data = load_cifti(self.inputs.in_file)
+        along = 1 if self.inputs.direction == 'COLUMN' else 0
+        brain_models = img.header.get_axis(along)
+        if not isinstance(brain_models, cifti2_axes.BrainModelAxis):
+            raise ValueError('the {} direction of {} is not dense'.format(
+                self.inputs.direction, self.inputs.in_file))
+        other = img.header.get_axis(1 - along)
+        # (maps, brainordinates) with maps along the other direction
+        if along == 0:
+            data = data.T
+        outputs = self._list_outputs()
+        names = [str(n) for n in getattr(other, 'name', [''] * data.shape[0])]
+        step = rows_per_block(data.shape[1] * 4, self.inputs.block_mb)
+        blocks = {name: (slc, bm) for name, slc, bm in brain_models.iter_structures()}
+
+        for kind, structure in self._structures():
+            cifti_name = 'CIFTI_STRUCTURE_' + structure
+            if cifti_name not in blocks or not blocks[cifti_name][1].surface_mask.any():
+                raise ValueError('{} has no surface data for {}'.format(
+                    self.inputs.in_file, structure))
+            slc, bm = blocks[cifti_name]
+            # a view of this structure's brainordinates, read in blocks of maps
+            view = data[:, slc]
+            values = np.zeros((data.shape[0], bm.nvertices[cifti_name]),
+                              dtype=np.int32 if kind == 'label' else np.float32)
+            for start in range(0, data.shape[0], step):
+                values[start:start + step, bm.vertex] = view[start:start + step]
+            meta = {'AnatomicalStructurePrimary': structure.title().replace('_', '')}
+            darrays_meta = [nib.gifti.GiftiMetaData({'Name': name}) for name in names]
+            if kind == 'metric':
+                darrays = [nib.gifti.GiftiDataArray(row, intent='NIFTI_INTENT_NONE',
+                                                    datatype='NIFTI_TYPE_FLOAT32', meta=m)
+                           for row, m in zip(values, darrays_meta)]
+                table = None
+            else:
+                darrays = [nib.gifti.GiftiDataArray(row, intent='NIFTI_INTENT_LABEL',
+                                                    datatype='NIFTI_TYPE_INT32', meta=m)
+                           for row, m in zip(values, darrays_meta)]
+                table = nib.gifti.GiftiLabelTable()
+                entries = dict()
+                for label in getattr(other, 'label', []):
+                    entries.update(label)
+                for key, (name, rgba) in sorted(entries.items()):
+                    entry = nib.gifti.GiftiLabel(key, *rgba)
+                    entry.label = name
+                    table.labels.append(entry)
+            nib.save(nib.gifti.GiftiImage(meta=nib.gifti.GiftiMetaData(meta), labeltable=table,
+                                          darrays=darrays), outputs[structure + '_out'])
 
-        return "-label {} {}".format(structure, filename)
+        if self.inputs.volume_all:
+            volume = np.flatnonzero(brain_models.volume_mask)
+            if not len(volume):
+                raise ValueError('{} has no volume data'.format(self.inputs.in_file))
+            shape = brain_models.volume_shape
+            template = nib.Nifti1Image(np.broadcast_to(np.zeros((), np.float32), shape),
+                                       brain_models.affine)
+            ijk = brain_models.voxel[volume]
+            flat = np.ravel_multi_index(tuple(ijk.T), shape, order='F')
+            out = create_volume(outputs['volume_all_out'], template, data.shape[0])
+            # volume brainordinates are normally contiguous, so this is one slice of the file
+            view = data[:, volume[0]:volume[-1] + 1]
+            for start in range(0, data.shape[0], step):
+                out[start:start + step, flat] = view[start:start + step][:, volume - volume[0]]
+            finish_volume(out, outputs['volume_all_out'], template)
+            del out
+
+            roi = create_volume(outputs['volume_all_roi_out'], template, 1)
+            roi[0, flat] = 1
+            finish_volume(roi, outputs['volume_all_roi_out'], template)
+            del roi
+
+            # keys follow _valid_cifti_structs, so a structure has the same key in every file
+            structures = [str(n)[len('CIFTI_STRUCTURE_'):] for n in
+                          np.asarray(brain_models.name)[volume]]
+            present, inverse = np.unique(structures, return_inverse=True)
+            present_keys = np.array([_valid_cifti_structs.index(n) + 1 for n in present])
+            table = {0: ('???', (0.0, 0.0, 0.0, 0.0))}
+            table.update((int(key), (name, _structure_color(key)))
+                         for name, key in zip(present, present_keys))
+            labels = create_volume(outputs['volume_all_label_out'], template, 1, dtype=np.int32,
+                                   label_table=table)
+            labels[0, flat] = present_keys[inverse]
+            finish_volume(labels, outputs['volume_all_label_out'], template)
+            del labels
+        return runtime
 
     def _list_outputs(self):
         import os
 
         outputs = self.output_spec().get()
+        cwd = os.getcwd()
+        fname = self._base_name()
 
         if self.inputs.volume_all:
-            cwd = os.getcwd();
-            fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-            fname, _ = os.path.splitext(fname)
-
             outputs['volume_all_out'] = os.path.join(cwd, fname + '_volume_all.nii.gz')
             outputs['volume_all_roi_out'] = os.path.join(cwd, fname + '_volume_all_roi.nii.gz')
             outputs['volume_all_label_out'] = os.path.join(cwd, fname + '_volume_all_label.nii.gz')
-        '''
-        if isdefined(self.inputs.metric):
-            for structure in self.metric_files:
-                outputs[structure + '_out'] = self.metric_files[structure]
-        if isdefined(self.inputs.label):
-            for structure in self.label_files:
-                outputs[structure + '_out'] = self.label_files[structure]
-
-        return outputs
-        '''
-        if isdefined(self.inputs.metric):
-            cwd = os.getcwd()
-            fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-            fname, _ = os.path.splitext(fname)
-            for structure in self.inputs.metric:
-                outputs[structure + '_out'] = os.path.join(cwd, f"{fname}_{structure}.func.gii")
-        if isdefined(self.inputs.label):
-            cwd = os.getcwd()
-            fname, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
-            fname, _ = os.path.splitext(fname)
-            for structure in self.inputs.label:
-                outputs[structure + '_out'] = os.path.join(cwd, f"{fname}_{structure}.label.gii")
+        for kind, structure in self._structures():
+            ext = '.func.gii' if kind == 'metric' else '.label.gii'
+            outputs[structure + '_out'] = os.path.join(cwd, f"{fname}_{structure}{ext}")
 
         return outputs
 
@@ -415,7 +580,11 @@ class CiftiSeparate(wb.WBCommand):
 # where an HCP style cifti needs to be merged. If surfaces or volumes differ
 # this could break (e.g. if you have cerebellar surfaces) without additional
 # mods
-class CiftiCreateDenseTimeseriesInputSpec(CommandLineInputSpec):
+# engine='numpy' (here and in CiftiCreateDenseScalar and CiftiCreateLabel)
+# caches the brainordinates implied by the rois and the structure label volume
+# and streams blocks of maps from the inputs into the preallocated output (see
+# dense.py), so the full matrix is never held in memory.
+class CiftiCreateDenseTimeseriesInputSpec(WBEngineInputSpec):
     out_file=File(
         argstr='%s',
         position=0,
@@ -466,18 +635,38 @@ class CiftiCreateDenseTimeseriesInputSpec(CommandLineInputSpec):
     # cerebellum can be incorporated by copying the left_metric and right_metric implementations
     # note the _format_arg() function though and add appropriate handling there too
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the output to hold at once with engine='numpy'")
+
 class CiftiCreateDenseTimeseriesOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class CiftiCreateDenseTimeseries(wb.WBCommand):
+class CiftiCreateDenseTimeseries(WBEngineCommand):
     input_spec = CiftiCreateDenseTimeseriesInputSpec
     output_spec = CiftiCreateDenseTimeseriesOutputSpec
 
     _cmd = 'wb_command -cifti-create-dense-timeseries'
 
+    def _run_numpy(self, runtime):
+        from .dense import create_dense
+
+        def _get(name):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else None
+
+        surfaces = dict()
+        if isdefined(self.inputs.left_metric):
+            surfaces['CORTEX_LEFT'] = (self.inputs.left_metric, _get('left_roi'))
+        if isdefined(self.inputs.right_metric):
+            surfaces['CORTEX_RIGHT'] = (self.inputs.right_metric, _get('right_roi'))
+        create_dense('dtseries', self._gen_filename('out_file'), surfaces, _get('volume'),
+                     _get('volume_label'), self.inputs.block_mb)
+        return runtime
+
 
     def _gen_filename(self, name):
         import os
@@ -504,7 +693,7 @@ class CiftiCreateDenseTimeseries(wb.WBCommand):
 # this could break (e.g. if you have cerebellar surfaces) without additional
 # mods. Note syntax is basically identical to CiftiCreateDenseTimeseries and
 # mods to one should also work on the other.
-class CiftiCreateDenseScalarInputSpec(CommandLineInputSpec):
+class CiftiCreateDenseScalarInputSpec(WBEngineInputSpec):
     out_file=File(
         argstr='%s',
         position=0,
@@ -555,18 +744,38 @@ class CiftiCreateDenseScalarInputSpec(CommandLineInputSpec):
     # cerebellum can be incorporated by copying the left_metric and right_metric implementations
     # note the _format_arg() function though and add appropriate handling there too
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the output to hold at once with engine='numpy'")
+
 class CiftiCreateDenseScalarOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class CiftiCreateDenseScalar(wb.WBCommand):
+class CiftiCreateDenseScalar(WBEngineCommand):
     input_spec = CiftiCreateDenseScalarInputSpec
     output_spec = CiftiCreateDenseScalarOutputSpec
 
     _cmd = 'wb_command -cifti-create-dense-scalar'
 
+    def _run_numpy(self, runtime):
+        from .dense import create_dense
+
+        def _get(name):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else None
+
+        surfaces = dict()
+        if isdefined(self.inputs.left_metric):
+            surfaces['CORTEX_LEFT'] = (self.inputs.left_metric, _get('left_roi'))
+        if isdefined(self.inputs.right_metric):
+            surfaces['CORTEX_RIGHT'] = (self.inputs.right_metric, _get('right_roi'))
+        create_dense('dscalar', self._gen_filename('out_file'), surfaces, _get('volume'),
+                     _get('volume_label'), self.inputs.block_mb)
+        return runtime
+
 
     def _gen_filename(self, name):
         import os
@@ -590,7 +799,7 @@ class CiftiCreateDenseScalar(wb.WBCommand):
 # this could break (e.g. if you have cerebellar surfaces) without additional
 # mods. Note syntax is basically identical to CiftiCreateDenseTimeseries and
 # mods to one should also work on the other.
-class CiftiCreateLabelInputSpec(CommandLineInputSpec):
+class CiftiCreateLabelInputSpec(WBEngineInputSpec):
     out_file=File(
         argstr='%s',
         position=0,
@@ -641,18 +850,38 @@ class CiftiCreateLabelInputSpec(CommandLineInputSpec):
     # cerebellum can be incorporated by copying the left_label and right_label implementations
     # note the _format_arg() function though and add appropriate handling there too
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the output to hold at once with engine='numpy'")
+
 class CiftiCreateLabelOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class CiftiCreateLabel(wb.WBCommand):
+class CiftiCreateLabel(WBEngineCommand):
     input_spec = CiftiCreateLabelInputSpec
     output_spec = CiftiCreateLabelOutputSpec
 
     _cmd = 'wb_command -cifti-create-label'
 
+    def _run_numpy(self, runtime):
+        from .dense import create_dense
+
+        def _get(name):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else None
+
+        surfaces = dict()
+        if isdefined(self.inputs.left_label):
+            surfaces['CORTEX_LEFT'] = (self.inputs.left_label, _get('left_roi'))
+        if isdefined(self.inputs.right_label):
+            surfaces['CORTEX_RIGHT'] = (self.inputs.right_label, _get('right_roi'))
+        create_dense('dlabel', self._gen_filename('out_file'), surfaces, _get('volume'),
+                     _get('volume_label'), self.inputs.block_mb)
+        return runtime
+
 
     def _gen_filename(self, name):
         import os
@@ -670,7 +899,13 @@ class CiftiCreateLabel(wb.WBCommand):
 
 
 # another quick and dirty implementation
-class CiftiMergeInputSpec(CommandLineInputSpec):
+# engine='numpy' checks every input against the others from their headers
+# alone, then copies them block by block into the preallocated output (see
+# merge.py), so the number of inputs is not limited by memory. Inputs can
+# select maps as with wb_command, e.g. 'run.dtseries.nii -column 1 -up-to 100'.
+# append=True adds the inputs' maps to an existing out_file and always runs
+# in-process.
+class CiftiMergeInputSpec(WBEngineInputSpec):
     out_file=File(
         argstr='%s',
         position=0,
@@ -678,24 +913,51 @@ class CiftiMergeInputSpec(CommandLineInputSpec):
         desc="The output cifti file. Autogenerated if not specified."
     )
 
-    cifti=traits.List(File(exists=True),
-        desc='specify an input cifti file list',
+    cifti=traits.List(traits.Either(File(exists=True), Str()),
+        desc='specify an input cifti file list. An entry can be followed by -column <n> '
+             '[-up-to <last> [-reverse]] (repeatable, 1-based) to only use those maps',
         argstr='-cifti %s...',
         mandatory=True,
         position=1)
 
+    append=traits.Bool(False,
+        usedefault=True,
+        desc="add the maps of the inputs to the end of out_file if it exists")
+
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of an input to hold at once with engine='numpy'")
+
 class CiftiMergeOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class CiftiMerge(wb.WBCommand):
+class CiftiMerge(WBEngineCommand):
     input_spec = CiftiMergeInputSpec
     output_spec = CiftiMergeOutputSpec
 
     _cmd = 'wb_command -cifti-merge'
 
+    def _use_numpy(self):
+        # wb_command cannot read and write out_file at once
+        return super()._use_numpy() or self.inputs.append
+
+    def _extra_input_files(self):
+        # with append the existing out_file is an input (see store.result_key)
+        import os
+
+        out_file = self._gen_filename('out_file')
+        return [out_file] if self.inputs.append and os.path.isfile(out_file) else []
+
+    def _run_numpy(self, runtime):
+        from .merge import merge_cifti
+
+        merge_cifti(self._gen_filename('out_file'), self.inputs.cifti,
+                    append=self.inputs.append, block_mb=self.inputs.block_mb)
+        return runtime
+
     def _gen_filename(self, name):
         import os
 
@@ -713,7 +975,13 @@ class CiftiMerge(wb.WBCommand):
 
 
 # Drafted by chatGPT
-class ParcellateInputSpec(CommandLineInputSpec):
+# engine='numpy' parses each dlabel once (cached by content hash, see
+# cifti_io.parcel_index) and applies it as a sparse product over contiguous
+# blocks of brainordinates, so per subject cost for MEAN/SUM/STDEV/VARIANCE is
+# about one read of in_file. MEDIAN and MODE read blocks of maps instead, which
+# costs a read of in_file per block once it does not fit in the page cache. It
+# requires in_file and parcellation to have the same brainordinates.
+class ParcellateInputSpec(WBEngineInputSpec):
     in_file = File(
         exists=True,
         argstr="%s",
@@ -722,12 +990,15 @@ class ParcellateInputSpec(CommandLineInputSpec):
         desc="Input CIFTI data file (e.g., dtseries.nii or dscalar.nii)"
     )
 
-    parcellation = File(
-        exists=True,
+    parcellation = traits.Either(
+        File(exists=True),
+        traits.List(File(exists=True)),
         argstr="%s",
         position=1,
         mandatory=True,
-        desc="CIFTI label file defining parcels (e.g., a dlabel.nii)"
+        desc="CIFTI label file defining parcels (e.g., a dlabel.nii). A list of label "
+             "files parcellates in_file against every atlas from a single read of "
+             "in_file (always in-process), writing one output per atlas to out_files"
     )
 
     direction = traits.Enum(
@@ -752,20 +1023,96 @@ class ParcellateInputSpec(CommandLineInputSpec):
         desc="Statistical method to apply for parcellation"
     )
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of in_file to hold at once with engine='numpy'")
+
 
 class ParcellateOutputSpec(TraitedSpec):
     out_file = File(
         exists=True,
         desc="Parcellated output CIFTI file"
     )
+    out_files = traits.List(File(exists=True),
+        desc="Parcellated output CIFTI files, one per parcellation (multi-atlas mode only)"
+    )
 
 
-class Parcellate(wb.WBCommand):
+class Parcellate(WBEngineCommand):
     input_spec = ParcellateInputSpec
     output_spec = ParcellateOutputSpec
 
     _cmd = 'wb_command -cifti-parcellate'
 
+    def _multi_atlas(self):
+        return isinstance(self.inputs.parcellation, list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._multi_atlas()
+
+    def _check_mandatory_inputs(self):
+        super()._check_mandatory_inputs()
+        if self._multi_atlas() and isdefined(self.inputs.out_file):
+            raise ValueError('out_file cannot be set with a list of parcellations, '
+                             'their outputs are named after in_file and each atlas')
+
+    def _run_numpy(self, runtime):
+        import numpy as np
+        from .cifti_io import (load_cifti, iter_map_blocks, iter_brainordinate_blocks,
+                               parcel_index, label_indicator, brain_model_hash, parcels_axis,
+                               save_cifti)
+        from .reductions import reduce_rois, RoiReducer, ROI_STREAMING_OPERATIONS
+
+        img, data = load_cifti(self.inputs.in_file)
+        map_axis, brain_models = img.header.get_axis(0), img.header.get_axis(1)
+        if hasattr(map_axis, 'label'):
+            raise ValueError('engine="numpy" does not parcellate dlabel files')
+        atlases = self._parcellations()
+        indices = [parcel_index(atlas) for atlas in atlases]
+        bm_hash = brain_model_hash(brain_models)
+        for atlas, index in zip(atlases, indices):
+            if str(index['brain_model_hash']) != bm_hash:
+                raise ValueError('{} and {} do not have the same brainordinates, '
+                                 'use engine="wb_command"'.format(self.inputs.in_file, atlas))
+        indicators = [label_indicator(atlas)[0] for atlas in atlases]
+        method = self.inputs.method if isdefined(self.inputs.method) else 'MEAN'
+
+        if method in ROI_STREAMING_OPERATIONS:
+            # stream in_file once in contiguous blocks of brainordinates and feed
+            # every atlas from each block
+            reducers = [RoiReducer(indicator, method) for indicator in indicators]
+            for start, stop, block in iter_brainordinate_blocks(data, self.inputs.block_mb):
+                for reducer in reducers:
+                    reducer.update(start, stop, block)
+            parcellated = [reducer.result() for reducer in reducers]
+        else:
+            # MEDIAN/MODE need every value of a parcel at once. Blocks of maps are
+            # strided reads, so in_file is read once per block when it does not
+            # fit in the page cache
+            parcellated = [np.empty((data.shape[0], ind.shape[1])) for ind in indicators]
+            for start, stop, block in iter_map_blocks(data, self.inputs.block_mb):
+                for out, indicator in zip(parcellated, indicators):
+                    out[start:stop] = reduce_rois(block, indicator, method)
+        for out, index, out_file in zip(parcellated, indices, self._out_files()):
+            save_cifti(out, (map_axis, parcels_axis(index, brain_models)), out_file)
+        return runtime
+
+    def _parcellations(self):
+        if self._multi_atlas():
+            return list(self.inputs.parcellation)
+        return [self.inputs.parcellation]
+
+    def _out_files(self):
+        import os
+        if not self._multi_atlas():
+            return [self._gen_filename('out_file')]
+        from .base import unique_stems
+
+        base, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
+        base, _ = os.path.splitext(base)
+        return [os.path.join(os.getcwd(), '{}_{}_parcellated.ptseries.nii'.format(base, atlas))
+                for atlas in unique_stems(self.inputs.parcellation)]
+
     def _gen_filename(self, name):
         import os
         if name == 'out_file':
@@ -777,12 +1124,20 @@ class Parcellate(wb.WBCommand):
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
-        outputs['out_file'] = self._gen_filename('out_file')
+        if self._multi_atlas():
+            outputs['out_files'] = self._out_files()
+        else:
+            outputs['out_file'] = self._gen_filename('out_file')
         return outputs
 
 
 # CiftiReduce interfaces drafted by chatGPT
-class ReduceInputSpec(CommandLineInputSpec):
+# engine='numpy' memory-maps in_file and streams it in blocks of at most block_mb
+# so peak memory does not grow with the length of the run. ROW reductions read
+# contiguous brainordinate blocks. COLUMN reductions accumulate across
+# brainordinate blocks in one pass (two with exclude_outliers), except MEDIAN and
+# MODE which need whole columns and read blocks of maps instead.
+class ReduceInputSpec(WBEngineInputSpec):
     in_file = File(
         exists=True,
         argstr="%s",
@@ -815,6 +1170,10 @@ class ReduceInputSpec(CommandLineInputSpec):
         argstr="-only-numeric",
         desc="Filter non‑numeric values before reduction")
 
+    block_mb = traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of in_file to hold at once with engine='numpy'")
+
     out_file = File(
         argstr="%s",
         position=-1,
@@ -827,12 +1186,77 @@ class ReduceOutputSpec(TraitedSpec):
         desc="Reduced output CIFTI file"
     )
 
-class Reduce(wb.WBCommand):
+class Reduce(WBEngineCommand):
     input_spec = ReduceInputSpec
     output_spec = ReduceOutputSpec
 
     _cmd = 'wb_command -cifti-reduce'
 
+    def _valid_mask(self, block, axis):
+        import numpy as np
+        from .reductions import outlier_mask
+
+        mask = np.isfinite(block) if self.inputs.only_numeric else np.ones(block.shape, bool)
+        if isdefined(self.inputs.exclude_outliers):
+            below, above = self.inputs.exclude_outliers
+            mask = outlier_mask(block, below, above, axis=axis, mask=mask)
+        return mask
+
+    def _reduce_columns_streaming(self, data):
+        # reduce every map across brainordinates with one-pass accumulators
+        import numpy as np
+        from .cifti_io import iter_brainordinate_blocks
+        from .reductions import StreamingReducer
+
+        bounds = None
+        if isdefined(self.inputs.exclude_outliers):
+            # first pass: per map mean and stdev of the values we may keep
+            moments = StreamingReducer('STDEV')
+            for _, _, block in iter_brainordinate_blocks(data, self.inputs.block_mb):
+                moments.update(block.T, np.isfinite(block.T) if self.inputs.only_numeric else None)
+            stdev = moments.result()
+            below, above = self.inputs.exclude_outliers
+            bounds = (moments.mean - below * stdev, moments.mean + above * stdev)
+
+        reducer = StreamingReducer(self.inputs.operation)
+        for _, _, block in iter_brainordinate_blocks(data, self.inputs.block_mb):
+            block = block.T
+            mask = np.isfinite(block) if self.inputs.only_numeric else np.ones(block.shape, bool)
+            if bounds is not None:
+                mask &= (block >= bounds[0]) & (block <= bounds[1])
+            reducer.update(block, mask)
+        return reducer.result()
+
+    def _run_numpy(self, runtime):
+        import numpy as np
+        from nibabel.cifti2 import ScalarAxis
+        from .cifti_io import (load_cifti, iter_map_blocks, iter_brainordinate_blocks,
+                               save_cifti)
+        from .reductions import reduce_masked, STREAMING_OPERATIONS
+
+        img, data = load_cifti(self.inputs.in_file)
+        operation = self.inputs.operation
+        if self.inputs.direction == 'ROW':
+            # every brainordinate block holds whole rows, so reduce it exactly
+            reduced = np.empty(data.shape[1])
+            for start, stop, block in iter_brainordinate_blocks(data, self.inputs.block_mb):
+                reduced[start:stop] = reduce_masked(
+                    block, self._valid_mask(block, 0), operation, axis=0)
+            reduced = reduced[None, :]
+            axes = (ScalarAxis([operation]), img.header.get_axis(1))
+        else:
+            if operation in STREAMING_OPERATIONS:
+                reduced = self._reduce_columns_streaming(data)
+            else:
+                reduced = np.empty(data.shape[0])
+                for start, stop, block in iter_map_blocks(data, self.inputs.block_mb):
+                    reduced[start:stop] = reduce_masked(
+                        block, self._valid_mask(block, 1), operation, axis=1)
+            reduced = reduced[:, None]
+            axes = (img.header.get_axis(0), ScalarAxis([operation]))
+        save_cifti(reduced, axes, self._gen_filename('out_file'))
+        return runtime
+
     def _gen_filename(self, name):
         import os
         if name == 'out_file':
@@ -851,9 +1275,12 @@ class Reduce(wb.WBCommand):
 # partial implementation
 # TODO: 
 # - add support for cropped input
-# - add support for label inputs
 # - add support for volume inputs (other than -volume-all)
-class CiftiCreateDenseFromTemplateInputSpec(CommandLineInputSpec):
+# engine='numpy' looks the template's brainordinates up in a template index
+# cached by header hash (see template.py) and copies blocks of maps from every
+# input into their columns of the preallocated output, so against a fixed
+# template (e.g. 91k fsLR) the cost is about that of copying the data.
+class CiftiCreateDenseFromTemplateInputSpec(WBEngineInputSpec):
     template=File(
         argstr='%s',
         position=0,
@@ -896,6 +1323,12 @@ class CiftiCreateDenseFromTemplateInputSpec(CommandLineInputSpec):
         position=-3,
         argstr='-cifti %s...',
         desc="repeatable - use input data from cifti file")
+
+    label=List(traits.BaseTuple(traits.Enum(_valid_cifti_structs), File),
+        exists=True,
+        argstr="-label %s %s...",
+        position=-5,
+        desc=f"List of tuples (struct, file_path) of label files where structure is a string from {_valid_cifti_structs}")
         
     label_collision=traits.Enum('ERROR', 'SURFACES_FIRST', 'LEGACY',
         position=-4,
@@ -903,6 +1336,10 @@ class CiftiCreateDenseFromTemplateInputSpec(CommandLineInputSpec):
         desc="How to handle conflicts between label keys. Legacy matches wb_command v.1.4.2 \
               and earlier. (default ERROR)")
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of the output to hold at once with engine='numpy'")
+
     # cerebellum can be incorporated by copying the left_metric and right_metric implementations
     # note the _format_arg() function though and add appropriate handling there too
 
@@ -912,12 +1349,27 @@ class CiftiCreateDenseFromTemplateOutputSpec(TraitedSpec):
         desc="the output cifti file"
     )
 
-class CiftiCreateDenseFromTemplate(wb.WBCommand):
+class CiftiCreateDenseFromTemplate(WBEngineCommand):
     input_spec = CiftiCreateDenseFromTemplateInputSpec
     output_spec = CiftiCreateDenseFromTemplateOutputSpec
 
     _cmd = 'wb_command -cifti-create-dense-from-template'
 
+    def _run_numpy(self, runtime):
+        from .template import create_from_template
+
+        def _get(name, default=None):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else default
+
+        create_from_template(self._gen_filename('out_file'), self.inputs.template,
+                             cifti=_get('cifti', []), metric=_get('metric', []),
+                             label=_get('label', []), volume_all=_get('volume_all'),
+                             series=_get('series'), series_unit=_get('series_unit', 'SECOND'),
+                             label_collision=_get('label_collision', 'ERROR'),
+                             block_mb=self.inputs.block_mb)
+        return runtime
+
     def _gen_filename(self, name):
         import os
 
@@ -949,51 +1401,16 @@ class CiftiCreateDenseFromTemplate(wb.WBCommand):
     
 
 
-# another quick and dirty implementation
-class CiftiMergeInputSpec(CommandLineInputSpec):
-    out_file=File(
-        argstr='%s',
-        position=0,
-        genfile=True,
-        desc="The output cifti file. Autogenerated if not specified."
-    )
-
-    cifti=traits.List(File(exists=True),
-        desc='specify an input cifti file list',
-        argstr='-cifti %s...',
-        mandatory=True,
-        position=1)
-
-class CiftiMergeOutputSpec(TraitedSpec):
-    out_file=File(
-        exists=True,
-        desc="the output cifti file"
-    )
-
-class CiftiMerge(wb.WBCommand):
-    input_spec = CiftiMergeInputSpec
-    output_spec = CiftiMergeOutputSpec
-
-    _cmd = 'wb_command -cifti-merge'
-
-    def _gen_filename(self, name):
-        import os
-
-        if name == 'out_file':
-            if 'out_file' not in self.inputs.get() or not isdefined(self.inputs.out_file):
-                return os.path.join(os.getcwd(), 'merged_cifti.dscalar.nii')
-            return self.inputs.out_file
-
-    def _list_outputs(self):
-        outputs = self.output_spec().get()
-        if 'out_file' not in outputs or not isdefined(outputs['out_file']):
-            outputs['out_file'] = self._gen_filename('out_file')
-
-        return outputs
-
 # This has not yet been tested with the roi option, which changes the output format
 # from a float or list of floats to a list of list of floats.
-class CiftiStatsInputSpec(CommandLineInputSpec):
+# engine='numpy' skips the subprocess entirely, which matters when this is called
+# per subject, per roi and per column. In that case the roi's first map is used
+# for every column unless match_maps is set. With roi_label/roi_list, SUM,
+# MEAN, the moments, L2NORM and COUNT_NONZERO are accumulated over contiguous
+# blocks of brainordinates in one read of in_file. Other reductions and
+# percentiles read blocks of maps, which are strided through the whole file:
+# once in_file does not fit in the page cache that is a read per block.
+class CiftiStatsInputSpec(WBEngineInputSpec):
     in_file=Str(
         argstr='%s',
         position=0,
@@ -1035,19 +1452,192 @@ class CiftiStatsInputSpec(CommandLineInputSpec):
         argstr='-show-map-name',
         desc="print column index and name before each output")
 
+    # multi-roi mode. wb_command has no equivalent so these always run in-process
+    roi_label=File(
+        exists=True,
+        xor=['roi', 'roi_list'],
+        desc="dlabel file. Compute the statistic for every parcel of its first map at "
+             "once. Always runs in-process")
+
+    roi_list=traits.List(File(exists=True),
+        xor=['roi', 'roi_label'],
+        desc="list of roi files. Compute the statistic for every roi at once. "
+             "Always runs in-process")
+
+    out_file=File(
+        desc="roi x map table written in multi-roi mode, .npy or .tsv. "
+             "Autogenerated (.npy) if not specified.")
+
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of in_file to hold at once in multi-roi mode")
+
 class CiftiStatsOutputSpec(TraitedSpec):
     value=traits.Either(traits.Float(), 
                         traits.List(traits.Float()), 
                         traits.List(traits.List(traits.Float())),
         desc="For each column of the input a list element is returned resulting from the specified reduction or percentile operation"
     )
+    out_file=File(
+        desc="roi x map table (multi-roi mode only)")
+    roi_names=traits.List(Str(),
+        desc="names of the rows of out_file (multi-roi mode only)")
 
-class CiftiStats(wb.WBCommand):
+class CiftiStats(WBEngineCommand):
     input_spec = CiftiStatsInputSpec
     output_spec = CiftiStatsOutputSpec
 
     _cmd = 'wb_command -cifti-stats'
 
+    def _multi_roi(self):
+        return isdefined(self.inputs.roi_label) or isdefined(self.inputs.roi_list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._multi_roi()
+
+    def _check_mandatory_inputs(self):
+        super()._check_mandatory_inputs()
+        if not isdefined(self.inputs.reduce) and not isdefined(self.inputs.percentile):
+            raise ValueError('CiftiStats needs either reduce (e.g. MEAN) or percentile to be set')
+
+    def _gen_filename(self, name):
+        import os
+        if name == 'out_file':
+            if not isdefined(self.inputs.out_file):
+                base, _ = os.path.splitext(os.path.basename(self.inputs.in_file))
+                base, _ = os.path.splitext(base)
+                return os.path.join(os.getcwd(), base + '_roi_stats.npy')
+            return os.path.abspath(self.inputs.out_file)
+
+    def _roi_names(self):
+        import os
+        from .cifti_io import label_indicator
+
+        if isdefined(self.inputs.roi_label):
+            return label_indicator(self.inputs.roi_label)[2]
+        return [os.path.basename(f).split('.')[0] for f in self.inputs.roi_list]
+
+    def _roi_indicator(self):
+        from .cifti_io import label_indicator, roi_indicator
+
+        if isdefined(self.inputs.roi_label):
+            return label_indicator(self.inputs.roi_label)[0]
+        return roi_indicator(self.inputs.roi_list)
+
+    def _run_multi_roi(self, runtime):
+        import numpy as np
+        from .cifti_io import load_cifti, iter_map_blocks, iter_brainordinate_blocks
+        from . import reductions
+
+        if self.inputs.match_maps:
+            raise ValueError('match_maps cannot be used with roi_label or roi_list')
+        img, data = load_cifti(self.inputs.in_file)
+        if isdefined(self.inputs.column):
+            if not 1 <= self.inputs.column <= data.shape[0]:
+                raise ValueError('column {} is out of range for {}'.format(
+                    self.inputs.column, self.inputs.in_file))
+            data = data[self.inputs.column - 1:self.inputs.column]
+        indicator = self._roi_indicator()
+        names = self._roi_names()
+        if indicator.shape[0] != data.shape[1]:
+            raise ValueError('rois do not match the brainordinates of the input')
+
+        percent = self.inputs.percentile if isdefined(self.inputs.percentile) else None
+        operation = self.inputs.reduce if isdefined(self.inputs.reduce) else None
+        if percent is None and operation in reductions.ROI_STREAMING_OPERATIONS:
+            # one contiguous read of in_file, every roi accumulates from each block
+            reducer = reductions.RoiReducer(indicator, operation)
+            for start, stop, block in iter_brainordinate_blocks(data, self.inputs.block_mb):
+                reducer.update(start, stop, block)
+            table = reducer.result().T
+        else:
+            # order statistics need every value of a roi at once. Blocks of maps
+            # are strided reads, so in_file is read once per block when it does
+            # not fit in the page cache
+            table = np.empty((indicator.shape[1], data.shape[0]))
+            for start, stop, block in iter_map_blocks(data, self.inputs.block_mb):
+                table[:, start:stop] = reductions.reduce_rois(
+                    block, indicator, operation=operation, percent=percent).T
+
+        out_file = self._gen_filename('out_file')
+        if out_file.endswith('.npy'):
+            np.save(out_file, table)
+        else:
+            map_names = getattr(img.header.get_axis(0), 'name', None)
+            if map_names is None:
+                map_names = [str(i + 1) for i in range(img.shape[0])]
+            if isdefined(self.inputs.column):
+                map_names = [map_names[self.inputs.column - 1]]
+            with open(out_file, 'w') as f:
+                f.write('\t'.join(['roi'] + list(map_names)) + '\n')
+                for name, row in zip(names, table):
+                    f.write('\t'.join([name] + [repr(float(v)) for v in row]) + '\n')
+        return runtime
+
+    def _load_roi_stats(self):
+        import numpy as np
+
+        out_file = self._gen_filename('out_file')
+        if out_file.endswith('.npy'):
+            return np.load(out_file)
+        with open(out_file) as f:
+            rows = [line.rstrip('\n').split('\t')[1:] for line in f.readlines()[1:]]
+        return np.array(rows, dtype=float)
+
+    def _list_outputs(self):
+        # the values are parsed from stdout in aggregate_outputs, the only file
+        # is the multi-roi table
+        outputs = self.output_spec().get()
+        if self._multi_roi():
+            outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
+    def _run_numpy(self, runtime):
+        from .cifti_io import load_cifti
+        from . import reductions
+
+        if self._multi_roi():
+            return self._run_multi_roi(runtime)
+
+        img, data = load_cifti(self.inputs.in_file)
+        columns = list(range(data.shape[0]))
+        if isdefined(self.inputs.column):
+            if not 1 <= self.inputs.column <= data.shape[0]:
+                raise ValueError('column {} is out of range for {}'.format(
+                    self.inputs.column, self.inputs.in_file))
+            columns = [self.inputs.column - 1]
+
+        if isdefined(self.inputs.roi):
+            _, roi = load_cifti(self.inputs.roi)
+            if roi.shape[1] != data.shape[1]:
+                raise ValueError('roi does not match the brainordinates of the input')
+            if self.inputs.match_maps and roi.shape[0] != data.shape[0]:
+                raise ValueError('match_maps requires the roi to have as many maps as the input')
+            masks = [roi[c if self.inputs.match_maps else 0] > 0 for c in columns]
+        else:
+            masks = [slice(None)] * len(columns)
+
+        def _reduce(values):
+            if isdefined(self.inputs.percentile):
+                return reductions.percentile(values, self.inputs.percentile, axis=-1)
+            return reductions.reduce(values, self.inputs.reduce, axis=-1)
+
+        if isdefined(self.inputs.roi) and self.inputs.match_maps:
+            values = [_reduce(data[c][m]) for c, m in zip(columns, masks)]
+        else:
+            # same brainordinates for every column, so reduce them all at once
+            values = _reduce(data[columns][:, masks[0]])
+
+        names = getattr(img.header.get_axis(0), 'name', [''] * data.shape[0])
+        lines = []
+        for c, v in zip(columns, values):
+            if self.inputs.show_map_name:
+                lines.append('{}:\t{}:\t{!r}'.format(c + 1, names[c], float(v)))
+            else:
+                lines.append(repr(float(v)))
+        runtime.stdout = '\n'.join(lines) + '\n'
+        return runtime
+
     # function below drafted by chatGPT
     def aggregate_outputs(self, runtime=None, needed_outputs=None):
         outputs = self._outputs()
@@ -1055,10 +1645,18 @@ class CiftiStats(wb.WBCommand):
         # Capture and process the output from the command-line execution
         if runtime is None:
             runtime = self.run()
+
+        if self._multi_roi():
+            outputs.out_file = self._gen_filename('out_file')
+            outputs.value = self._load_roi_stats().tolist()
+            outputs.roi_names = self._roi_names()
+            return outputs
         
         # Parse the output
         try:
-            output_values = [float(x) for x in runtime.stdout.strip().split()]
+            # one line per column, the value is last (show_map_name prefixes it)
+            output_values = [float(line.split()[-1])
+                             for line in runtime.stdout.strip().splitlines()]
             # Assign the parsed values to the output trait
             if len(output_values) == 1:
                 outputs.value = output_values[0]  # Single float value
@@ -1072,7 +1670,11 @@ class CiftiStats(wb.WBCommand):
 
 
 
-class CiftiSmoothingInputSpec(CommandLineInputSpec):
+# engine='numpy' builds the whole smoothing as one sparse brainordinate by
+# brainordinate matrix (see smoothing.py), caches it by the content of the
+# surfaces, areas and roi, and applies it to blocks of maps on all cores. The
+# matrix only depends on the template, so it is built once per mesh and kernel.
+class CiftiSmoothingInputSpec(WBEngineInputSpec):
     in_file=File(
         exists=True,
         argstr='%s',
@@ -1172,18 +1774,83 @@ class CiftiSmoothingInputSpec(CommandLineInputSpec):
         position=15,
         desc="smooth across subcortical structure boundaries")
 
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of in_file to hold at once with engine='numpy'")
+
 class CiftiSmoothingOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class CiftiSmoothing(wb.WBCommand):
+class CiftiSmoothing(WBEngineCommand):
     input_spec = CiftiSmoothingInputSpec
     output_spec = CiftiSmoothingOutputSpec
 
     _cmd = 'wb_command -cifti-smoothing'
 
+    def _operator(self, brain_models):
+        from .smoothing import fwhm_to_sigma, smoothing_operator
+
+        surface_sigma, volume_sigma = self.inputs.surface_kernel, self.inputs.volume_kernel
+        if self.inputs.fwhm:
+            surface_sigma, volume_sigma = fwhm_to_sigma(surface_sigma), fwhm_to_sigma(volume_sigma)
+        surface_files, area_files = dict(), dict()
+        for structure, surface, areas in [
+                ('CIFTI_STRUCTURE_CORTEX_LEFT', 'left_surface', 'left_corrected_areas'),
+                ('CIFTI_STRUCTURE_CORTEX_RIGHT', 'right_surface', 'right_corrected_areas'),
+                ('CIFTI_STRUCTURE_CEREBELLUM', 'cerebellum_surface', 'cerebellum_corrected_areas')]:
+            if isdefined(getattr(self.inputs, surface)):
+                surface_files[structure] = getattr(self.inputs, surface)
+                if isdefined(getattr(self.inputs, areas)):
+                    area_files[structure] = getattr(self.inputs, areas)
+        roi_file = self.inputs.cifti_roi if isdefined(self.inputs.cifti_roi) else None
+        return smoothing_operator(brain_models, surface_files, area_files, surface_sigma,
+                                  volume_sigma, roi_file, bool(self.inputs.merged_volume),
+                                  self.inputs.block_mb)
+
+    def _run_numpy(self, runtime):
+        import os
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+        from nibabel.cifti2 import BrainModelAxis
+        from .cifti_io import load_cifti, create_cifti, rows_per_block, flush
+        from .smoothing import apply_operator
+
+        img, data = load_cifti(self.inputs.in_file)
+        axes = (img.header.get_axis(0), img.header.get_axis(1))
+        along = 1 if self.inputs.direction == 'COLUMN' else 0
+        brain_models = axes[along]
+        if not isinstance(brain_models, BrainModelAxis):
+            raise ValueError('{} has no brainordinates along {}'.format(
+                self.inputs.in_file, self.inputs.direction))
+        operator = self._operator(brain_models)
+        zero_missing = np.zeros(len(brain_models), dtype=bool)
+        if self.inputs.fix_zeros_surface:
+            zero_missing |= brain_models.surface_mask
+        if self.inputs.fix_zeros_volume:
+            zero_missing |= brain_models.volume_mask
+
+        out = create_cifti(self._gen_filename('out_file'), axes)
+        if along == 0:
+            data, out = data.T, out.T
+        # blocks of maps, at least one per thread, smoothed in threads
+        # (scipy's sparse products release the GIL)
+        workers = self._num_threads()
+        step = min(rows_per_block(data.shape[1] * 8 * 3 * workers, self.inputs.block_mb),
+                   -(-data.shape[0] // workers))
+
+        def _smooth(start):
+            stop = min(start + step, data.shape[0])
+            block = np.asarray(data[start:stop], dtype=np.float64).T
+            out[start:stop] = apply_operator(operator, block, zero_missing).T
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(_smooth, range(0, data.shape[0], step)))
+        flush(out)
+        return runtime
+
 
     def _gen_filename(self, name):
         import os
@@ -1213,8 +1880,10 @@ class CiftiSmoothing(wb.WBCommand):
 # specifications of suboptions to -var, which can take -select x y -repeat type
 # option. If you want to pass something like that implement a Function interface
 # that takes your input file name as input and returns a string that includes
-# that filename and the subsequent modifiers.
-class CiftiMathInputSpec(CommandLineInputSpec):
+# that filename and the subsequent modifiers, e.g. 'run.dtseries.nii -select 1 5 -repeat'.
+# Both engines understand that form. engine='numpy' compiles the expression once
+# (see mathexpr.py) and evaluates it block by block over memory-mapped inputs.
+class CiftiMathInputSpec(WBEngineInputSpec):
     expression=Str(
         argstr='"%s"',
         position=0,
@@ -1235,6 +1904,9 @@ class CiftiMathInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=2
     )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of inputs to hold at once with engine='numpy'")
 
 class CiftiMathOutputSpec(TraitedSpec):
     out_file=File(
@@ -1242,12 +1914,24 @@ class CiftiMathOutputSpec(TraitedSpec):
         desc="the output cifti file"
     )
 
-class CiftiMath(wb.WBCommand):
+class CiftiMath(WBEngineCommand):
     input_spec = CiftiMathInputSpec
     output_spec = CiftiMathOutputSpec
 
     _cmd = 'wb_command -cifti-math'
 
+    def _run_numpy(self, runtime):
+        from .cifti_io import create_cifti, flush
+        from .mathexpr import Expression, output_shape, evaluate_blocks
+
+        expression = Expression(self.inputs.expression)
+        variables, images = _cifti_math_variables(self.inputs.in_vars)
+        n_maps, _ = output_shape(variables)
+        out = create_cifti(self._gen_filename('out_file'),
+                           _cifti_math_axes(variables, images, n_maps))
+        evaluate_blocks(expression, variables, out, self.inputs.block_mb)
+        flush(out)
+        return runtime
 
     def _gen_filename(self, name):
         import os
@@ -1264,9 +1948,123 @@ class CiftiMath(wb.WBCommand):
         return outputs
 
 
+def _cifti_math_variables(in_vars):
+    # in_vars -> mathexpr.Variable list (and the images they came from)
+    from .cifti_io import load_cifti
+    from .mathexpr import Variable, parse_var, ExpressionError
+
+    variables, images = [], []
+    for name, spec in in_vars:
+        filename, options = parse_var(spec)
+        img, data = load_cifti(filename)
+        map_index = element_index = None
+        if '-select' in options:
+            # dimension 1 runs along a row (maps), dimension 2 along a column
+            dim, index = [int(v) for v in options['-select']]
+            if dim not in [1, 2] or not 1 <= index <= data.shape[dim - 1]:
+                raise ExpressionError('bad -select {} {} for {}'.format(dim, index, filename))
+            if dim == 1:
+                map_index = index - 1
+            else:
+                element_index = index - 1
+        variables.append(Variable(name, data, map_index, element_index, '-repeat' in options))
+        images.append(img)
+    return variables, images
+
+
+def _cifti_math_axes(variables, images, n_maps):
+    # take the mappings from the first variable that has the output's shape
+    for v, img in zip(variables, images):
+        if not v.repeat and v.n_maps == n_maps:
+            map_axis = img.header.get_axis(0)
+            if v.map_index is not None:
+                map_axis = map_axis[v.map_index:v.map_index + 1]
+            break
+    else:
+        map_axis = images[0].header.get_axis(0)[:1]
+    brain_axis = [img.header.get_axis(1) for v, img in zip(variables, images)
+                  if v.element_index is None][0]
+    return map_axis, brain_axis
+
+
+# Runs a chain of CiftiMath steps (e.g. demean -> scale -> threshold -> mask) as one
+# in-process pass without writing the intermediate ciftis. Each step is
+# (expression, result_name) and later steps can use earlier results as variables.
+class CiftiMathChainInputSpec(BaseInterfaceInputSpec):
+    steps=traits.List(
+        traits.Tuple(Str(), Str()),
+        mandatory=True,
+        desc="ordered (expression, result_name) pairs. The last result is written to out_file"
+    )
+    in_vars=traits.List(
+        traits.Tuple(Str(),
+                     traits.Either(File(exists=True),
+                                   Str())),
+        desc='cifti files used as variables, same format as CiftiMath.in_vars',
+        mandatory=True,
+    )
+    out_file=File(
+        desc="the output cifti file. Autogenerated if not specified."
+    )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of inputs to hold at once")
+
+class CiftiMathChainOutputSpec(TraitedSpec):
+    out_file=File(
+        exists=True,
+        desc="the output cifti file"
+    )
+    io_bytes_avoided=traits.Int(
+        desc="bytes of file I/O saved compared to running the steps as separate CiftiMath nodes"
+    )
+
+class CiftiMathChain(BaseInterface):
+    input_spec = CiftiMathChainInputSpec
+    output_spec = CiftiMathChainOutputSpec
+
+    def _run_interface(self, runtime):
+        from .cifti_io import create_cifti, flush
+        from .mathexpr import ExpressionChain, output_shape, evaluate_blocks
+
+        chain = ExpressionChain(self.inputs.steps)
+        variables, images = _cifti_math_variables(self.inputs.in_vars)
+        n_maps, n_elements = output_shape(variables)
+        out = create_cifti(self._gen_filename('out_file'),
+                           _cifti_math_axes(variables, images, n_maps))
+        evaluate_blocks(chain, variables, out, self.inputs.block_mb)
+        flush(out)
+        self._io_bytes_avoided = chain.io_bytes_avoided(variables, n_maps, n_elements)
+        return runtime
+
+    def _gen_filename(self, name):
+        import os
+
+        if name == 'out_file':
+            if not isdefined(self.inputs.out_file):
+                return os.path.join(os.getcwd(), 'cifti_math_results.dscalar.nii')
+            return os.path.abspath(self.inputs.out_file)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        outputs['io_bytes_avoided'] = getattr(self, '_io_bytes_avoided', 0)
+
+        return outputs
+
+
 
-# incomplete: does not support weighted averaging
-class AverageInputSpec(CommandLineInputSpec):
+# Averages ciftis with optional per-file weights.
+# Developer Notes:
+# The numpy engine keeps weighted Welford accumulators (running mean and M2
+# per element plus the total weight) as .npy memmaps, so neither the inputs nor
+# the accumulators have to fit in memory. With state_dir those accumulators
+# persist between runs and inputs already recorded there are skipped, which
+# lets new subjects be folded into an existing average by reading only the new
+# files. exclude_outliers needs the final mean and stdev of every element before
+# it knows which values to drop, so it costs a second read of every recorded
+# file, old ones included.
+class AverageInputSpec(WBEngineInputSpec):
     out_file=File(
         argstr='%s',
         position=0,
@@ -1288,18 +2086,231 @@ class AverageInputSpec(CommandLineInputSpec):
         position=2
     )
 
+    # no argstr, these are added to in_vars by _format_arg()
+    weights=traits.List(traits.Float(),
+        desc='weight of each file in in_vars, in the same order'
+    )
+
+    state_dir=Directory(
+        desc=("directory holding the running sums of a previous average (created if "
+              "missing). Inputs recorded there are skipped and new inputs are added to "
+              "it. Only supported with engine='numpy', which it implies")
+    )
+
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of each input to hold at once with engine='numpy'")
+
 class AverageOutputSpec(TraitedSpec):
     out_file=File(
         exists=True,
         desc="the output cifti file"
     )
 
-class Average(wb.WBCommand):
+    state_dir=Directory(
+        desc="running sums the average was computed from, if state_dir was given"
+    )
+
+    n_files=traits.Int(
+        desc="number of files the average covers (numpy engine only)"
+    )
+
+class _RunningAverage(object):
+    # weighted Welford accumulators for Average, stored brainordinate major
+    # (like the cifti payload) so a brainordinate block is a contiguous slice
+    _VERSION = 1
+
+    def __init__(self, path, img):
+        import os
+        import json
+        import numpy as np
+        from .cifti_io import brain_model_hash
+
+        self.path = path
+        shape = (img.shape[1], img.shape[0])
+        bm_hash = brain_model_hash(img.header.get_axis(1))
+        meta_file = os.path.join(path, 'state.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get('version') != self._VERSION:
+                raise ValueError('{} was written by an incompatible version'.format(path))
+            if not meta['complete']:
+                raise ValueError('{} was left incomplete by an interrupted run, remove it and '
+                                 'average all inputs again'.format(path))
+            if tuple(meta['shape']) != shape or meta['brain_model_hash'] != bm_hash:
+                raise ValueError('{} does not match the maps and brainordinates of {}'.format(
+                    path, img.get_filename()))
+            mode = 'r+'
+        else:
+            os.makedirs(path, exist_ok=True)
+            meta = dict(version=self._VERSION, shape=list(shape), brain_model_hash=bm_hash,
+                        total_weight=0.0, files=[], complete=True)
+            mode = 'w+'
+        self.meta = meta
+        self.bm_hash = bm_hash
+        self.mean = np.lib.format.open_memmap(os.path.join(path, 'mean.npy'), mode=mode,
+                                              dtype=np.float64, shape=shape)
+        self.m2 = np.lib.format.open_memmap(os.path.join(path, 'm2.npy'), mode=mode,
+                                            dtype=np.float64, shape=shape)
+
+    @staticmethod
+    def _file_id(filename):
+        import os
+        stat = os.stat(filename)
+        return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+    def contains(self, filename):
+        file_id = self._file_id(filename)
+        return any(entry['id'] == file_id for entry in self.meta['files'])
+
+    def _save_meta(self):
+        import os
+        import json
+        meta_file = os.path.join(self.path, 'state.json')
+        tmp = '{}.{}.tmp'.format(meta_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, meta_file)
+
+    def begin(self):
+        # mark the state dirty while the memmaps are being updated in place
+        self.meta['complete'] = False
+        self._save_meta()
+
+    def commit(self):
+        self.mean.flush()
+        self.m2.flush()
+        self.meta['complete'] = True
+        self._save_meta()
+
+    def add(self, filename, weight, block_mb):
+        from .cifti_io import load_cifti, brain_model_hash, iter_brainordinate_blocks
+
+        if weight <= 0:
+            raise ValueError('weights must be positive, got {} for {}'.format(weight, filename))
+        img, data = load_cifti(filename)
+        if (data.shape[::-1] != self.mean.shape or
+                brain_model_hash(img.header.get_axis(1)) != self.bm_hash):
+            raise ValueError('{} does not match the maps and brainordinates of {}'.format(
+                filename, self.path))
+        total = self.meta['total_weight'] + weight
+        for start, stop, block in iter_brainordinate_blocks(data, block_mb):
+            block = block.T
+            mean = self.mean[start:stop]
+            delta = block - mean
+            mean += delta * (weight / total)
+            self.m2[start:stop] += weight * delta * (block - mean)
+        self.meta['total_weight'] = total
+        self.meta['files'].append(dict(id=self._file_id(filename), weight=weight))
+
+    def write_mean(self, out, block_mb):
+        from .cifti_io import rows_per_block
+
+        step = rows_per_block(self.mean.shape[1] * 8, block_mb)
+        for start in range(0, self.mean.shape[0], step):
+            out[:, start:start + step] = self.mean[start:start + step].T
+
+    def write_trimmed_mean(self, out, sigma_below, sigma_above, block_mb):
+        # weighted mean of the values within the bounds set by the final moments
+        import os
+        import tempfile
+        import numpy as np
+        from .cifti_io import load_cifti, iter_brainordinate_blocks, rows_per_block
+
+        total = self.meta['total_weight']
+        with tempfile.TemporaryDirectory(dir=self.path) as scratch:
+            sums = np.lib.format.open_memmap(os.path.join(scratch, 'sums.npy'), mode='w+',
+                                             dtype=np.float64, shape=self.mean.shape)
+            kept = np.lib.format.open_memmap(os.path.join(scratch, 'kept.npy'), mode='w+',
+                                             dtype=np.float64, shape=self.mean.shape)
+            for entry in self.meta['files']:
+                filename = entry['id'][0]
+                if not os.path.exists(filename) or self._file_id(filename) != entry['id']:
+                    raise ValueError('{} changed or moved since it was averaged, it is needed '
+                                     'again for exclude_outliers'.format(filename))
+                _, data = load_cifti(filename)
+                for start, stop, block in iter_brainordinate_blocks(data, block_mb):
+                    block = block.T
+                    mean = self.mean[start:stop]
+                    stdev = np.sqrt(np.maximum(self.m2[start:stop], 0) / total)
+                    keep = (block >= mean - sigma_below * stdev) & (block <= mean + sigma_above * stdev)
+                    sums[start:stop] += np.where(keep, entry['weight'] * block, 0)
+                    kept[start:stop] += np.where(keep, entry['weight'], 0)
+
+            step = rows_per_block(self.mean.shape[1] * 8, block_mb)
+            for start in range(0, self.mean.shape[0], step):
+                stop = start + step
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    # elements with every value excluded keep the plain mean
+                    out[:, start:stop] = np.where(kept[start:stop] > 0,
+                                                  sums[start:stop] / kept[start:stop],
+                                                  self.mean[start:stop]).T
+            del sums, kept
+
+class Average(WBEngineCommand):
     input_spec = AverageInputSpec
     output_spec = AverageOutputSpec
 
     _cmd = 'wb_command -cifti-average'
 
+    def _use_numpy(self):
+        return super()._use_numpy() or isdefined(self.inputs.state_dir)
+
+    def _weights(self):
+        if not isdefined(self.inputs.weights):
+            return [1.0] * len(self.inputs.in_vars)
+        if len(self.inputs.weights) != len(self.inputs.in_vars):
+            raise ValueError('weights must have one entry per file in in_vars')
+        return list(self.inputs.weights)
+
+    def _format_arg(self, name, spec, value):
+        if name == 'in_vars' and isdefined(self.inputs.weights):
+            return ' '.join('-cifti {} -weight {:f}'.format(f, w)
+                            for f, w in zip(value, self._weights()))
+        return super(Average, self)._format_arg(name, spec, value)
+
+    def _run_numpy(self, runtime):
+        import os
+        import tempfile
+        from .cifti_io import load_cifti, create_cifti, flush
+
+        exclude = None
+        if isdefined(self.inputs.exclude_outliers) and self.inputs.exclude_outliers:
+            if len(self.inputs.exclude_outliers) > 1:
+                raise ValueError('exclude_outliers takes a single (sigma-below, sigma-above) pair')
+            exclude = self.inputs.exclude_outliers[0]
+
+        img, _ = load_cifti(self.inputs.in_vars[0])
+        scratch = None
+        if isdefined(self.inputs.state_dir):
+            state_path = os.path.abspath(self.inputs.state_dir)
+        else:
+            scratch = tempfile.TemporaryDirectory(dir=os.getcwd())
+            state_path = scratch.name
+        try:
+            state = _RunningAverage(state_path, img)
+            new = [(f, w) for f, w in zip(self.inputs.in_vars, self._weights())
+                   if not state.contains(f)]
+            if new:
+                state.begin()
+                for filename, weight in new:
+                    state.add(filename, weight, self.inputs.block_mb)
+                state.commit()
+
+            out = create_cifti(self._gen_filename('out_file'),
+                               (img.header.get_axis(0), img.header.get_axis(1)))
+            if exclude is None:
+                state.write_mean(out, self.inputs.block_mb)
+            else:
+                state.write_trimmed_mean(out, exclude[0], exclude[1], self.inputs.block_mb)
+            flush(out)
+            self._n_files = len(state.meta['files'])
+            del out, state
+        finally:
+            if scratch is not None:
+                scratch.cleanup()
+        return runtime
 
     def _gen_filename(self, name):
         import os
@@ -1310,7 +2321,13 @@ class Average(wb.WBCommand):
             return self.inputs.out_file
 
     def _list_outputs(self):
+        import os
+
         outputs = self.output_spec().get()
         outputs['out_file'] = self._gen_filename('out_file')
+        if isdefined(self.inputs.state_dir):
+            outputs['state_dir'] = os.path.abspath(self.inputs.state_dir)
+        if hasattr(self, '_n_files'):
+            outputs['n_files'] = self._n_files
 
         return outputs
\ No newline at end of file
@@ -0,0 +1,227 @@
+# nibabel helpers for the in-process engines.
+# Developer Notes:
+# nibabel presents cifti data as a (maps, brainordinates) array, i.e. the
+# transpose of the rows/columns convention wb_command uses in its help text.
+# A wb_command "column" is therefore a row of the arrays returned here.
+
+import numpy as np
+import nibabel as nib
+
+
+def load_cifti(filename):
+    """
+    Open a cifti file without reading its payload.
+
+    Returns the image and a (maps, brainordinates) array. For uncompressed
+    files the array is a read-only memmap, so slicing it only reads what is
+    needed.
+    """
+    img = nib.load(filename, mmap='r')
+    if not isinstance(img, nib.Cifti2Image):
+        raise ValueError('{} is not a cifti file'.format(filename))
+    data = np.asanyarray(img.dataobj)
+    return img, data.reshape(img.shape)
+
+
+def rows_per_block(row_nbytes, block_mb):
+    """Number of rows of ``row_nbytes`` each that fit in ``block_mb`` megabytes."""
+    return max(1, int(block_mb * 2 ** 20 // max(row_nbytes, 1)))
+
+
+def iter_map_blocks(data, block_mb=256):
+    """
+    Yield ``(start, stop, block)`` over the maps of a (maps, brainordinates)
+    array, where ``block`` is a float64 copy of ``data[start:stop]`` no larger
+    than roughly ``block_mb`` megabytes.
+    """
+    step = rows_per_block(data.shape[1] * 8, block_mb)
+    for start in range(0, data.shape[0], step):
+        stop = min(start + step, data.shape[0])
+        yield start, stop, np.asarray(data[start:stop], dtype=np.float64)
+
+
+def label_table(img, map_index=0):
+    """{key: name} for one map of a dlabel image."""
+    axis = img.header.get_axis(0)
+    if not hasattr(axis, 'label'):
+        raise ValueError('{} is not a dlabel file'.format(img.get_filename()))
+    return {int(key): name for key, (name, _) in axis.label[map_index].items()}
+
+
+def brain_model_hash(axis):
+    """Hash of the brainordinates described by a BrainModelAxis."""
+    import hashlib
+
+    digest = hashlib.sha256()
+    digest.update(np.asarray(axis.name).astype(str).tobytes())
+    digest.update(np.ascontiguousarray(axis.vertex).tobytes())
+    digest.update(np.ascontiguousarray(axis.voxel).tobytes())
+    return digest.hexdigest()
+
+
+def parcel_index(filename, map_index=0):
+    """
+    Brainordinate to parcel mapping for one map of a dlabel file.
+
+    Every key other than 0 (unlabeled) that is used by at least one
+    brainordinate becomes a parcel, in ascending key order. The mapping is
+    stored in CSC layout: the brainordinates of parcel j are
+    ``indices[indptr[j]:indptr[j + 1]]``. Entries are cached by the dlabel's
+    content hash, so a fixed atlas is only parsed once.
+
+    Returns a dict with ``indices``, ``indptr``, ``keys``, ``names``,
+    ``n_brainordinates`` and ``brain_model_hash``.
+    """
+    from . import cache
+
+    def _build():
+        img, data = load_cifti(filename)
+        table = label_table(img, map_index)
+        labels = np.rint(np.asarray(data[map_index])).astype(np.int64)
+        keys = np.array([k for k in np.unique(labels) if k != 0], dtype=np.int64)
+        indices = np.flatnonzero(np.isin(labels, keys))
+        # stable sort keeps brainordinates in file order within each parcel
+        indices = indices[np.argsort(labels[indices], kind='stable')]
+        counts = np.bincount(np.searchsorted(keys, labels[indices]), minlength=len(keys))
+        return dict(
+            indices=indices,
+            indptr=np.concatenate([[0], np.cumsum(counts)]),
+            keys=keys,
+            names=np.array([table.get(int(k), str(k)) for k in keys], dtype=str),
+            n_brainordinates=labels.size,
+            brain_model_hash=brain_model_hash(img.header.get_axis(1)),
+        )
+
+    key = cache.hash_key('parcel-index-v1', cache.file_hash(filename), map_index)
+    return cache.load_or_build('parcel_index', key, _build)
+
+
+def label_indicator(filename, map_index=0):
+    """
+    Sparse (brainordinates, parcels) 0/1 matrix for one map of a dlabel file,
+    see parcel_index(). Returns the matrix, the keys and the label names.
+    """
+    from scipy import sparse
+
+    index = parcel_index(filename, map_index)
+    indicator = sparse.csc_matrix(
+        (np.ones(len(index['indices'])), index['indices'], index['indptr']),
+        shape=(int(index['n_brainordinates']), len(index['keys'])))
+    return indicator, index['keys'], [str(name) for name in index['names']]
+
+
+def roi_indicator(filenames):
+    """
+    Sparse (brainordinates, rois) 0/1 matrix from a list of single-map roi
+    files. Brainordinates with a value greater than zero are in the roi.
+    """
+    from scipy import sparse
+
+    columns = []
+    for filename in filenames:
+        _, roi = load_cifti(filename)
+        if columns and roi.shape[1] != columns[0].shape[0]:
+            raise ValueError('{} does not match the brainordinates of {}'.format(
+                filename, filenames[0]))
+        columns.append(sparse.csc_matrix((np.asarray(roi[0]) > 0).astype(np.float64)[:, None]))
+    return sparse.hstack(columns, format='csc')
+
+
+def parcels_axis(index, brain_models):
+    """ParcelsAxis for a parcel_index() entry over the given BrainModelAxis."""
+    from nibabel.cifti2 import ParcelsAxis
+
+    indptr = index['indptr']
+    return ParcelsAxis.from_brain_models(
+        [(str(name), brain_models[index['indices'][indptr[j]:indptr[j + 1]]])
+         for j, name in enumerate(index['names'])])
+
+
+_INTENTS = {
+    ('SeriesAxis', 'BrainModelAxis'): 'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES',
+    ('ScalarAxis', 'BrainModelAxis'): 'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS',
+    ('LabelAxis', 'BrainModelAxis'): 'NIFTI_INTENT_CONNECTIVITY_DENSE_LABELS',
+    ('SeriesAxis', 'ParcelsAxis'): 'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SERIES',
+    ('ScalarAxis', 'ParcelsAxis'): 'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SCALAR',
+}
+
+
+def _cifti_image(dataobj, axes):
+    img = nib.Cifti2Image(dataobj, header=axes)
+    # wb_command keys the file type off the intent, nibabel leaves it unknown
+    intent = _INTENTS.get(tuple(type(ax).__name__ for ax in axes))
+    if intent is not None:
+        img.nifti_header.set_intent(intent)
+    return img
+
+
+def save_cifti(data, axes, filename):
+    """Write a (maps, brainordinates/parcels) array as float32 cifti."""
+    nib.save(_cifti_image(np.asarray(data, dtype=np.float32), axes), filename)
+
+
+def mapping_xml(axis, dimension):
+    """XML (bytes) of the MatrixIndicesMap of ``axis`` as cifti dimension ``dimension``."""
+    return axis.to_mapping(dimension).to_xml()
+
+
+def create_cifti(filename, axes, dtype=np.float32):
+    """
+    Preallocate a cifti file for ``axes`` and return a writable memmap of its
+    (maps, brainordinates) payload. Nothing but the header is held in memory;
+    flush the memmap (or drop it) when done writing.
+    """
+    intent = _INTENTS.get(tuple(type(ax).__name__ for ax in axes),
+                          'NIFTI_INTENT_CONNECTIVITY_UNKNOWN')
+    return create_cifti_xml(filename, [mapping_xml(ax, i) for i, ax in enumerate(axes)],
+                            tuple(len(ax) for ax in axes), intent, dtype)
+
+
+def create_cifti_xml(filename, mappings, shape, intent, dtype=np.float32):
+    """
+    create_cifti() from already serialized MatrixIndicesMaps (see
+    mapping_xml), e.g. ones cached with a template, so no axis has to be
+    parsed or built again. ``shape`` is the length of each mapping.
+    """
+    from nibabel.nifti1 import Nifti1Extension
+
+    xml = b''.join([b'<CIFTI Version="2"><Matrix>'] + list(mappings) + [b'</Matrix></CIFTI>'])
+    header = nib.Nifti2Header()
+    header.set_data_shape((1, 1, 1, 1) + tuple(shape))
+    header.set_data_dtype(dtype)
+    header.set_intent(intent)
+    # there is no qform, so the spatial pixdims are reset as nibabel does
+    header['pixdim'][:4] = 1
+    # 32 is the cifti extension code, nibabel recognizes it when reading
+    header.extensions.append(Nifti1Extension(32, xml))
+    header['vox_offset'] = 0
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        offset = header.get_data_offset()
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    # nifti is column major, i.e. all maps of a brainordinate are contiguous
+    out = np.memmap(filename, dtype=header.get_data_dtype(), mode='r+',
+                    offset=offset, shape=tuple(shape)[::-1])
+    return out.T
+
+
+def iter_brainordinate_blocks(data, block_mb=256):
+    """
+    Yield ``(start, stop, block)`` over the brainordinates of a (maps,
+    brainordinates) array, where ``block`` is a float64 copy of
+    ``data[:, start:stop]``. Cifti stores all maps of a brainordinate next to
+    each other, so each block is a contiguous read of the file.
+    """
+    step = rows_per_block(data.shape[0] * 8, block_mb)
+    for start in range(0, data.shape[1], step):
+        stop = min(start + step, data.shape[1])
+        yield start, stop, np.asarray(data[:, start:stop], dtype=np.float64)
+
+
+def flush(array):
+    """Flush the memmap an array is a view of, if any."""
+    while array is not None:
+        if isinstance(array, np.memmap):
+            array.flush()
+            return
+        array = getattr(array, 'base', None)
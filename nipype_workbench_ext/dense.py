@@ -0,0 +1,181 @@
+# Streaming assembly of dense cifti files from metrics/labels and volumes, as
+# wb_command -cifti-create-dense-timeseries/-scalar and -cifti-create-label do.
+# Developer Notes:
+# Which brainordinates a dense file has only depends on the surface rois
+# (vertices with roi > 0, every vertex without a roi) and the structure label
+# volume (voxels with a non-zero key, named by the key's label). That index
+# is worked out once per roi/label set and cached. The payload is then copied
+# in blocks of maps straight from the inputs into a preallocated cifti (NIfTI-2)
+# output, so no more than a block of the output is ever held. Gifti inputs are
+# base64 encoded and always read whole, the volume is memory-mapped.
+# Surfaces come first and volume structures follow in the order of
+# cifti._valid_cifti_structs, each as one block of voxels in nifti order (i
+# fastest), however many keys of the label volume name it. Keys whose label
+# is not a structure name are left out.
+
+import numpy as np
+
+_SURFACES = ('CORTEX_LEFT', 'CORTEX_RIGHT')
+
+
+def _cifti_name(name):
+    return name if name.startswith('CIFTI_STRUCTURE_') else 'CIFTI_STRUCTURE_' + name
+
+
+def dense_index(surfaces, label_volume=None):
+    """
+    Cached brainordinates of a dense file. ``surfaces`` maps structure names
+    (e.g. 'CORTEX_LEFT') to (number of vertices, roi metric file or None).
+    Returns a dict of arrays: the structure ``names`` and ``vertex`` of every
+    brainordinate, the ``flat`` (nifti order) voxel index of every volume
+    brainordinate, ``ijk``, and the volume ``affine`` and ``shape``.
+    """
+    from . import cache
+    from .cifti import _valid_cifti_structs
+    from .gifti_io import load_metric
+    from .volume_io import label_table
+
+    def _hash(filename):
+        return None if filename is None else cache.file_hash(filename)
+
+    structures = [s for s in _SURFACES if s in surfaces] + \
+        sorted(set(surfaces) - set(_SURFACES))
+
+    def _build():
+        import nibabel as nib
+
+        names, vertex, n_vertices = [], [], []
+        for structure in structures:
+            count, roi_file = surfaces[structure]
+            keep = np.arange(count)
+            if roi_file is not None:
+                roi = load_metric(roi_file)[1][0]
+                if len(roi) != count:
+                    raise ValueError('{} does not match the vertices of the {} data'.format(
+                        roi_file, structure))
+                keep = np.flatnonzero(roi > 0)
+            names += [_cifti_name(structure)] * len(keep)
+            vertex.append(keep)
+            n_vertices.append(count)
+        entry = dict(surface_structures=np.array([_cifti_name(s) for s in structures], dtype=str),
+                     n_vertices=np.array(n_vertices, dtype=np.int64),
+                     flat=np.zeros(0, dtype=np.int64), ijk=np.zeros((0, 3), dtype=np.int64),
+                     affine=np.eye(4), shape=np.zeros(3, dtype=np.int64))
+        if label_volume is not None:
+            img = nib.load(label_volume)
+            keys = np.asarray(img.dataobj).reshape(img.shape[:3] + (-1,))[..., 0]
+            keys = np.rint(keys).astype(np.int64).ravel(order='F')
+            table = label_table(img)
+            by_structure = dict()
+            for key in (k for k in np.unique(keys) if k != 0):
+                if key not in table:
+                    raise ValueError('key {} of {} is not in its label table'.format(
+                        key, label_volume))
+                structure = _cifti_name(table[key][0])[len('CIFTI_STRUCTURE_'):]
+                if structure in _valid_cifti_structs:
+                    by_structure.setdefault(structure, []).append(key)
+            flat = []
+            for structure in sorted(by_structure, key=_valid_cifti_structs.index):
+                voxels = np.flatnonzero(np.isin(keys, by_structure[structure]))
+                names += [_cifti_name(structure)] * len(voxels)
+                vertex.append(np.full(len(voxels), -1))
+                flat.append(voxels)
+            flat = np.concatenate(flat) if flat else np.zeros(0, dtype=np.int64)
+            entry.update(flat=flat,
+                         ijk=np.stack(np.unravel_index(flat, img.shape[:3], order='F'), axis=1),
+                         affine=img.affine, shape=np.array(img.shape[:3]))
+        entry['names'] = np.array(names)
+        entry['vertex'] = np.concatenate(vertex) if vertex else np.zeros(0, dtype=np.int64)
+        return entry
+
+    key = cache.hash_key('dense-index-v2', tuple((s, int(surfaces[s][0]), _hash(surfaces[s][1]))
+                                                 for s in structures), _hash(label_volume))
+    return cache.load_or_build('dense_index', key, _build)
+
+
+def brain_model_axis(index):
+    """The BrainModelAxis of a dense_index()."""
+    from nibabel.cifti2 import cifti2_axes
+
+    names = np.asarray(index['names']).astype(str)
+    voxel = np.full((len(names), 3), -1, dtype=np.int64)
+    voxel[len(names) - len(index['flat']):] = index['ijk']
+    surfaces = np.asarray(index['surface_structures']).astype(str)
+    nvertices = {s: int(n) for s, n in zip(surfaces, index['n_vertices'])}
+    volume = len(index['flat']) > 0
+    return cifti2_axes.BrainModelAxis(
+        names, voxel=voxel, vertex=np.asarray(index['vertex']),
+        affine=np.asarray(index['affine']) if volume else None,
+        volume_shape=tuple(int(s) for s in index['shape']) if volume else None,
+        nvertices=nvertices)
+
+
+def create_dense(kind, out_file, surface_files, volume_file=None, label_volume=None,
+                 block_mb=256):
+    """
+    Write a dense cifti of ``kind`` 'dtseries', 'dscalar' or 'dlabel'.
+
+    ``surface_files`` maps structure names to (metric or label file, roi file
+    or None). ``volume_file`` holds the data of every volume structure
+    defined by the structure ``label_volume``.
+    """
+    from nibabel.cifti2 import cifti2_axes
+    from .cifti_io import create_cifti, rows_per_block, flush
+    from .gifti_io import load_metric, column_names
+    from .volume_io import load_volume, label_table
+
+    data = {structure: load_metric(filename)
+            for structure, (filename, _) in surface_files.items()}
+    index = dense_index({s: (data[s][1].shape[1], roi) for s, (_, roi) in surface_files.items()},
+                        label_volume)
+    volume = None
+    if volume_file is not None:
+        volume_img, volume = load_volume(volume_file)
+        if tuple(volume_img.shape[:3]) != tuple(index['shape']):
+            raise ValueError('{} does not match the dimensions of {}'.format(volume_file,
+                                                                             label_volume))
+    counts = {d.shape[0] for _, d in data.values()} | ({volume.shape[0]} if volume is not None
+                                                      else set())
+    if len(counts) != 1:
+        raise ValueError('the inputs do not have the same number of maps')
+    n_maps = counts.pop()
+
+    brain_models = brain_model_axis(index)
+    first = next(iter(data.values()))[0] if data else None
+    if kind == 'dtseries':
+        map_axis = cifti2_axes.SeriesAxis(0, 1, n_maps, 'SECOND')
+    elif kind == 'dscalar':
+        names = column_names(first) if first is not None else [''] * n_maps
+        map_axis = cifti2_axes.ScalarAxis(names)
+    else:
+        table = dict()
+        sources = [img.labeltable for img, _ in data.values()]
+        for labeltable in sources:
+            for label in labeltable.labels:
+                table[int(label.key)] = (label.label, tuple(label.rgba))
+        if volume is not None:
+            table.update(label_table(volume_img))
+        names = column_names(first) if first is not None else [''] * n_maps
+        map_axis = cifti2_axes.LabelAxis(names, [table] * n_maps)
+
+    out = create_cifti(out_file, (map_axis, brain_models))
+    # positions of every input's brainordinates in the output
+    vertex = np.asarray(index['vertex'])
+    names = np.asarray(index['names']).astype(str)
+    parts = []
+    for structure in surface_files:
+        mask = names == _cifti_name(structure)
+        parts.append((np.flatnonzero(mask), data[structure][1], vertex[mask]))
+    if volume is not None:
+        flat = np.asarray(index['flat'])
+        parts.append((np.arange(len(names) - len(flat), len(names)), volume, flat))
+
+    step = rows_per_block(len(brain_models) * 4, block_mb)
+    for start in range(0, n_maps, step):
+        stop = min(start + step, n_maps)
+        block = np.empty((stop - start, len(brain_models)), dtype=np.float32)
+        for columns, source, rows in parts:
+            block[:, columns] = source[start:stop][:, rows]
+        out[start:stop] = block
+    flush(out)
+    del out
@@ -0,0 +1,199 @@
+# Export of cifti data to text and to binary/columnar formats.
+# Developer Notes:
+# wb_command -cifti-convert -to-text writes one line per brainordinate with
+# its maps separated by tabs. For a dtseries that is gigabytes of text which is
+# slow to write and slower to parse. export_cifti() writes the same
+# (brainordinates, maps) matrix in blocks of brainordinates, which are
+# contiguous in the cifti file, to:
+#   text     the -to-text layout, formatted in parallel
+#   npy      a float array any numpy can memory-map
+#   parquet  one float column per map, a row group per block (pyarrow)
+#   arrow    the same as an Arrow IPC (feather v2) file (pyarrow)
+#   hdf5     a 'data' dataset with the given chunks/compression (h5py)
+#   zarr     an array with the given chunks/compression (zarr)
+# pyarrow, h5py and zarr are optional and only imported by their writer.
+# Formatting numbers holds the GIL, so text blocks are formatted in worker
+# processes and written in order; the other writers are limited by I/O. Text
+# values have 9 significant digits, enough to read back the same float32.
+# Map names (or map_<n> where they are empty or repeated) become column names
+# and the 'map_names' attribute of hdf5/zarr outputs.
+
+import os
+
+import numpy as np
+
+FORMATS = {
+    'text': '.txt',
+    'npy': '.npy',
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'hdf5': '.h5',
+    'zarr': '.zarr',
+}
+
+
+def _map_names(img):
+    names = [str(n) for n in getattr(img.header.get_axis(0), 'name', [])]
+    if len(names) != img.shape[0] or '' in names or len(set(names)) != len(names):
+        names = ['map_{}'.format(i + 1) for i in range(img.shape[0])]
+    return names
+
+
+def _blocks(data, block_mb, step=None):
+    # (start, stop, (brainordinates, maps) block) over the brainordinates
+    from .cifti_io import rows_per_block
+
+    step = step or rows_per_block(data.shape[0] * data.dtype.itemsize, block_mb)
+    for start in range(0, data.shape[1], step):
+        stop = min(start + step, data.shape[1])
+        yield start, stop, np.asarray(data[:, start:stop]).T
+
+
+def _format_block(block, col_delim):
+    line = col_delim.join(['%.9g'] * block.shape[1]) + '\n'
+    return ((line * block.shape[0]) % tuple(block.ravel().tolist())).encode()
+
+
+def _format_rows(payload, start, stop, col_delim):
+    # runs in a worker process. The payload is mapped directly, parsing the
+    # cifti header again in every worker would cost more than the formatting
+    filename, offset, dtype, shape = payload
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape[::-1]).T
+    return _format_block(np.asarray(data[:, start:stop]).T, col_delim)
+
+
+def _write_text(img, out_file, data, col_delim, block_mb, n_workers):
+    from concurrent.futures import ProcessPoolExecutor
+    from .cifti_io import rows_per_block
+
+    # about 16 characters per value, and 2 blocks per worker in flight
+    step = rows_per_block(data.shape[0] * 16, block_mb / (2 * n_workers))
+    ranges = [(start, min(start + step, data.shape[1]))
+              for start in range(0, data.shape[1], step)]
+    dataobj = img.dataobj
+    # compressed or scaled payloads cannot be mapped by the workers
+    mapped = isinstance(data, np.memmap) and getattr(dataobj, 'slope', 1.0) == 1.0 and \
+        getattr(dataobj, 'inter', 0.0) == 0.0
+    with open(out_file, 'wb') as f:
+        if n_workers == 1 or len(ranges) == 1 or not mapped:
+            for start, stop, block in _blocks(data, block_mb, step):
+                f.write(_format_block(block, col_delim))
+            return
+        payload = (os.path.abspath(img.get_filename()), dataobj.offset,
+                   np.dtype(dataobj.dtype).str, data.shape)
+        with ProcessPoolExecutor(min(n_workers, len(ranges))) as pool:
+            pending = []
+            for start, stop in ranges:
+                pending.append(pool.submit(_format_rows, payload, start, stop, col_delim))
+                if len(pending) >= 2 * n_workers:
+                    f.write(pending.pop(0).result())
+            for future in pending:
+                f.write(future.result())
+
+
+def _write_npy(out_file, data, block_mb):
+    out = np.lib.format.open_memmap(out_file, mode='w+', dtype=data.dtype,
+                                    shape=data.shape[::-1])
+    for start, stop, block in _blocks(data, block_mb):
+        out[start:stop] = block
+    out.flush()
+    del out
+
+
+def _write_arrow(out_file, data, names, out_format, compression, block_rows, block_mb):
+    import pyarrow as pa
+
+    schema = pa.schema([(name, pa.from_numpy_dtype(data.dtype)) for name in names])
+    if out_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(out_file, schema, compression=compression or 'snappy')
+        write = writer.write_table
+        table = pa.Table.from_arrays
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        writer = pa.ipc.new_file(out_file, schema, options=options)
+        write = writer.write_batch
+        table = pa.RecordBatch.from_arrays
+    with writer:
+        for _, _, block in _blocks(data, block_mb, block_rows):
+            write(table([pa.array(np.ascontiguousarray(block[:, j]))
+                         for j in range(block.shape[1])], schema=schema))
+
+
+def _write_hdf5(out_file, data, names, chunks, compression, block_mb):
+    import h5py
+
+    with h5py.File(out_file, 'w') as f:
+        out = f.create_dataset('data', shape=data.shape[::-1], dtype=data.dtype,
+                               chunks=chunks or (True if compression else None),
+                               compression=compression)
+        out.attrs['map_names'] = names
+        for start, stop, block in _blocks(data, block_mb):
+            out[start:stop] = block
+
+
+def _zarr_codec(zarr, compression):
+    # a numcodecs codec for zarr 2, a zarr.codecs codec for zarr 3
+    if int(zarr.__version__.split('.')[0]) < 3:
+        import numcodecs
+
+        return numcodecs.get_codec(dict(id=compression))
+    import zarr.codecs
+
+    codecs = dict(zstd=zarr.codecs.ZstdCodec, gzip=zarr.codecs.GzipCodec,
+                  blosc=zarr.codecs.BloscCodec)
+    if compression not in codecs:
+        raise ValueError('unknown zarr compression {}, use one of {}'.format(
+            compression, sorted(codecs)))
+    return codecs[compression]()
+
+
+def _write_zarr(out_file, data, names, chunks, compression, block_mb):
+    import zarr
+
+    kwargs = dict(chunks=chunks) if chunks else dict()
+    if int(zarr.__version__.split('.')[0]) < 3:
+        if compression:
+            kwargs['compressor'] = _zarr_codec(zarr, compression)
+        out = zarr.open_array(out_file, mode='w', shape=data.shape[::-1], dtype=data.dtype,
+                              **kwargs)
+    else:
+        if compression:
+            kwargs['compressors'] = [_zarr_codec(zarr, compression)]
+        out = zarr.create_array(out_file, shape=data.shape[::-1], dtype=data.dtype,
+                                overwrite=True, **kwargs)
+    out.attrs['map_names'] = names
+    for start, stop, block in _blocks(data, block_mb):
+        out[start:stop] = block
+
+
+def export_cifti(in_file, out_file, out_format='text', chunks=None, compression=None,
+                 col_delim='\t', block_mb=256, n_workers=1):
+    """
+    Write the (brainordinates, maps) matrix of ``in_file`` to ``out_file``
+    as ``out_format`` (see FORMATS). ``chunks`` is the (brainordinates, maps)
+    chunk shape of hdf5 and zarr outputs; for parquet/arrow its first entry
+    is the number of brainordinates per row group/record batch.
+    ``compression`` names a codec of the writing library (e.g. 'gzip' for
+    hdf5, 'zstd' for parquet/arrow/zarr); without it the library's default
+    is used. Text uses ``n_workers`` processes.
+    """
+    from .cifti_io import load_cifti
+
+    if out_format not in FORMATS:
+        raise ValueError('unknown export format {}, use one of {}'.format(
+            out_format, sorted(FORMATS)))
+    img, data = load_cifti(in_file)
+    chunks = tuple(int(c) for c in chunks) if chunks else None
+    if out_format == 'text':
+        _write_text(img, out_file, data, col_delim, block_mb, max(int(n_workers), 1))
+    elif out_format == 'npy':
+        _write_npy(out_file, data, block_mb)
+    elif out_format in ('parquet', 'arrow'):
+        _write_arrow(out_file, data, _map_names(img), out_format, compression,
+                     chunks[0] if chunks else None, block_mb)
+    elif out_format == 'hdf5':
+        _write_hdf5(out_file, data, _map_names(img), chunks, compression, block_mb)
+    else:
+        _write_zarr(out_file, data, _map_names(img), chunks, compression, block_mb)
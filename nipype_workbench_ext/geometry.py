@@ -0,0 +1,105 @@
+# Decoded surface geometry shared by the in-process surface engines.
+# Developer Notes:
+# Gifti surfaces are base64/gzip encoded, so every wb_command call that takes a
+# surface decodes it again. Template meshes (fsLR 32k/164k) are used by every
+# subject in a study, so the decoded arrays, the vertex adjacency and the
+# vertex areas are stored once per surface content in the cache, as .npy files
+# that are memory mapped on load. Anything derived purely from a surface's
+# geometry should come from here rather than from gifti_io.load_surface().
+
+import numpy as np
+
+
+def triangle_areas(coords, triangles):
+    """Area of each triangle."""
+    coords = np.asarray(coords, dtype=np.float64)
+    a, b, c = (coords[triangles[:, i]] for i in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1)
+
+
+def vertex_areas(coords, triangles):
+    """Area of each vertex: a third of the area of every triangle that uses it."""
+    return np.bincount(np.ravel(triangles),
+                       weights=np.repeat(triangle_areas(coords, triangles) / 3, 3),
+                       minlength=len(coords))
+
+
+def vertex_mean(values, triangles, n_vertices):
+    """Average of per-triangle ``values`` over the triangles around each vertex."""
+    counts = np.bincount(np.ravel(triangles), minlength=n_vertices)
+    total = np.bincount(np.ravel(triangles), weights=np.repeat(values, 3), minlength=n_vertices)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / counts
+
+
+def local_affine_stretches(reference, distorted, triangles):
+    """
+    Singular values (largest first) of the 2D affine taking each triangle of
+    the ``reference`` coordinates onto the same triangle of ``distorted``,
+    each expressed in its own plane. Returns a (triangles, 2) array.
+    """
+    def _planar(coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        e1 = coords[triangles[:, 1]] - coords[triangles[:, 0]]
+        e2 = coords[triangles[:, 2]] - coords[triangles[:, 0]]
+        u = e1 / np.linalg.norm(e1, axis=1, keepdims=True)
+        v = e2 - np.einsum('ij,ij->i', e2, u)[:, None] * u
+        v /= np.linalg.norm(v, axis=1, keepdims=True)
+        # columns are the two edges in the triangle's (u, v) frame
+        return np.stack([np.stack([np.einsum('ij,ij->i', e1, u), np.einsum('ij,ij->i', e2, u)], -1),
+                         np.stack([np.einsum('ij,ij->i', e1, v), np.einsum('ij,ij->i', e2, v)], -1)],
+                        axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        affine = _planar(distorted) @ np.linalg.inv(_planar(reference))
+    return np.linalg.svd(affine, compute_uv=False)
+
+
+def vertex_adjacency(n_vertices, triangles):
+    """(indptr, indices) of the sorted neighbours of every vertex, as int32 CSR."""
+    u = triangles.ravel().astype(np.int64)
+    v = triangles[:, [1, 2, 0]].ravel().astype(np.int64)
+    edges = np.unique(np.concatenate([u * n_vertices + v, v * n_vertices + u]))
+    rows, cols = np.divmod(edges, n_vertices)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_vertices))])
+    return indptr.astype(np.int32), cols.astype(np.int32)
+
+
+def load_geometry(filename, use_disk=True):
+    """
+    Geometry of a .surf.gii, cached by content hash. Returns a dict of
+    read-only arrays: ``coords`` (float32, (vertices, 3)), ``triangles``
+    (int32, (triangles, 3)), ``adjacency_indptr``/``adjacency_indices``
+    (int32 CSR, see vertex_adjacency()) and ``areas`` (float64, see
+    vertex_areas()). Without ``use_disk`` the entry is only kept in memory,
+    for surfaces that are not reused across runs.
+    """
+    from . import cache
+    from .gifti_io import load_surface
+
+    def _build():
+        coords, triangles = load_surface(filename)
+        indptr, indices = vertex_adjacency(len(coords), triangles)
+        return dict(coords=coords.astype(np.float32), triangles=triangles.astype(np.int32),
+                    adjacency_indptr=indptr, adjacency_indices=indices,
+                    areas=vertex_areas(coords, triangles))
+
+    key = cache.hash_key('surface-geometry-v1', cache.file_hash(filename))
+    return cache.load_or_build('surface_geometry', key, _build, use_disk=use_disk, mmap=True)
+
+
+def adjacency_matrix(geometry):
+    """Sparse (vertices, vertices) 0/1 matrix of a load_geometry() entry's edges."""
+    from scipy import sparse
+
+    n = len(geometry['coords'])
+    indices = geometry['adjacency_indices']
+    return sparse.csr_matrix((np.ones(len(indices)), indices, geometry['adjacency_indptr']),
+                             shape=(n, n))
+
+
+def edges(geometry):
+    """(first, second) vertex of every directed edge of a load_geometry() entry."""
+    indptr = np.asarray(geometry['adjacency_indptr'])
+    first = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return first, np.asarray(geometry['adjacency_indices'])
@@ -0,0 +1,84 @@
+# nibabel helpers for gifti metric/label files used by the in-process engines.
+# Developer Notes:
+# Metrics are handled as (columns, vertices) arrays to match the
+# (maps, brainordinates) convention of cifti_io. Gifti payloads are base64
+# encoded so, unlike cifti, they are always read fully into memory.
+
+import numpy as np
+import nibabel as nib
+
+
+def load_metric(filename):
+    """Return the gifti image and its data as a (columns, vertices) float array."""
+    img = nib.load(filename)
+    if not img.darrays:
+        raise ValueError('{} has no data arrays'.format(filename))
+    return img, np.vstack([np.asarray(d.data).reshape(1, -1) for d in img.darrays])
+
+
+def column_names(img):
+    return [d.meta.get('Name', '') for d in img.darrays]
+
+
+def save_metric(data, filename, template=None, names=None, meta=None):
+    """
+    Write a (columns, vertices) array as a float32 metric. File metadata
+    (e.g. AnatomicalStructurePrimary) is copied from ``template`` if given,
+    otherwise taken from the ``meta`` dict.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+    if names is None:
+        names = [''] * data.shape[0]
+    if template is not None:
+        meta = dict(template.meta)
+    meta = nib.gifti.GiftiMetaData(meta) if meta is not None else None
+    darrays = [nib.gifti.GiftiDataArray(row, intent='NIFTI_INTENT_NONE',
+                                        datatype='NIFTI_TYPE_FLOAT32',
+                                        meta=nib.gifti.GiftiMetaData({'Name': name}))
+               for row, name in zip(data, names)]
+    nib.save(nib.gifti.GiftiImage(meta=meta, darrays=darrays), filename)
+
+
+def load_surface(filename):
+    """Return the float64 (vertices, 3) coordinates and int (triangles, 3) faces of a surface."""
+    img = nib.load(filename)
+    coords = img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')
+    triangles = img.get_arrays_from_intent('NIFTI_INTENT_TRIANGLE')
+    if not coords or not triangles:
+        raise ValueError('{} is not a surface file'.format(filename))
+    return (np.asarray(coords[0].data, dtype=np.float64),
+            np.asarray(triangles[0].data, dtype=np.int64))
+
+
+
+def structure_meta(img):
+    """
+    The AnatomicalStructure* entries of a gifti image, from the file metadata
+    or, as surfaces usually carry them, from the first data array.
+    """
+    for meta in [img.meta] + [d.meta for d in img.darrays[:1]]:
+        found = {k: v for k, v in dict(meta).items() if k.startswith('AnatomicalStructure')}
+        if found:
+            return found
+    return dict()
+
+
+def load_label(filename):
+    """Return the gifti label image and its keys as a (columns, vertices) int array."""
+    img = nib.load(filename)
+    if not img.darrays:
+        raise ValueError('{} has no data arrays'.format(filename))
+    return img, np.vstack([np.asarray(d.data).reshape(1, -1) for d in img.darrays]).astype(np.int32)
+
+
+def save_label(keys, filename, template, names=None):
+    """Write (columns, vertices) label keys with the label table and metadata of ``template``."""
+    keys = np.atleast_2d(np.asarray(keys, dtype=np.int32))
+    if names is None:
+        names = [''] * keys.shape[0]
+    darrays = [nib.gifti.GiftiDataArray(row, intent='NIFTI_INTENT_LABEL',
+                                        datatype='NIFTI_TYPE_INT32',
+                                        meta=nib.gifti.GiftiMetaData({'Name': name}))
+               for row, name in zip(keys, names)]
+    nib.save(nib.gifti.GiftiImage(meta=nib.gifti.GiftiMetaData(dict(template.meta)),
+                                  labeltable=template.labeltable, darrays=darrays), filename)
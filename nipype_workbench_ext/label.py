@@ -1,4 +1,3 @@
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     BaseInterface, 
     BaseInterfaceInputSpec, 
@@ -9,20 +8,33 @@ from nipype.interfaces.base import (
     CommandLineInputSpec, 
     Str
 )
+from nipype import logging
 from traits.api import List
+import os
+
+from .base import WBEngineInputSpec, WBEngineCommand
+
+iflogger = logging.getLogger("nipype.interface")
 
 '''
 LabelResample interface using nipype.interfaces.workbench.metric.py
 as a starting point.
+
+engine='numpy' works out the resampling weights once per sphere pair, method,
+area files and roi, caches them as a sparse matrix (see resample.py) and
+resamples by a weighted vote per label key. A list of label files is resampled
+in one in-process run, writing out_files.
 '''
 
-class LabelResampleInputSpec(CommandLineInputSpec):
-    in_file = File(
-        exists=True,
+class LabelResampleInputSpec(WBEngineInputSpec):
+    in_file = traits.Either(
+        File(exists=True),
+        traits.List(File(exists=True)),
         mandatory=True,
         argstr="%s",
         position=0,
-        desc="The label file to resample",
+        desc="The label file to resample. A list of label files is resampled in "
+        "one in-process run, writing out_files",
     )
     current_sphere = File(
         exists=True,
@@ -51,12 +63,10 @@ class LabelResampleInputSpec(CommandLineInputSpec):
         " exactly one of area_surfs or area_metrics must be specified",
     )
     out_file = File(
-        name_source=["new_sphere"],
-        name_template="%s.nii",
-        keep_extension=True,
+        genfile=True,
         argstr="%s",
         position=4,
-        desc="The output label",
+        desc="The output label. Autogenerated if not specified.",
     )
     area_surfs = traits.Bool(
         position=5,
@@ -103,9 +113,13 @@ class LabelResampleInputSpec(CommandLineInputSpec):
 class LabelResampleOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="the output label")
     roi_file = File(desc="ROI of vertices that got data from valid source vertices")
+    out_files = traits.List(File(exists=True),
+        desc="the output labels, one per input (batch mode only)")
+    roi_files = traits.List(File(),
+        desc="valid ROIs, one per input (batch mode with valid_roi_out only)")
 
 
-class LabelResample(wb.WBCommand):
+class LabelResample(WBEngineCommand):
     """
     Resample a label file to a different mesh
 
@@ -154,8 +168,63 @@ class LabelResample(wb.WBCommand):
             spec.argstr += " " + roi_out
         return super()._format_arg(opt, spec, val)
 
+    def _batch(self):
+        return isinstance(self.inputs.in_file, list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._batch()
+
+    def _run_numpy(self, runtime):
+        from .gifti_io import load_label, save_label, save_metric, structure_meta
+        from .resample import matrix_for_inputs, resample_labels, valid_rows
+
+        matrix = matrix_for_inputs(self.inputs)
+        for in_file, out_file, roi_file in zip(*self._outputs_per_input()):
+            img, keys = load_label(in_file)
+            if keys.shape[1] != matrix.shape[1]:
+                raise ValueError("{} does not match the vertices of {}".format(
+                    in_file, self.inputs.current_sphere))
+            save_label(resample_labels(matrix, keys, bool(self.inputs.largest)), out_file,
+                       template=img, names=[d.meta.get("Name", "") for d in img.darrays])
+            if roi_file is not None:
+                save_metric(valid_rows(matrix)[None], roi_file, meta=structure_meta(img))
+        return runtime
+
+    def _outputs_per_input(self):
+        # (in_files, out_files, roi_files) in matching order
+        from .base import unique_stems
+
+        if not self._batch():
+            outputs = self._list_outputs()
+            return ([self.inputs.in_file], [outputs["out_file"]],
+                    [outputs.get("roi_file") if self.inputs.valid_roi_out else None])
+        in_files = list(self.inputs.in_file)
+        stems = unique_stems(in_files)
+        out_files = [os.path.join(os.getcwd(), stem + "_resampled.label.gii") for stem in stems]
+        roi_files = [os.path.join(os.getcwd(), stem + "_roi.func.gii")
+                     if self.inputs.valid_roi_out else None for stem in stems]
+        return in_files, out_files, roi_files
+
+    def _resampled_name(self, in_file):
+        return os.path.join(os.getcwd(),
+                            os.path.basename(in_file).split(".")[0] + "_resampled.label.gii")
+
+    def _gen_filename(self, name, outdir=None, suffix="", ext=None):
+        if name == "out_file":
+            if not isdefined(self.inputs.out_file):
+                return self._resampled_name(self.inputs.in_file)
+            return os.path.abspath(self.inputs.out_file)
+        return super()._gen_filename(name, outdir, suffix, ext)
+
     def _list_outputs(self):
-        outputs = super()._list_outputs()
+        if self._batch():
+            outputs = self.output_spec().get()
+            _, outputs["out_files"], roi_files = self._outputs_per_input()
+            if self.inputs.valid_roi_out:
+                outputs["roi_files"] = roi_files
+            return outputs
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self._gen_filename("out_file")
         if self.inputs.valid_roi_out:
             roi_file = self._gen_filename(self.inputs.in_file, suffix="_roi")
             outputs["roi_file"] = os.path.abspath(roi_file)
@@ -0,0 +1,406 @@
+# numpy evaluation of wb_command math expressions (-cifti-math, -metric-math,
+# -volume-math).
+# Developer Notes:
+# The grammar follows the wb_command help text: C-like operators and
+# precedence except that ^ is exponentiation (right associative, binding
+# tighter than unary minus), comparisons and logical operators return 1 or 0,
+# and `a ? b : c` is the inline if. Expressions are parsed once into a tree of
+# closures that evaluate elementwise on numpy arrays, so the same compiled
+# Expression can be applied block by block to memory-mapped inputs.
+# Like wb_command, ==, !=, <= and >= treat values within a relative 1e-6 of
+# the smaller magnitude as equal, so e.g. `x == 1` matches float32 data that
+# went through resampling the same way for either engine.
+
+import re
+import shlex
+
+import numpy as np
+
+_FUNCTIONS = {
+    'sin': (1, np.sin),
+    'cos': (1, np.cos),
+    'tan': (1, np.tan),
+    'asin': (1, np.arcsin),
+    'acos': (1, np.arccos),
+    'atan': (1, np.arctan),
+    'sinh': (1, np.sinh),
+    'cosh': (1, np.cosh),
+    'tanh': (1, np.tanh),
+    'exp': (1, np.exp),
+    'log': (1, np.log),
+    'ln': (1, np.log),
+    'log2': (1, np.log2),
+    'log10': (1, np.log10),
+    'sqrt': (1, np.sqrt),
+    'abs': (1, np.abs),
+    'floor': (1, np.floor),
+    'ceil': (1, np.ceil),
+    # C rounding, halves go away from zero
+    'round': (1, lambda x: np.sign(x) * np.floor(np.abs(x) + 0.5)),
+    'atan2': (2, np.arctan2),
+    'min': (2, np.minimum),
+    'max': (2, np.maximum),
+    'mod': (2, lambda x, y: np.where(y == 0, 0.0, x - y * np.floor(x / np.where(y == 0, 1, y)))),
+    'clamp': (3, lambda x, low, high: np.minimum(np.maximum(x, low), high)),
+}
+
+_CONSTANTS = {'PI': np.pi, 'E': np.e}
+
+_EQUAL_TOLERANCE = 1e-6
+
+
+def _close(a, b):
+    with np.errstate(invalid='ignore'):
+        return (a == b) | (np.abs(a - b) <= _EQUAL_TOLERANCE * np.minimum(np.abs(a), np.abs(b)))
+
+_BINARY = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.divide,
+    '^': np.power,
+    '<': lambda a, b: (a < b).astype(np.float64),
+    '>': lambda a, b: (a > b).astype(np.float64),
+    '<=': lambda a, b: ((a < b) | _close(a, b)).astype(np.float64),
+    '>=': lambda a, b: ((a > b) | _close(a, b)).astype(np.float64),
+    '==': lambda a, b: _close(a, b).astype(np.float64),
+    '!=': lambda a, b: (~_close(a, b)).astype(np.float64),
+    '&&': lambda a, b: ((a != 0) & (b != 0)).astype(np.float64),
+    '||': lambda a, b: ((a != 0) | (b != 0)).astype(np.float64),
+}
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>&&|\|\||==|!=|<=|>=|[-+*/^<>!(),?:])
+    )''', re.VERBOSE)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise ExpressionError('cannot parse "{}" at position {}'.format(text, pos))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser(object):
+    # recursive descent, one method per precedence level (lowest first)
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise ExpressionError('empty expression')
+        node = self.ternary()
+        if self.pos != len(self.tokens):
+            raise ExpressionError('unexpected "{}" in "{}"'.format(
+                self.tokens[self.pos][1], self.text))
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        if self.pos >= len(self.tokens):
+            raise ExpressionError('unexpected end of "{}"'.format(self.text))
+        kind, value = self.tokens[self.pos]
+        if expected is not None and value != expected:
+            raise ExpressionError('expected "{}" but found "{}" in "{}"'.format(
+                expected, value, self.text))
+        self.pos += 1
+        return kind, value
+
+    def ternary(self):
+        node = self.binary(0)
+        if self.peek() == '?':
+            self.take('?')
+            if_true = self.ternary()
+            self.take(':')
+            if_false = self.ternary()
+            node = ('if', node, if_true, if_false)
+        return node
+
+    _LEVELS = [['||'], ['&&'], ['==', '!='], ['<', '>', '<=', '>='], ['+', '-'], ['*', '/']]
+
+    def binary(self, level):
+        if level == len(self._LEVELS):
+            return self.unary()
+        node = self.binary(level + 1)
+        while self.peek() in self._LEVELS[level]:
+            op = self.take()[1]
+            node = ('op', op, node, self.binary(level + 1))
+        return node
+
+    def unary(self):
+        if self.peek() in ['-', '+', '!']:
+            op = self.take()[1]
+            return ('unary', op, self.unary())
+        return self.power()
+
+    def power(self):
+        node = self.primary()
+        if self.peek() == '^':
+            self.take('^')
+            node = ('op', '^', node, self.unary())
+        return node
+
+    def primary(self):
+        kind, value = self.take()
+        if kind == 'number':
+            return ('num', float(value))
+        if kind == 'name':
+            if self.peek() == '(':
+                if value not in _FUNCTIONS:
+                    raise ExpressionError('unknown function "{}"'.format(value))
+                self.take('(')
+                args = [self.ternary()]
+                while self.peek() == ',':
+                    self.take(',')
+                    args.append(self.ternary())
+                self.take(')')
+                if len(args) != _FUNCTIONS[value][0]:
+                    raise ExpressionError('{} takes {} arguments'.format(
+                        value, _FUNCTIONS[value][0]))
+                return ('call', value, args)
+            return ('var', value)
+        if value == '(':
+            node = self.ternary()
+            self.take(')')
+            return node
+        raise ExpressionError('unexpected "{}" in "{}"'.format(value, self.text))
+
+
+class Expression(object):
+    """
+    A compiled wb_command math expression.
+
+    ``variables`` lists the names the expression needs; calling the expression
+    with a dict of arrays for those names evaluates it elementwise (with numpy
+    broadcasting) and returns a float64 array.
+
+    >>> Expression('clamp(x, 0, 1) > 0.5 ? -x : x^2').variables
+    ['x']
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = _Parser(text).parse()
+        self.variables = sorted(self._names(self.tree))
+        self._evaluate = self._compile(self.tree)
+
+    def _names(self, node):
+        if node[0] == 'var':
+            return set() if node[1] in _CONSTANTS else {node[1]}
+        if node[0] == 'num':
+            return set()
+        children = node[2] if node[0] == 'call' else node[1:]
+        names = set()
+        for child in children:
+            if isinstance(child, tuple):
+                names |= self._names(child)
+        return names
+
+    def _compile(self, node):
+        kind = node[0]
+        if kind == 'num':
+            value = np.float64(node[1])
+            return lambda env: value
+        if kind == 'var':
+            name = node[1]
+            if name in _CONSTANTS:
+                value = np.float64(_CONSTANTS[name])
+                return lambda env: value
+            return lambda env: env[name]
+        if kind == 'unary':
+            operand = self._compile(node[2])
+            if node[1] == '-':
+                return lambda env: np.negative(operand(env))
+            if node[1] == '!':
+                return lambda env: (operand(env) == 0).astype(np.float64)
+            return operand
+        if kind == 'op':
+            func, left, right = _BINARY[node[1]], self._compile(node[2]), self._compile(node[3])
+            return lambda env: func(left(env), right(env))
+        if kind == 'call':
+            func = _FUNCTIONS[node[1]][1]
+            args = [self._compile(arg) for arg in node[2]]
+            return lambda env: func(*[arg(env) for arg in args])
+        if kind == 'if':
+            cond, if_true, if_false = [self._compile(n) for n in node[1:]]
+            return lambda env: np.where(cond(env) != 0, if_true(env), if_false(env))
+        raise ExpressionError('bad expression node {}'.format(kind))
+
+    def __call__(self, env):
+        missing = [name for name in self.variables if name not in env]
+        if missing:
+            raise ExpressionError('no value given for variable(s) {}'.format(', '.join(missing)))
+        with np.errstate(all='ignore'):
+            return np.asarray(self._evaluate(env), dtype=np.float64)
+
+
+# -var modifiers, with the number of arguments each takes
+_VAR_OPTIONS = {'-select': 2, '-repeat': 0, '-column': 1, '-subvolume': 1}
+
+
+def parse_var(spec):
+    """
+    Split an in_vars value into the file and its modifiers.
+
+    ``'run.dtseries.nii -select 1 5 -repeat'`` gives
+    ``('run.dtseries.nii', {'-select': ['1', '5'], '-repeat': []})``.
+    """
+    tokens = shlex.split(spec)
+    if not tokens:
+        raise ExpressionError('empty variable specification')
+    options = dict()
+    pos = 1
+    while pos < len(tokens):
+        option = tokens[pos]
+        if option not in _VAR_OPTIONS:
+            raise ExpressionError('unknown -var option "{}"'.format(option))
+        nargs = _VAR_OPTIONS[option]
+        options[option] = tokens[pos + 1:pos + 1 + nargs]
+        if len(options[option]) != nargs:
+            raise ExpressionError('{} takes {} argument(s)'.format(option, nargs))
+        pos += 1 + nargs
+    return tokens[0], options
+
+
+class Variable(object):
+    """
+    One -var input as a (maps, elements) array, optionally reduced to a single
+    map (``map_index``) and/or a single element (``element_index``). A variable
+    with ``repeat`` set is broadcast over the maps of the output.
+    """
+
+    def __init__(self, name, data, map_index=None, element_index=None, repeat=False):
+        self.name = name
+        self.data = data
+        self.map_index = map_index
+        self.element_index = element_index
+        self.repeat = repeat
+
+    @property
+    def n_maps(self):
+        return 1 if self.map_index is not None else self.data.shape[0]
+
+    @property
+    def n_elements(self):
+        return None if self.element_index is not None else self.data.shape[1]
+
+    @property
+    def nbytes(self):
+        # bytes read for this variable, only the selected map/element with -select
+        return self.n_maps * (self.n_elements or 1) * self.data.dtype.itemsize
+
+    def block(self, start, stop):
+        rows = slice(None) if self.map_index is None else slice(self.map_index, self.map_index + 1)
+        if self.element_index is not None:
+            cols = slice(self.element_index, self.element_index + 1)
+        else:
+            cols = slice(start, stop)
+        return np.asarray(self.data[rows, cols], dtype=np.float64)
+
+
+def output_shape(variables):
+    """(maps, elements) of the result, checking the variables agree like wb_command does."""
+    fixed = [v for v in variables if not v.repeat]
+    n_maps = {v.n_maps for v in fixed} or {1}
+    if len(n_maps) != 1:
+        raise ExpressionError('variables have different numbers of maps: {}'.format(
+            ', '.join('{}={}'.format(v.name, v.n_maps) for v in fixed)))
+    n_maps = n_maps.pop()
+    for v in variables:
+        if v.repeat and v.n_maps != 1:
+            raise ExpressionError('-repeat requires variable {} to have a single map'.format(v.name))
+    n_elements = {v.n_elements for v in variables if v.n_elements is not None}
+    if len(n_elements) != 1:
+        raise ExpressionError('variables do not have the same number of elements')
+    return n_maps, n_elements.pop()
+
+
+def evaluate_blocks(expression, variables, out, block_mb=256):
+    """
+    Evaluate ``expression`` into the (maps, elements) array ``out``, reading
+    the variables in element blocks so that no more than roughly ``block_mb``
+    of input and temporaries is held at once.
+    """
+    by_name = {v.name: v for v in variables}
+    missing = [name for name in expression.variables if name not in by_name]
+    if missing:
+        raise ExpressionError('no -var given for {}'.format(', '.join(missing)))
+    n_maps, n_elements = out.shape
+    # each input block plus a few temporaries per variable
+    column_nbytes = 8 * n_maps * (2 * len(variables) + 2)
+    step = max(1, int(block_mb * 2 ** 20 // column_nbytes))
+    for start in range(0, n_elements, step):
+        stop = min(start + step, n_elements)
+        env = {name: by_name[name].block(start, stop) for name in expression.variables}
+        out[:, start:stop] = np.broadcast_to(expression(env), (n_maps, stop - start))
+    return out
+
+
+class ExpressionChain(object):
+    """
+    Several math steps fused into one evaluation.
+
+    ``steps`` is a list of ``(expression, result_name)``; later steps may use
+    the results of earlier ones as variables. Per block, every step is
+    evaluated once from the block's inputs and the result of the last step is
+    returned, so chained CiftiMath/MetricMath nodes become a single pass with
+    no intermediate files. Behaves like an Expression for evaluate_blocks.
+    """
+
+    def __init__(self, steps):
+        if not steps:
+            raise ExpressionError('an expression chain needs at least one step')
+        self.steps = [(Expression(text), name) for text, name in steps]
+        self.text = '; '.join('{} = {}'.format(name, text) for text, name in steps)
+        produced = set()
+        variables = set()
+        for expression, name in self.steps:
+            variables |= set(expression.variables) - produced
+            produced.add(name)
+        self.variables = sorted(variables)
+
+    def __call__(self, env):
+        env = dict(env)
+        for expression, name in self.steps:
+            env[name] = expression(env)
+        return env[self.steps[-1][1]]
+
+    def io_bytes_avoided(self, variables, n_maps, n_elements, itemsize=4):
+        """
+        Bytes of file I/O saved compared to running each step as its own node:
+        every intermediate result is neither written nor read back, and inputs
+        used by several steps are only read once.
+        """
+        by_name = {v.name: v for v in variables}
+        result_nbytes = n_maps * n_elements * itemsize
+        unfused = 0
+        results = set()
+        for expression, name in self.steps:
+            for var in expression.variables:
+                if var in results:
+                    unfused += result_nbytes
+                else:
+                    unfused += by_name[var].nbytes
+            unfused += result_nbytes
+            results.add(name)
+        fused = sum(by_name[var].nbytes for var in self.variables) + result_nbytes
+        return unfused - fused
@@ -0,0 +1,147 @@
+# Streaming merge of cifti files along their maps, as wb_command -cifti-merge.
+# Developer Notes:
+# wb_command reads every input whole before writing, so merging hundreds of
+# runs or thousands of dscalars needs the memory of all of them. Here the
+# inputs are checked against each other from their headers alone (through
+# template.template_index, kept in memory only: merge inputs are rarely seen
+# twice and would fill the disk cache), the output is preallocated, and each
+# input is then copied in blocks of brainordinates. Cifti stores the maps of
+# a brainordinate next to each other, so those blocks are contiguous reads of
+# the input.
+# For the same reason maps cannot be appended to a file in place: every
+# brainordinate's run of maps gets longer. append=True therefore streams the
+# existing file through like any other input into a new file that replaces
+# it, which still never holds more than a block in memory.
+
+import os
+
+import numpy as np
+
+
+def parse_merge_input(spec):
+    """
+    Split a merge input into the file and the maps to take from it, using
+    wb_command's -column/-up-to/-reverse options (1-based, inclusive), e.g.
+    ``'run.dtseries.nii -column 11 -up-to 20'``. Returns the file and a list
+    of 0-based map indices, or None for all maps.
+    """
+    import shlex
+
+    tokens = shlex.split(spec)
+    if not tokens:
+        raise ValueError('empty merge input')
+    selections = []
+    pos = 1
+    while pos < len(tokens):
+        if tokens[pos] != '-column' or pos + 1 >= len(tokens):
+            raise ValueError('bad column selection "{}"'.format(spec))
+        first = last = int(tokens[pos + 1])
+        reverse = False
+        pos += 2
+        if pos < len(tokens) and tokens[pos] == '-up-to':
+            if pos + 1 >= len(tokens):
+                raise ValueError('-up-to needs a column in "{}"'.format(spec))
+            last = int(tokens[pos + 1])
+            pos += 2
+            if pos < len(tokens) and tokens[pos] == '-reverse':
+                reverse = True
+                pos += 1
+        selections.append((first, last, reverse))
+    if not selections:
+        return tokens[0], None
+    columns = []
+    for first, last, reverse in selections:
+        if last < first:
+            raise ValueError('-up-to {} is before -column {} in "{}"'.format(last, first, spec))
+        selected = list(range(first - 1, last))
+        columns += selected[::-1] if reverse else selected
+    return tokens[0], columns
+
+
+def _map_axis(index, columns):
+    # map axis of a template_index() entry restricted to columns (None: all)
+    from nibabel.cifti2 import cifti2_axes
+    from .template import label_tables
+
+    kind = str(index['map_kind'])
+    columns = list(range(int(index['shape'][0]))) if columns is None else columns
+    if kind == 'SeriesAxis':
+        start, step = [float(v) for v in index['series']]
+        return cifti2_axes.SeriesAxis(start, step, len(columns), str(index['series_unit']))
+    names = [str(n) for n in np.asarray(index['map_names'])[columns]]
+    if kind == 'ScalarAxis':
+        return cifti2_axes.ScalarAxis(names)
+    if kind == 'LabelAxis':
+        tables = label_tables(index)
+        return cifti2_axes.LabelAxis(names, [tables[c] for c in columns])
+    raise ValueError('cannot merge files with a {} along their maps'.format(kind))
+
+
+def merge_cifti(out_file, inputs, append=False, block_mb=256):
+    """
+    Concatenate the maps of ``inputs`` (file names, optionally with column
+    selections, see parse_merge_input) into ``out_file``. With ``append`` the
+    maps of an existing ``out_file`` come first. All inputs must have the
+    same brainordinates (or parcels) and the same kind of maps. Series take
+    their start, step and unit from the first input.
+    """
+    from nibabel.cifti2 import cifti2_axes
+    from .cifti_io import load_cifti, create_cifti_xml, mapping_xml, rows_per_block, flush
+    from .template import template_index, _bytes
+
+    sources = [parse_merge_input(spec) for spec in inputs]
+    if append and os.path.exists(out_file):
+        sources.insert(0, (out_file, None))
+    if not sources:
+        raise ValueError('nothing to merge')
+
+    # headers only: check everything before writing anything
+    indices = [template_index(filename, use_disk=False) for filename, _ in sources]
+    first = indices[0]
+    axes = []
+    for (filename, columns), index in zip(sources, indices):
+        if _bytes(index['columns_xml']) != _bytes(first['columns_xml']):
+            raise ValueError('{} does not have the brainordinates of {}'.format(
+                filename, sources[0][0]))
+        if str(index['map_kind']) != str(first['map_kind']):
+            raise ValueError('{} has {} maps but {} has {}'.format(
+                filename, index['map_kind'], sources[0][0], first['map_kind']))
+        n_maps = int(index['shape'][0])
+        if columns is not None and any(not 0 <= c < n_maps for c in columns):
+            raise ValueError('{} only has {} maps'.format(filename, n_maps))
+        axes.append(_map_axis(index, columns))
+    if str(first['map_kind']) == 'SeriesAxis':
+        map_axis = cifti2_axes.SeriesAxis(axes[0].start, axes[0].step,
+                                          sum(len(ax) for ax in axes), axes[0].unit)
+    else:
+        map_axis = axes[0]
+        for axis in axes[1:]:
+            map_axis = map_axis + axis
+
+    n_columns = int(first['shape'][1])
+    intent = int(first['intent_code']) or 'NIFTI_INTENT_CONNECTIVITY_UNKNOWN'
+    # write next to out_file and move into place, out_file may be an input
+    tmp = '{}.{}.tmp.nii'.format(out_file, os.getpid())
+    try:
+        out = create_cifti_xml(tmp, [mapping_xml(map_axis, 0), _bytes(first['columns_xml'])],
+                               (len(map_axis), n_columns), intent)
+        row = 0
+        for filename, columns in sources:
+            _, data = load_cifti(filename)
+            n_maps = data.shape[0] if columns is None else len(columns)
+            # a contiguous run of maps (the usual case) is sliced rather than gathered
+            if columns is not None and columns == list(range(columns[0], columns[0] + n_maps)):
+                data, columns = data[columns[0]:columns[0] + n_maps], None
+            step = rows_per_block(data.shape[0] * 4, block_mb)
+            for start in range(0, n_columns, step):
+                stop = min(start + step, n_columns)
+                block = np.asarray(data[:, start:stop])
+                out[row:row + n_maps, start:stop] = block if columns is None else block[columns]
+            row += n_maps
+            del data
+        flush(out)
+        del out
+        os.replace(tmp, out_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
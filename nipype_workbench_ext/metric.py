@@ -1,4 +1,3 @@
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     BaseInterface, 
     BaseInterfaceInputSpec, 
@@ -10,16 +9,24 @@ from nipype.interfaces.base import (
     CommandLineInputSpec
 )
 from traits.api import List
+
+from .base import WBEngineInputSpec, WBEngineCommand
         
 
 # parts copied from nipreps
-class MetricDilateInputSpec(CommandLineInputSpec):
-    metric=File(
+# engine='numpy' looks up the geodesic neighbourhood of every vertex in an
+# index that is built once per (surface, distance, exponent) and cached (see
+# dilation.py), so dilating another metric on the same surface is a gather. It
+# dilates every column of metric, and a list of metrics in one call.
+class MetricDilateInputSpec(WBEngineInputSpec):
+    metric=traits.Either(
+        File(exists=True),
+        traits.List(File(exists=True)),
         argstr='%s ',
         position=0,
-        exists=True,
         mandatory=True,
-        desc="The metric to dilate"
+        desc="The metric to dilate. A list of metrics on the same surface is dilated "
+             "in one in-process run, writing out_files"
     )
     surface=File(
         argstr='%s ',
@@ -35,9 +42,6 @@ class MetricDilateInputSpec(CommandLineInputSpec):
         desc="Distance in mm to dilate"
     )
     out_file=File(
-        name_source=['in_file'],
-        name_template="%s.func.gii",
-        keep_extension=False,
         argstr='%s ',
         position=3,
         genfile=True,
@@ -82,21 +86,83 @@ class MetricDilateOutputSpec(TraitedSpec):
         exists=True,
         desc="The output metric file"
     )
+    out_files=traits.List(File(exists=True),
+        desc="The output metric files, one per input metric (batch mode only)"
+    )
 
-class MetricDilate(wb.WBCommand):
+class MetricDilate(WBEngineCommand):
     input_spec = MetricDilateInputSpec
     output_spec = MetricDilateOutputSpec
 
     _cmd = 'wb_command -metric-dilate'
 
+    def _batch(self):
+        return isinstance(self.inputs.metric, list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._batch()
+
+    def _run_numpy(self, runtime):
+        import numpy as np
+        from .dilation import dilation_index, dilate
+        from .gifti_io import load_metric, save_metric, column_names
+
+        exponent = self.inputs.exponent if isdefined(self.inputs.exponent) else 6.0
+        areas = self.inputs.corrected_areas if isdefined(self.inputs.corrected_areas) else None
+        index = dilation_index(self.inputs.surface, self.inputs.distance, exponent, areas)
+        method = 'nearest' if self.inputs.nearest else 'linear' if self.inputs.linear else 'weighted'
+        n_vertices = len(index['indptr']) - 1
+        for metric, out_file in zip(self._metrics(), self._out_files()):
+            img, data = load_metric(metric)
+            if data.shape[1] != n_vertices:
+                raise ValueError('{} does not have the same number of vertices as {}'.format(
+                    metric, self.inputs.surface))
+            dilated = np.stack([dilate(column, index, method, bool(self.inputs.legacy_cutoff))
+                                for column in data])
+            save_metric(dilated, out_file, template=img, names=column_names(img))
+        return runtime
+
+    def _metrics(self):
+        if self._batch():
+            return list(self.inputs.metric)
+        return [self.inputs.metric]
+
+    def _out_files(self):
+        import os
+        from .base import unique_stems
+
+        if not self._batch():
+            return [self._gen_filename('out_file')]
+        return [os.path.join(os.getcwd(), stem + '_dilated.func.gii')
+                for stem in unique_stems(self.inputs.metric)]
+
+    def _gen_filename(self, name):
+        import os
+
+        if name == 'out_file':
+            if not isdefined(self.inputs.out_file):
+                return os.path.join(os.getcwd(), os.path.basename(self.inputs.metric).split('.')[0] +
+                                    '_dilated.func.gii')
+            return self.inputs.out_file
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        if self._batch():
+            outputs['out_files'] = self._out_files()
+        else:
+            outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
 
 
 # Note: this is another quick and dirty implementation. The dirt comes down to
-# specifications of suboptions to -var, which can take -select x y -repeat type
+# specifications of suboptions to -var, which can take -column x -repeat type
 # option. If you want to pass something like that implement a Function interface
 # that takes your input file name as input and returns a string that includes
-# that filename and the subsequent modifiers.
-class MetricMathInputSpec(CommandLineInputSpec):
+# that filename and the subsequent modifiers, e.g. 'thickness.func.gii -column 2 -repeat'.
+# Both engines understand that form. engine='numpy' compiles the expression once
+# (see mathexpr.py) and evaluates it in vertex blocks.
+class MetricMathInputSpec(WBEngineInputSpec):
     expression=Str(
         argstr='"%s"',
         position=0,
@@ -117,6 +183,9 @@ class MetricMathInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=2
     )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of temporaries to hold at once with engine='numpy'")
 
 class MetricMathOutputSpec(TraitedSpec):
     out_file=File(
@@ -124,12 +193,25 @@ class MetricMathOutputSpec(TraitedSpec):
         desc="the output metric file"
     )
 
-class MetricMath(wb.WBCommand):
+class MetricMath(WBEngineCommand):
     input_spec = MetricMathInputSpec
     output_spec = MetricMathOutputSpec
 
     _cmd = 'wb_command -metric-math'
 
+    def _run_numpy(self, runtime):
+        import numpy as np
+        from .gifti_io import save_metric
+        from .mathexpr import Expression, output_shape, evaluate_blocks
+
+        expression = Expression(self.inputs.expression)
+        variables, images = _metric_math_variables(self.inputs.in_vars)
+        n_maps, n_vertices = output_shape(variables)
+        out = np.empty((n_maps, n_vertices), dtype=np.float32)
+        evaluate_blocks(expression, variables, out, self.inputs.block_mb)
+        save_metric(out, self._gen_filename('out_file'), template=images[0],
+                    names=_metric_math_names(variables, images, n_maps))
+        return runtime
 
     def _gen_filename(self, name):
         import os
@@ -143,4 +225,310 @@ class MetricMath(wb.WBCommand):
         outputs = self.output_spec().get()
         outputs['out_file'] = self._gen_filename('out_file')
 
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+def _metric_math_variables(in_vars):
+    # in_vars -> mathexpr.Variable list (and the images they came from)
+    from .gifti_io import load_metric, column_names
+    from .mathexpr import Variable, parse_var, ExpressionError
+
+    variables, images = [], []
+    for name, spec in in_vars:
+        filename, options = parse_var(spec)
+        img, data = load_metric(filename)
+        map_index = None
+        if '-column' in options:
+            # a 1-based column number or a column name
+            column = options['-column'][0]
+            names = column_names(img)
+            if column in names:
+                map_index = names.index(column)
+            elif column.isdigit() and 1 <= int(column) <= data.shape[0]:
+                map_index = int(column) - 1
+            else:
+                raise ExpressionError('{} has no column {}'.format(filename, column))
+        variables.append(Variable(name, data, map_index, None, '-repeat' in options))
+        images.append(img)
+    return variables, images
+
+
+def _metric_math_names(variables, images, n_maps):
+    # column names of the first variable that has the output's shape
+    from .gifti_io import column_names
+
+    for v, img in zip(variables, images):
+        if not v.repeat and v.n_maps == n_maps:
+            names = column_names(img)
+            if v.map_index is not None:
+                names = names[v.map_index:v.map_index + 1]
+            return names
+    return [''] * n_maps
+
+
+# Runs a chain of MetricMath steps as one in-process pass without writing the
+# intermediate metrics. Each step is (expression, result_name) and later steps can
+# use earlier results as variables.
+class MetricMathChainInputSpec(BaseInterfaceInputSpec):
+    steps=traits.List(
+        traits.Tuple(Str(), Str()),
+        mandatory=True,
+        desc="ordered (expression, result_name) pairs. The last result is written to out_file"
+    )
+    in_vars=traits.List(
+        traits.Tuple(Str(),
+                     traits.Either(File(exists=True),
+                                   Str())),
+        desc='gifti files used as variables, same format as MetricMath.in_vars',
+        mandatory=True,
+    )
+    out_file=File(
+        desc="the output gifti file. Autogenerated if not specified."
+    )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of temporaries to hold at once")
+
+class MetricMathChainOutputSpec(TraitedSpec):
+    out_file=File(
+        exists=True,
+        desc="the output metric file"
+    )
+    io_bytes_avoided=traits.Int(
+        desc="bytes of file I/O saved compared to running the steps as separate MetricMath nodes"
+    )
+
+class MetricMathChain(BaseInterface):
+    input_spec = MetricMathChainInputSpec
+    output_spec = MetricMathChainOutputSpec
+
+    def _run_interface(self, runtime):
+        import numpy as np
+        from .gifti_io import save_metric
+        from .mathexpr import ExpressionChain, output_shape, evaluate_blocks
+
+        chain = ExpressionChain(self.inputs.steps)
+        variables, images = _metric_math_variables(self.inputs.in_vars)
+        n_maps, n_vertices = output_shape(variables)
+        out = np.empty((n_maps, n_vertices), dtype=np.float32)
+        evaluate_blocks(chain, variables, out, self.inputs.block_mb)
+        save_metric(out, self._gen_filename('out_file'), template=images[0],
+                    names=_metric_math_names(variables, images, n_maps))
+        self._io_bytes_avoided = chain.io_bytes_avoided(variables, n_maps, n_vertices)
+        return runtime
+
+    def _gen_filename(self, name):
+        import os
+
+        if name == 'out_file':
+            if not isdefined(self.inputs.out_file):
+                return os.path.join(os.getcwd(), 'metric_math_results.func.gii')
+            return os.path.abspath(self.inputs.out_file)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        outputs['io_bytes_avoided'] = getattr(self, '_io_bytes_avoided', 0)
+
+        return outputs
+
+
+# sibling of label.LabelResample, after nipype.interfaces.workbench.metric.
+# engine='numpy' applies the cached resampling matrix of resample.py as a
+# sparse product, and resamples a list of metrics in one in-process run.
+class MetricResampleInputSpec(WBEngineInputSpec):
+    in_file = traits.Either(
+        File(exists=True),
+        traits.List(File(exists=True)),
+        mandatory=True,
+        argstr="%s",
+        position=0,
+        desc="The metric file to resample. A list of metric files is resampled in "
+        "one in-process run, writing out_files",
+    )
+    current_sphere = File(
+        exists=True,
+        mandatory=True,
+        argstr="%s",
+        position=1,
+        desc="A sphere surface with the mesh that the metric is currently on",
+    )
+    new_sphere = File(
+        exists=True,
+        mandatory=True,
+        argstr="%s",
+        position=2,
+        desc="A sphere surface that is in register with <current-sphere> and"
+        " has the desired output mesh",
+    )
+    method = traits.Enum(
+        "ADAP_BARY_AREA",
+        "BARYCENTRIC",
+        argstr="%s",
+        mandatory=True,
+        position=3,
+        desc="The method name - ADAP_BARY_AREA method is recommended for"
+        " ordinary metric data, because it should use all data while"
+        " downsampling, unlike BARYCENTRIC. If ADAP_BARY_AREA is used,"
+        " exactly one of area_surfs or area_metrics must be specified",
+    )
+    out_file = File(
+        genfile=True,
+        argstr="%s",
+        position=4,
+        desc="The output metric. Autogenerated if not specified.",
+    )
+    area_surfs = traits.Bool(
+        position=5,
+        argstr="-area-surfs",
+        xor=["area_metrics"],
+        desc="Specify surfaces to do vertex area correction based on",
+    )
+    area_metrics = traits.Bool(
+        position=5,
+        argstr="-area-metrics",
+        xor=["area_surfs"],
+        desc="Specify vertex area metrics to do area correction based on",
+    )
+    current_area = File(
+        exists=True,
+        position=6,
+        argstr="%s",
+        desc="A relevant anatomical surface with <current-sphere> mesh OR"
+        " a metric file with vertex areas for <current-sphere> mesh",
+    )
+    new_area = File(
+        exists=True,
+        position=7,
+        argstr="%s",
+        desc="A relevant anatomical surface with <new-sphere> mesh OR"
+        " a metric file with vertex areas for <new-sphere> mesh",
+    )
+    roi_metric = File(
+        exists=True,
+        position=8,
+        argstr="-current-roi %s",
+        desc="Input roi on the current mesh used to exclude non-data vertices",
+    )
+    valid_roi_out = traits.Bool(
+        position=9,
+        argstr="-valid-roi-out",
+        desc="Output the ROI of vertices that got data from valid source vertices",
+    )
+    largest = traits.Bool(
+        position=10,
+        argstr="-largest",
+        desc="Use only the value of the vertex with the largest weight",
+    )
+
+
+class MetricResampleOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="the output metric")
+    roi_file = File(desc="ROI of vertices that got data from valid source vertices")
+    out_files = traits.List(File(exists=True),
+        desc="the output metrics, one per input (batch mode only)")
+    roi_files = traits.List(File(),
+        desc="valid ROIs, one per input (batch mode with valid_roi_out only)")
+
+
+class MetricResample(WBEngineCommand):
+    """
+    Resample a metric file to a different mesh
+
+    Resamples a metric file, given two spherical surfaces that are in
+    register.  If ``ADAP_BARY_AREA`` is used, exactly one of ``area_surfs``
+    or ``area_metrics`` must be specified.
+    """
+
+    input_spec = MetricResampleInputSpec
+    output_spec = MetricResampleOutputSpec
+    _cmd = "wb_command -metric-resample"
+
+    def _format_arg(self, opt, spec, val):
+        if opt in ["current_area", "new_area"]:
+            if not self.inputs.area_surfs and not self.inputs.area_metrics:
+                raise ValueError(
+                    "{} was set but neither area_surfs or"
+                    " area_metrics were set".format(opt)
+                )
+        if opt == "method":
+            if (
+                val == "ADAP_BARY_AREA"
+                and not self.inputs.area_surfs
+                and not self.inputs.area_metrics
+            ):
+                raise ValueError(
+                    "Exactly one of area_surfs or area_metrics must be specified"
+                )
+        if opt == "valid_roi_out" and val:
+            # generate a filename and add it to argstr
+            roi_out = self._gen_filename(self.inputs.in_file, suffix="_roi")
+            spec.argstr += " " + roi_out
+        return super()._format_arg(opt, spec, val)
+
+    def _batch(self):
+        return isinstance(self.inputs.in_file, list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._batch()
+
+    def _run_numpy(self, runtime):
+        from .gifti_io import load_metric, save_metric, column_names, structure_meta
+        from .resample import matrix_for_inputs, resample_metric, valid_rows
+
+        matrix = matrix_for_inputs(self.inputs)
+        for in_file, out_file, roi_file in zip(*self._outputs_per_input()):
+            img, data = load_metric(in_file)
+            if data.shape[1] != matrix.shape[1]:
+                raise ValueError("{} does not match the vertices of {}".format(
+                    in_file, self.inputs.current_sphere))
+            save_metric(resample_metric(matrix, data, bool(self.inputs.largest)), out_file,
+                        template=img, names=column_names(img))
+            if roi_file is not None:
+                save_metric(valid_rows(matrix)[None], roi_file, meta=structure_meta(img))
+        return runtime
+
+    def _outputs_per_input(self):
+        # (in_files, out_files, roi_files) in matching order
+        import os
+        from .base import unique_stems
+
+        if not self._batch():
+            outputs = self._list_outputs()
+            return ([self.inputs.in_file], [outputs["out_file"]],
+                    [outputs.get("roi_file") if self.inputs.valid_roi_out else None])
+        in_files = list(self.inputs.in_file)
+        stems = unique_stems(in_files)
+        out_files = [os.path.join(os.getcwd(), stem + "_resampled.func.gii") for stem in stems]
+        roi_files = [os.path.join(os.getcwd(), stem + "_roi.func.gii")
+                     if self.inputs.valid_roi_out else None for stem in stems]
+        return in_files, out_files, roi_files
+
+    def _resampled_name(self, in_file):
+        import os
+        return os.path.join(os.getcwd(),
+                            os.path.basename(in_file).split(".")[0] + "_resampled.func.gii")
+
+    def _gen_filename(self, name, outdir=None, suffix="", ext=None):
+        import os
+        if name == "out_file":
+            if not isdefined(self.inputs.out_file):
+                return self._resampled_name(self.inputs.in_file)
+            return os.path.abspath(self.inputs.out_file)
+        return super()._gen_filename(name, outdir, suffix, ext)
+
+    def _list_outputs(self):
+        import os
+
+        if self._batch():
+            outputs = self.output_spec().get()
+            _, outputs["out_files"], roi_files = self._outputs_per_input()
+            if self.inputs.valid_roi_out:
+                outputs["roi_files"] = roi_files
+            return outputs
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self._gen_filename("out_file")
+        if self.inputs.valid_roi_out:
+            roi_file = self._gen_filename(self.inputs.in_file, suffix="_roi")
+            outputs["roi_file"] = os.path.abspath(roi_file)
+        return outputs
@@ -1,4 +1,3 @@
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     BaseInterface,
     BaseInterfaceInputSpec,
@@ -11,12 +10,14 @@ from nipype.interfaces.base import (
 )
 from traits.api import List
 
+from .base import WBInputSpec, WBCommand
+
 # another quick and dirty implementation
 # note that cifti needs an input in the -cifti <index> <name> format
 # try passing inputs it into a function that reformats lists like so
 # newList = [(int(i+1), item) for i,item in enumerate(oldList)]
 # note that index is 1-indexed
-class SetMapNamesInputSpec(CommandLineInputSpec):
+class SetMapNamesInputSpec(WBInputSpec):
     in_file=File(
         argstr='%s',
         position=0,
@@ -36,7 +37,7 @@ class SetMapNamesOutputSpec(TraitedSpec):
         desc="the input cifti file"
     )
 
-class SetMapNames(wb.WBCommand):
+class SetMapNames(WBCommand):
     input_spec = SetMapNamesInputSpec
     output_spec = SetMapNamesOutputSpec
 
@@ -59,12 +60,17 @@ class SetMapNames(wb.WBCommand):
 
         return outputs
 
-    def _run_interface(self, runtime):
+    def _before_command(self):
+        # also called by batch.run_batched, which runs the command elsewhere
         import shutil, os
         out_file = self._gen_filename('out_file')
-        shutil.copyfile(self.inputs.in_file, out_file)
+        if os.path.abspath(self.inputs.in_file) != out_file:
+            shutil.copyfile(self.inputs.in_file, out_file)
 
         # Redirect to copy
         self.inputs.in_file = out_file
+
+    def _run_interface(self, runtime):
+        self._before_command()
         runtime = super()._run_interface(runtime)
         return runtime
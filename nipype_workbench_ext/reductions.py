@@ -0,0 +1,361 @@
+# numpy equivalents of wb_command's reduction operations (ReductionEnum).
+# Developer Notes:
+# These follow the definitions printed by `wb_command -cifti-reduce`, e.g.
+# STDEV uses an N denominator, SAMPSTDEV/TSNR/COV use N-1, and INDEXMAX/INDEXMIN
+# are 1-based. Everything is computed in double precision like wb_command does
+# before the result is cast back to float on write.
+
+import numpy as np
+
+REDUCE_OPERATIONS = ['MAX', 'MIN', 'INDEXMAX', 'INDEXMIN', 'SUM', 'PRODUCT', 'MEAN',
+                     'STDEV', 'SAMPSTDEV', 'VARIANCE', 'TSNR', 'COV', 'L2NORM',
+                     'MEDIAN', 'MODE', 'COUNT_NONZERO']
+
+
+def _mode(data, axis):
+    # most frequent value, ties go to the smallest value
+    data = np.moveaxis(data, axis, -1)
+    out = np.empty(data.shape[:-1])
+    for idx in np.ndindex(*data.shape[:-1]):
+        values, counts = np.unique(data[idx], return_counts=True)
+        out[idx] = values[np.argmax(counts)]
+    return out
+
+
+def reduce(data, operation, axis=-1):
+    """
+    Reduce ``data`` along ``axis`` the way wb_command's -reduce option does.
+
+    Returns a float64 array with ``axis`` removed.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[axis]
+    if n == 0:
+        raise ValueError('cannot reduce an empty set of values')
+    if operation in ['SAMPSTDEV', 'TSNR', 'COV'] and n < 2:
+        raise ValueError('{} requires at least 2 values'.format(operation))
+
+    if operation == 'MAX':
+        return data.max(axis=axis)
+    if operation == 'MIN':
+        return data.min(axis=axis)
+    if operation == 'INDEXMAX':
+        return data.argmax(axis=axis) + 1.0
+    if operation == 'INDEXMIN':
+        return data.argmin(axis=axis) + 1.0
+    if operation == 'SUM':
+        return data.sum(axis=axis)
+    if operation == 'PRODUCT':
+        return data.prod(axis=axis)
+    if operation == 'MEAN':
+        return data.mean(axis=axis)
+    if operation == 'STDEV':
+        return data.std(axis=axis)
+    if operation == 'SAMPSTDEV':
+        return data.std(axis=axis, ddof=1)
+    if operation == 'VARIANCE':
+        return data.var(axis=axis)
+    if operation == 'TSNR':
+        return data.mean(axis=axis) / data.std(axis=axis, ddof=1)
+    if operation == 'COV':
+        return data.std(axis=axis, ddof=1) / data.mean(axis=axis)
+    if operation == 'L2NORM':
+        return np.sqrt(np.square(data).sum(axis=axis))
+    if operation == 'MEDIAN':
+        return np.median(data, axis=axis)
+    if operation == 'MODE':
+        return _mode(data, axis)
+    if operation == 'COUNT_NONZERO':
+        return np.count_nonzero(data, axis=axis).astype(np.float64)
+    raise ValueError('unknown reduction operation: {}'.format(operation))
+
+
+def percentile(data, percent, axis=-1):
+    """Value at ``percent`` (0-100) along ``axis``, linearly interpolated."""
+    data = np.asarray(data, dtype=np.float64)
+    if data.shape[axis] == 0:
+        raise ValueError('cannot take a percentile of an empty set of values')
+    if not 0 <= percent <= 100:
+        raise ValueError('percentile must be between 0 and 100')
+    return np.percentile(data, percent, axis=axis)
+
+
+def reduce_rois(data, indicator, operation=None, percent=None):
+    """
+    Reduce a (maps, brainordinates) block over every roi at once.
+
+    ``indicator`` is a sparse (brainordinates, rois) 0/1 matrix. Linear
+    statistics are computed as sparse matrix products, everything else by
+    gathering each roi's brainordinates. Returns a (maps, rois) array.
+    """
+    from scipy import sparse
+
+    data = np.asarray(data, dtype=np.float64)
+    indicator = sparse.csc_matrix(indicator)
+    counts = np.diff(indicator.indptr)
+    if np.any(counts == 0):
+        raise ValueError('roi {} is empty'.format(int(np.flatnonzero(counts == 0)[0]) + 1))
+    if operation in ['SAMPSTDEV', 'TSNR', 'COV'] and np.any(counts < 2):
+        raise ValueError('{} requires at least 2 values in every roi'.format(operation))
+
+    def _sum(values):
+        return np.asarray(indicator.T @ values.T).T
+
+    if percent is None and operation == 'SUM':
+        return _sum(data)
+    if percent is None and operation == 'MEAN':
+        return _sum(data) / counts
+    if percent is None and operation == 'COUNT_NONZERO':
+        return _sum((data != 0).astype(np.float64))
+    if percent is None and operation == 'L2NORM':
+        return np.sqrt(_sum(np.square(data)))
+    if percent is None and operation in ['STDEV', 'SAMPSTDEV', 'VARIANCE', 'TSNR', 'COV']:
+        # shift by the per-map mean so sum of squares does not cancel badly
+        shift = data.mean(axis=1, keepdims=True)
+        shifted = data - shift
+        s1 = _sum(shifted)
+        ss = np.maximum(_sum(np.square(shifted)) - s1 ** 2 / counts, 0)
+        mean = s1 / counts + shift
+        if operation == 'VARIANCE':
+            return ss / counts
+        if operation == 'STDEV':
+            return np.sqrt(ss / counts)
+        sampstdev = np.sqrt(ss / (counts - 1))
+        if operation == 'TSNR':
+            return mean / sampstdev
+        if operation == 'COV':
+            return sampstdev / mean
+        return sampstdev
+
+    out = np.empty((data.shape[0], indicator.shape[1]))
+    for j in range(indicator.shape[1]):
+        values = data[:, indicator.indices[indicator.indptr[j]:indicator.indptr[j + 1]]]
+        if percent is not None:
+            out[:, j] = percentile(values, percent, axis=1)
+        else:
+            out[:, j] = reduce(values, operation, axis=1)
+    return out
+
+
+# operations RoiReducer can accumulate over blocks of brainordinates
+ROI_STREAMING_OPERATIONS = ['SUM', 'MEAN', 'COUNT_NONZERO', 'L2NORM', 'STDEV', 'SAMPSTDEV',
+                            'VARIANCE', 'TSNR', 'COV']
+
+
+class RoiReducer(object):
+    """
+    reduce_rois() over consecutive blocks of brainordinates.
+
+    Each ``update(start, stop, block)`` takes the (maps, stop - start) block
+    of brainordinates start:stop; ``result()`` gives the (maps, rois) array
+    reduce_rois() would give on the whole matrix. Cifti stores the maps of a
+    brainordinate together, so these blocks are contiguous reads of the file.
+    Moments are kept per roi as count/mean/M2 and merged with Chan's update.
+    """
+
+    def __init__(self, indicator, operation):
+        from scipy import sparse
+
+        if operation not in ROI_STREAMING_OPERATIONS:
+            raise ValueError('{} cannot be computed over blocks of brainordinates'.format(
+                operation))
+        self.indicator = sparse.csr_matrix(indicator)
+        self.operation = operation
+        counts = np.diff(sparse.csc_matrix(self.indicator).indptr)
+        if np.any(counts == 0):
+            raise ValueError('roi {} is empty'.format(int(np.flatnonzero(counts == 0)[0]) + 1))
+        if operation in ['SAMPSTDEV', 'TSNR', 'COV'] and np.any(counts < 2):
+            raise ValueError('{} requires at least 2 values in every roi'.format(operation))
+        self.count = np.zeros(self.indicator.shape[1])
+        self.value = self.mean = self.m2 = None
+
+    def update(self, start, stop, block):
+        block = np.asarray(block, dtype=np.float64)
+        part = self.indicator[start:stop]
+        n = np.asarray(part.sum(axis=0)).ravel()
+        op = self.operation
+        if op in _MOMENT_OPERATIONS:
+            # shift by the per-map mean so the sum of squares does not cancel badly
+            shift = block.mean(axis=1, keepdims=True)
+            shifted = block - shift
+            s1 = np.asarray(shifted @ part)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block_mean = np.where(n > 0, s1 / n, 0)
+                block_m2 = np.maximum(np.asarray(np.square(shifted) @ part) -
+                                      np.where(n > 0, s1 ** 2 / n, 0), 0)
+            block_mean = block_mean + np.where(n > 0, shift, 0)
+            if self.mean is None:
+                self.mean, self.m2 = block_mean, block_m2
+            else:
+                total = self.count + n
+                delta = block_mean - self.mean
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    self.mean = np.where(total > 0, self.mean + delta * n / total, 0)
+                    self.m2 = self.m2 + block_m2 + np.where(
+                        total > 0, delta ** 2 * self.count * n / total, 0)
+        else:
+            if op == 'COUNT_NONZERO':
+                block = (block != 0).astype(np.float64)
+            elif op == 'L2NORM':
+                block = np.square(block)
+            value = np.asarray(block @ part)
+            self.value = value if self.value is None else self.value + value
+        self.count = self.count + n
+
+    def result(self):
+        op = self.operation
+        count = self.count
+        if op in ['SUM', 'COUNT_NONZERO']:
+            return self.value
+        if op == 'MEAN':
+            return self.mean
+        if op == 'L2NORM':
+            return np.sqrt(self.value)
+        if op == 'VARIANCE':
+            return self.m2 / count
+        if op == 'STDEV':
+            return np.sqrt(self.m2 / count)
+        sampstdev = np.sqrt(self.m2 / (count - 1))
+        if op == 'TSNR':
+            return self.mean / sampstdev
+        if op == 'COV':
+            return sampstdev / self.mean
+        return sampstdev
+
+
+def outlier_mask(data, sigma_below, sigma_above, axis=-1, mask=None):
+    """
+    True where a value lies within [mean - sigma_below * stdev, mean + sigma_above * stdev]
+    of its line along ``axis`` (population stdev, over values already in ``mask``).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if mask is None:
+        mask = np.ones(data.shape, dtype=bool)
+    count = mask.sum(axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(mask, data, 0).sum(axis=axis, keepdims=True) / count
+        stdev = np.sqrt(np.where(mask, (data - mean) ** 2, 0).sum(axis=axis, keepdims=True) / count)
+        return mask & (data >= mean - sigma_below * stdev) & (data <= mean + sigma_above * stdev)
+
+
+def reduce_masked(data, mask, operation, axis=-1):
+    """
+    reduce() over only the values where ``mask`` is True, line by line.
+    INDEXMAX/INDEXMIN still report positions in the unmasked line.
+    """
+    data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, -1)
+    mask = np.moveaxis(mask, axis, -1)
+    if mask.all():
+        return reduce(data, operation, axis=-1)
+    if operation in ['INDEXMAX', 'INDEXMIN']:
+        fill = -np.inf if operation == 'INDEXMAX' else np.inf
+        return reduce(np.where(mask, data, fill), operation, axis=-1)
+    out = np.empty(data.shape[:-1])
+    for idx in np.ndindex(*data.shape[:-1]):
+        out[idx] = reduce(data[idx][mask[idx]], operation)
+    return out
+
+
+# operations StreamingReducer can accumulate without holding a whole line
+STREAMING_OPERATIONS = ['MAX', 'MIN', 'INDEXMAX', 'INDEXMIN', 'SUM', 'PRODUCT', 'MEAN',
+                        'STDEV', 'SAMPSTDEV', 'VARIANCE', 'TSNR', 'COV', 'L2NORM',
+                        'COUNT_NONZERO']
+
+_MOMENT_OPERATIONS = ['MEAN', 'STDEV', 'SAMPSTDEV', 'VARIANCE', 'TSNR', 'COV']
+
+
+class StreamingReducer(object):
+    """
+    One-pass reduction over consecutive blocks of the reduced axis.
+
+    Each ``update(block, mask)`` takes a (n, ...) block holding the next n
+    values of every line; ``result()`` gives the same numbers reduce() would
+    give on the concatenated blocks. Moments are merged with Welford/Chan
+    updates so no sums of squares are formed. Lines with no values come out
+    as NaN.
+    """
+
+    def __init__(self, operation):
+        if operation not in STREAMING_OPERATIONS:
+            raise ValueError('{} cannot be computed in one pass'.format(operation))
+        self.operation = operation
+        self.count = None
+        self.offset = 0
+
+    def update(self, block, mask=None):
+        block = np.asarray(block, dtype=np.float64)
+        if mask is None:
+            mask = np.ones(block.shape, dtype=bool)
+        n = mask.sum(axis=0)
+        op = self.operation
+        if self.count is None:
+            self.count = np.zeros(block.shape[1:])
+            if op in _MOMENT_OPERATIONS:
+                self.mean = np.zeros(block.shape[1:])
+                self.m2 = np.zeros(block.shape[1:])
+            elif op in ['MAX', 'INDEXMAX']:
+                self.value = np.full(block.shape[1:], -np.inf)
+                self.index = np.zeros(block.shape[1:])
+            elif op in ['MIN', 'INDEXMIN']:
+                self.value = np.full(block.shape[1:], np.inf)
+                self.index = np.zeros(block.shape[1:])
+            elif op == 'PRODUCT':
+                self.value = np.ones(block.shape[1:])
+            else:
+                self.value = np.zeros(block.shape[1:])
+
+        if op in _MOMENT_OPERATIONS:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block_mean = np.where(n > 0, np.where(mask, block, 0).sum(axis=0) / n, 0)
+            block_m2 = np.where(mask, (block - block_mean) ** 2, 0).sum(axis=0)
+            total = self.count + n
+            delta = block_mean - self.mean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.mean = np.where(total > 0, self.mean + delta * n / total, 0)
+                self.m2 = self.m2 + block_m2 + np.where(
+                    total > 0, delta ** 2 * self.count * n / total, 0)
+        elif op in ['MAX', 'INDEXMAX', 'MIN', 'INDEXMIN']:
+            pick = np.argmax if op in ['MAX', 'INDEXMAX'] else np.argmin
+            fill = -np.inf if op in ['MAX', 'INDEXMAX'] else np.inf
+            masked = np.where(mask, block, fill)
+            where = pick(masked, axis=0)
+            best = np.take_along_axis(masked, where[None], axis=0)[0]
+            # strict comparison keeps the first occurrence, like argmax
+            better = (best > self.value) if fill < 0 else (best < self.value)
+            better &= n > 0
+            self.value = np.where(better, best, self.value)
+            self.index = np.where(better, where + self.offset, self.index)
+        elif op == 'SUM':
+            self.value += np.where(mask, block, 0).sum(axis=0)
+        elif op == 'L2NORM':
+            self.value += np.where(mask, block ** 2, 0).sum(axis=0)
+        elif op == 'PRODUCT':
+            self.value *= np.where(mask, block, 1).prod(axis=0)
+        elif op == 'COUNT_NONZERO':
+            self.value += (mask & (block != 0)).sum(axis=0)
+        self.count = self.count + n
+        self.offset += block.shape[0]
+
+    def result(self):
+        op = self.operation
+        count = self.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if op in _MOMENT_OPERATIONS:
+                if op == 'MEAN':
+                    out = self.mean
+                elif op == 'STDEV':
+                    out = np.sqrt(self.m2 / count)
+                elif op == 'VARIANCE':
+                    out = self.m2 / count
+                else:
+                    sampstdev = np.sqrt(self.m2 / (count - 1))
+                    out = {'SAMPSTDEV': sampstdev,
+                           'TSNR': self.mean / sampstdev,
+                           'COV': sampstdev / self.mean}[op]
+            elif op in ['INDEXMAX', 'INDEXMIN']:
+                out = self.index + 1.0
+            elif op == 'L2NORM':
+                out = np.sqrt(self.value)
+            else:
+                out = self.value
+        return np.where(count > 0, out, np.nan)
@@ -0,0 +1,211 @@
+# Sparse resampling matrices between registered spheres, as used by
+# wb_command -metric-resample / -label-resample.
+# Developer Notes:
+# For a fixed sphere pair, method, area correction and roi the resampling is a
+# (new vertices, current vertices) matrix whose rows sum to 1 (rows of vertices
+# that get no valid data are empty). Matrices are cached by the content of every
+# file involved, so e.g. fsaverage -> fsLR is only worked out once. Metrics are
+# resampled with a sparse product, labels by summing the weights per label key.
+# ADAP_BARY_AREA follows wb's adaptive scheme: each new vertex takes the
+# barycentric weights from the current mesh unless more current vertices land
+# on it through the reverse (current -> new) barycentric weights, as happens
+# when downsampling. Weights are then scaled by the current vertex areas.
+
+import numpy as np
+
+
+def _unit(coords):
+    coords = np.asarray(coords, dtype=np.float64)
+    return coords / np.linalg.norm(coords, axis=1, keepdims=True)
+
+
+def _vertex_triangles(triangles, n_vertices):
+    # (vertices, max valence) triangles around each vertex, padded with -1
+    corners = np.ravel(triangles)
+    owner = np.repeat(np.arange(len(triangles)), 3)
+    order = np.argsort(corners, kind='stable')
+    counts = np.bincount(corners, minlength=n_vertices)
+    out = np.full((n_vertices, max(counts.max(), 1)), -1)
+    slot = np.arange(len(corners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    out[corners[order], slot] = owner[order]
+    return out
+
+
+def _barycentric(points, a, b, c):
+    # coordinates of the projection (along the ray from the centre) of unit
+    # ``points`` onto the planes of triangles abc
+    normal = np.cross(b - a, c - a)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.einsum('...j,...j->...', normal, a) / np.einsum('...j,...j->...', normal, points)
+        q = points * scale[..., None]
+        v0, v1, v2 = b - a, c - a, q - a
+        d00 = np.einsum('...j,...j->...', v0, v0)
+        d01 = np.einsum('...j,...j->...', v0, v1)
+        d11 = np.einsum('...j,...j->...', v1, v1)
+        d20 = np.einsum('...j,...j->...', v2, v0)
+        d21 = np.einsum('...j,...j->...', v2, v1)
+        denom = d00 * d11 - d01 * d01
+        wb = (d11 * d20 - d01 * d21) / denom
+        wc = (d00 * d21 - d01 * d20) / denom
+    weights = np.stack([1 - wb - wc, wb, wc], axis=-1)
+    # triangles facing away from the point are never a match
+    return np.where((scale > 0)[..., None], weights, -np.inf)
+
+
+def barycentric_weights(current_coords, current_triangles, new_coords, k=8):
+    """
+    Sparse (new vertices, current vertices) matrix of the barycentric weights
+    of the current-mesh triangle that contains each new vertex. Candidate
+    triangles are those around the ``k`` nearest current vertices (KD-tree);
+    a point that falls in none of them uses the closest candidate, clamped.
+    """
+    from scipy import sparse
+    from scipy.spatial import cKDTree
+
+    current, new = _unit(current_coords), _unit(new_coords)
+    triangles = np.asarray(current_triangles)
+    around = _vertex_triangles(triangles, len(current))
+    _, nearest = cKDTree(current).query(new, k=k)
+    candidates = around[nearest].reshape(len(new), -1)
+    safe = np.maximum(candidates, 0)
+    corners = triangles[safe]
+    weights = _barycentric(new[:, None, :], current[corners[..., 0]], current[corners[..., 1]],
+                           current[corners[..., 2]])
+    worst = np.where(candidates >= 0, np.nan_to_num(weights.min(axis=-1), nan=-np.inf), -np.inf)
+    best = worst.argmax(axis=1)
+    rows = np.arange(len(new))
+    chosen = np.clip(np.nan_to_num(weights[rows, best], nan=0, neginf=0), 0, None)
+    chosen /= np.maximum(chosen.sum(axis=1, keepdims=True), 1e-300)
+    return sparse.csr_matrix((chosen.ravel(), (np.repeat(rows, 3), corners[rows, best].ravel())),
+                             shape=(len(new), len(current)))
+
+
+def resampling_matrix(current_sphere, new_sphere, method, current_area=None, new_area=None,
+                      area_kind=None, roi_file=None):
+    """
+    Cached resampling matrix from ``current_sphere`` to ``new_sphere``.
+
+    ``method`` is 'BARYCENTRIC' or 'ADAP_BARY_AREA'. For ADAP_BARY_AREA,
+    ``area_kind`` is 'surfs' (``current_area``/``new_area`` are anatomical
+    surfaces) or 'metrics' (they are vertex area metrics). The new vertex
+    areas only scale whole rows, which the normalization undoes, so
+    ``new_area`` does not enter the matrix or its cache key. Current vertices
+    outside ``roi_file`` (a metric, > 0 is inside) get no weight. Returns a
+    CSR matrix with rows normalized to sum to 1 or empty.
+    """
+    from scipy import sparse
+    from . import cache
+    from .geometry import load_geometry
+    from .gifti_io import load_metric
+
+    def _hash(filename):
+        return None if filename is None else cache.file_hash(filename)
+
+    def _build():
+        current, new = load_geometry(current_sphere), load_geometry(new_sphere)
+        forward = barycentric_weights(current['coords'], current['triangles'], new['coords'])
+        if method == 'ADAP_BARY_AREA':
+            if area_kind == 'surfs':
+                areas = np.asarray(load_geometry(current_area)['areas'])
+            elif area_kind == 'metrics':
+                areas = load_metric(current_area)[1][0].astype(np.float64)
+            else:
+                raise ValueError('ADAP_BARY_AREA needs area surfaces or area metrics')
+            if len(areas) != len(current['coords']):
+                raise ValueError('{} does not match the vertices of {}'.format(
+                    current_area, current_sphere))
+            reverse = barycentric_weights(new['coords'], new['triangles'],
+                                          current['coords']).T.tocsr()
+            use_reverse = np.diff(reverse.indptr) > np.diff(forward.indptr)
+            weights = (sparse.diags((~use_reverse).astype(np.float64)) @ forward +
+                       sparse.diags(use_reverse.astype(np.float64)) @ reverse)
+            weights = weights @ sparse.diags(areas)
+        else:
+            weights = forward
+        if roi_file is not None:
+            roi = load_metric(roi_file)[1][0] > 0
+            weights = weights @ sparse.diags(roi.astype(np.float64))
+        weights = sparse.csr_matrix(weights)
+        weights.eliminate_zeros()
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weights = sparse.diags(np.where(total > 0, 1 / total, 0)) @ weights
+        weights = sparse.csr_matrix(weights)
+        return dict(data=weights.data, indices=weights.indices, indptr=weights.indptr,
+                    shape=np.array(weights.shape))
+
+    key = cache.hash_key('resampling-matrix-v1', _hash(current_sphere), _hash(new_sphere),
+                         method, area_kind if method == 'ADAP_BARY_AREA' else None,
+                         _hash(current_area) if method == 'ADAP_BARY_AREA' else None,
+                         _hash(roi_file))
+    entry = cache.load_or_build('resampling_matrix', key, _build)
+    return sparse.csr_matrix((entry['data'], entry['indices'], entry['indptr']),
+                             shape=tuple(entry['shape']))
+
+
+def _largest(matrix):
+    # column of the largest weight in every row, -1 for empty rows
+    out = np.full(matrix.shape[0], -1)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    if not len(rows):
+        return out
+    order = np.lexsort((-matrix.data, rows))
+    first = order[np.concatenate([[True], rows[order][1:] != rows[order][:-1]])]
+    out[rows[first]] = matrix.indices[first]
+    return out
+
+
+def valid_rows(matrix):
+    """True for new vertices that get data from at least one current vertex."""
+    return np.diff(matrix.indptr) > 0
+
+
+def resample_metric(matrix, data, largest=False):
+    """
+    Resample (columns, vertices) ``data`` with a resampling_matrix(); vertices
+    without data become 0.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    if largest:
+        source = _largest(matrix)
+        return np.where(source >= 0, data[:, np.maximum(source, 0)], 0)
+    return np.asarray(matrix @ data.T).T
+
+
+def resample_labels(matrix, keys, largest=False, unlabeled=0):
+    """
+    Resample (columns, vertices) integer label ``keys``: every new vertex gets
+    the key with the largest summed weight (or, with ``largest``, the key of
+    the single largest weight). Vertices without data get ``unlabeled``.
+    """
+    from scipy import sparse
+
+    keys = np.atleast_2d(np.asarray(keys))
+    if largest:
+        source = _largest(matrix)
+        return np.where(source >= 0, keys[:, np.maximum(source, 0)], unlabeled)
+    out = np.full((keys.shape[0], matrix.shape[0]), unlabeled, dtype=keys.dtype)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    for i, column in enumerate(keys):
+        values, codes = np.unique(column, return_inverse=True)
+        # (new vertices, label values) summed weights
+        votes = sparse.csr_matrix((matrix.data, (rows, codes[matrix.indices])),
+                                  shape=(matrix.shape[0], len(values)))
+        winner = np.asarray(votes.argmax(axis=1)).ravel()
+        valid = valid_rows(matrix)
+        out[i, valid] = values[winner[valid]]
+    return out
+
+
+def matrix_for_inputs(inputs):
+    """resampling_matrix() for the inputs of LabelResample/MetricResample."""
+    from nipype.interfaces.base import isdefined
+
+    def _get(name):
+        value = getattr(inputs, name)
+        return value if isdefined(value) else None
+
+    area_kind = 'surfs' if inputs.area_surfs else 'metrics' if inputs.area_metrics else None
+    return resampling_matrix(inputs.current_sphere, inputs.new_sphere, inputs.method,
+                             _get('current_area'), _get('new_area'), area_kind,
+                             _get('roi_metric'))
@@ -0,0 +1,145 @@
+# Scheduler resource hints for the interfaces.
+# Developer Notes:
+# MultiProc packs nodes by their mem_gb and n_procs, which default to a flat
+# 0.2 GB and 1 thread. For wb_command the memory is dominated by the data
+# it holds, brainordinates x maps x bytes per value of its inputs, times a
+# few copies (the input, the output and intermediates). All of that is in the
+# file headers, so it can be estimated before the node runs without reading
+# any data. n_procs follows the num_threads input (see base.py).
+
+import os
+
+import numpy as np
+
+try:
+    from nipype.utils.ram_estimator import RamEstimator
+except ImportError:
+    # nipype < 1.11 has no Node.ram_estimator, use resource_hints() there
+    RamEstimator = object
+
+# copies of the input data an interface holds at once, by class name.
+# Everything else is assumed to hold its inputs and one output.
+MEMORY_FACTORS = {
+    'CiftiSmoothing': 4.0,
+    'MetricDilate': 3.0,
+    'MetricResample': 3.0,
+    'LabelResample': 3.0,
+    'Average': 3.0,
+    'CiftiMath': 3.0,
+    'MetricMath': 3.0,
+    'VolumeMath': 3.0,
+}
+DEFAULT_FACTOR = 2.0
+OVERHEAD_GB = 0.3
+
+
+def _gifti_bytes(filename):
+    # from the DataArray attributes alone, loading a gifti decodes all of its data
+    import mmap
+    import re
+    from nibabel.nifti1 import data_type_codes
+
+    total = 0
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for tag in re.finditer(rb'<DataArray\b([^>]*)>', mm):
+            attributes = {k.decode(): v.decode()
+                          for k, v in re.findall(rb'(\w+)\s*=\s*"([^"]*)"', tag.group(1))}
+            dims = [int(attributes['Dim{}'.format(i)])
+                    for i in range(int(attributes.get('Dimensionality', 1)))]
+            itemsize = np.dtype(data_type_codes.dtype[attributes['DataType']]).itemsize
+            total += int(np.prod(dims, dtype=np.int64)) * itemsize
+    return total
+
+
+def file_bytes(filename):
+    """Bytes of data in ``filename`` according to its header (its size for non-images)."""
+    import nibabel as nib
+
+    if filename.endswith('.gii'):
+        try:
+            return _gifti_bytes(filename)
+        except (OSError, ValueError, KeyError):
+            return os.path.getsize(filename)
+    try:
+        img = nib.load(filename)
+    except Exception:
+        return os.path.getsize(filename)
+    return int(np.prod(img.shape, dtype=np.int64)) * img.get_data_dtype().itemsize
+
+
+def _files(value):
+    # existing files among a trait value, including those in e.g. 'x.nii -select 1 2'
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [f for v in value for f in _files(v)]
+    if isinstance(value, str):
+        if os.path.isfile(value):
+            return [value]
+        return [t for t in value.split() if os.path.isfile(t)]
+    return []
+
+
+def input_bytes(inputs):
+    """Data bytes of every existing input file of an interface's ``inputs``."""
+    from nipype.interfaces.base import isdefined
+
+    traits = inputs.traits()
+    total = 0
+    for name, value in inputs.get_traitsfree().items():
+        trait = traits[name]
+        # outputs written where inputs are given do not count
+        if trait.genfile or trait.name_source is not None or not isdefined(value):
+            continue
+        total += sum(file_bytes(f) for f in _files(value))
+    return total
+
+
+class WBRamEstimator(RamEstimator):
+    """
+    Node.ram_estimator for the interfaces of this package::
+
+        node = Node(CiftiSmoothing(num_threads=4), name='smooth')
+        node.ram_estimator = WBRamEstimator.for_interface(node.interface)
+
+    Estimates the memory as ``factor`` times the data in the input files,
+    plus ``overhead_gb``, bounded by ``min_gb`` and ``max_gb``.
+    """
+
+    def __init__(self, factor=DEFAULT_FACTOR, overhead_gb=OVERHEAD_GB, min_gb=0.2, max_gb=None):
+        self.factor = factor
+        self.overhead_gb = overhead_gb
+        self.min_gb = min_gb
+        self.max_gb = max_gb
+
+    @classmethod
+    def for_interface(cls, interface, **kwargs):
+        # subclasses (e.g. with the result store mixed in) use their base's factor
+        factor = DEFAULT_FACTOR
+        for base in interface.__class__.__mro__:
+            if base.__name__ in MEMORY_FACTORS:
+                factor = MEMORY_FACTORS[base.__name__]
+                break
+        return cls(factor=factor, **kwargs)
+
+    def __call__(self, inputs):
+        data_gb = input_bytes(inputs) / 2 ** 30
+        mem_gb = max(self.factor * data_gb + self.overhead_gb, self.min_gb)
+        if self.max_gb is not None:
+            mem_gb = min(mem_gb, self.max_gb)
+        return mem_gb, 'input data {:.3f} GB x {} + {} GB overhead'.format(
+            data_gb, self.factor, self.overhead_gb)
+
+
+def resource_hints(interface):
+    """
+    dict(mem_gb=..., n_procs=...) for an interface whose inputs are already
+    set, e.g. ``Node(interface, name='x', **resource_hints(interface))``.
+    """
+    from nipype.interfaces.base import isdefined
+
+    mem_gb, _ = WBRamEstimator.for_interface(interface)(interface.inputs)
+    n_procs = 1
+    if hasattr(interface.inputs, 'num_threads') and isdefined(interface.inputs.num_threads):
+        n_procs = interface.inputs.num_threads
+    return dict(mem_gb=mem_gb, n_procs=n_procs)
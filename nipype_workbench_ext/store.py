@@ -0,0 +1,320 @@
+# Package-wide, content-addressed store of interface results.
+# Developer Notes:
+# Nipype only reuses a result when the same node runs again in the same working
+# directory. Interfaces that opt in here (by subclassing ResultStoreMixin before
+# the interface, or with the @stored_results class decorator) look their
+# result up by a key made of the interface's _cmd, every hashed trait value, the
+# content (not the path) of every input file and the wb_command version, so
+# the same call is served from the store no matter which workflow or node it
+# comes from.
+# An entry is a directory holding the output files, the stdout/stderr of the
+# run and a manifest mapping each output trait (and list position) to a file.
+# Files go into the store as reflinks or copies, never as hardlinks of the
+# working-directory file, since a later run may rewrite that file in place.
+# They are served as reflinks or copies, or as hardlinks with
+# $NIPYPE_WB_STORE_LINK=hardlink, in which case store files are read-only so
+# that writing to a served file fails instead of corrupting the store.
+# Where outputs are written is left out of the key, but their format (the
+# extension, e.g. .nii vs .nii.gz, .npy vs .tsv) is not. Interfaces that read
+# files not named by an input trait (CiftiMerge with append reads out_file)
+# list them in _extra_input_files().
+# Entries are evicted least recently used first (a hit touches the manifest)
+# once the store is above its budget, $NIPYPE_WB_STORE_MB (0 disables the
+# store). Each process keeps a running total of the store's size and only
+# rescans it when that total passes the budget or every few minutes, so the
+# store can briefly exceed its budget by what other processes added in the
+# meantime. Interfaces whose result depends on more than their inputs (e.g.
+# Average with a state_dir) must not opt in.
+
+import json
+import os
+import shutil
+
+from nipype import logging
+
+from . import cache
+
+iflogger = logging.getLogger('nipype.interface')
+
+_VERSION = 'result-store-v1'
+_DEFAULT_BUDGET_MB = 20480
+_FICLONE = 0x40049409
+_RESCAN_SECONDS = 300
+_wb_versions = dict()
+# store path -> [estimated size in bytes, time of the last scan]
+_sizes = dict()
+
+
+def store_dir():
+    """Directory of the result store ($NIPYPE_WB_STORE_DIR or cache_dir()/results)."""
+    return os.environ.get('NIPYPE_WB_STORE_DIR', os.path.join(cache.cache_dir(), 'results'))
+
+
+def budget_bytes():
+    """Disk budget of the store, from $NIPYPE_WB_STORE_MB."""
+    return int(float(os.environ.get('NIPYPE_WB_STORE_MB', _DEFAULT_BUDGET_MB)) * 2 ** 20)
+
+
+def _reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def place(src, dst, hardlink=False):
+    """
+    Make ``dst`` a file with the content of ``src``: a hardlink (if asked for
+    and possible), else a reflink (copy-on-write filesystems), else a copy.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    try:
+        _reflink(src, dst)
+        return
+    except (OSError, ImportError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copyfile(src, dst)
+
+
+def _hash_value(value):
+    # trait values with every existing file replaced by the hash of its content
+    import shlex
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hash_value(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hash_value(v) for v in value)
+    if isinstance(value, str):
+        if os.path.isfile(value):
+            return ('file', cache.file_hash(value))
+        if ' ' in value:
+            # e.g. CiftiMath variables, 'file.dscalar.nii -select 1 2'
+            try:
+                tokens = shlex.split(value)
+            except ValueError:
+                return value
+            if any(os.path.isfile(t) for t in tokens):
+                return ('tokens', tuple(_hash_value(t) for t in tokens))
+    return value
+
+
+def _wb_version(interface):
+    # PackageInfo retries the version command on every call when wb_command is missing
+    cls = interface.__class__
+    if cls not in _wb_versions:
+        try:
+            _wb_versions[cls] = interface.version
+        except Exception:
+            _wb_versions[cls] = None
+    return _wb_versions[cls]
+
+
+def _file_format(path):
+    # '.dscalar.nii', '.func.gii', '.nii.gz', '.npy', ... of an output path
+    name = os.path.basename(path).lower()
+    stem, ext = os.path.splitext(name)
+    if ext == '.gz':
+        stem, inner = os.path.splitext(stem)
+        ext = inner + ext
+    if ext in ('.nii', '.gii'):
+        stem, kind = os.path.splitext(stem)
+        if kind[1:].isalpha():
+            ext = kind + ext
+    return ext
+
+
+def result_key(interface):
+    """Content-addressed key of the result of running ``interface`` as it is set up."""
+    traits = interface.inputs.traits()
+    values = []
+    for name, value in sorted(interface.inputs.get_traitsfree().items()):
+        trait = traits[name]
+        # where outputs are written does not change what they contain, their format does,
+        # and nohash traits (num_threads, environ) are left out as nipype's own hash does
+        if trait.genfile or trait.name_source is not None or trait.nohash:
+            continue
+        values.append((name, _hash_value(value)))
+    formats = tuple((name, index, _file_format(path))
+                    for name, index, path in _output_files(interface._list_outputs()))
+    extra = getattr(interface, '_extra_input_files', None)
+    extra = tuple(('file', cache.file_hash(f)) for f in extra()) if extra else ()
+    return cache.hash_key(_VERSION, interface.__class__.__module__,
+                          interface.__class__.__name__, getattr(interface, '_cmd', None),
+                          _wb_version(interface), tuple(values), formats, extra)
+
+
+def _output_files(outputs):
+    # [(output name, list position or None, path)] of the files among ``outputs``
+    files = []
+    for name, value in sorted((outputs or {}).items()):
+        if isinstance(value, (list, tuple)):
+            files += [(name, i, v) for i, v in enumerate(value) if isinstance(v, str)]
+        elif isinstance(value, str):
+            files.append((name, None, value))
+    return files
+
+
+class ResultStore(object):
+    """The on-disk store under ``path`` with a budget of ``budget`` bytes."""
+
+    def __init__(self, path=None, budget=None):
+        self.path = path or store_dir()
+        self.budget = budget_bytes() if budget is None else budget
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key, outputs, hardlink=False):
+        """
+        Place the stored files of ``key`` at the paths in ``outputs`` (the
+        interface's _list_outputs()). Returns the stored (stdout, stderr), or
+        None if there is no complete entry for these outputs.
+        """
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        stored = {(name, index): filename for name, index, filename in manifest['files']}
+        wanted = [f for f in _output_files(outputs) if (f[0], f[1]) in stored]
+        if len(wanted) != len(stored):
+            return None
+        try:
+            for name, index, path in wanted:
+                place(os.path.join(entry, stored[(name, index)]), path, hardlink)
+        except OSError:
+            return None
+        # least recently used is least recently touched
+        os.utime(os.path.join(entry, 'manifest.json'))
+        return manifest['stdout'], manifest['stderr']
+
+    def put(self, key, outputs, stdout='', stderr='', hardlink=False):
+        """Store the existing files among ``outputs`` under ``key``."""
+        import tempfile
+
+        if self.budget <= 0:
+            return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=os.path.dirname(entry))
+        files = []
+        try:
+            for i, (name, index, path) in enumerate(_output_files(outputs)):
+                if not os.path.isfile(path):
+                    continue
+                filename = '{:04d}_{}'.format(i, os.path.basename(path))
+                place(path, os.path.join(tmp, filename))
+                if hardlink:
+                    os.chmod(os.path.join(tmp, filename), 0o444)
+                files.append((name, index, filename))
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump(dict(files=files, stdout=stdout or '', stderr=stderr or ''), f)
+            size = sum(os.stat(os.path.join(tmp, name)).st_size for name in os.listdir(tmp))
+            os.rename(tmp, entry)
+        except OSError:
+            # another process stored the same result first, or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self._grow(size)
+
+    def _grow(self, size):
+        # add size to the running total, scanning the store only when needed
+        import time
+
+        known = _sizes.get(self.path)
+        if known is None or time.time() - known[1] > _RESCAN_SECONDS:
+            self.evict()
+            return
+        known[0] += size
+        if known[0] > self.budget:
+            self.evict()
+
+    def entries(self):
+        """[(last used, size in bytes, path)] of every complete entry."""
+        out = []
+        if not os.path.isdir(self.path):
+            return out
+        for prefix in os.listdir(self.path):
+            directory = os.path.join(self.path, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                entry = os.path.join(directory, key)
+                try:
+                    used = os.stat(os.path.join(entry, 'manifest.json')).st_mtime
+                    size = sum(os.stat(os.path.join(entry, name)).st_size
+                               for name in os.listdir(entry))
+                except OSError:
+                    continue
+                out.append((used, size, entry))
+        return out
+
+    def evict(self):
+        """Remove least recently used entries until the store fits its budget."""
+        import time
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.budget:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        _sizes[self.path] = [total, time.time()]
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        _sizes.pop(self.path, None)
+
+
+class ResultStoreMixin(object):
+    """
+    Serve the results of a WBCommand from the package-wide ResultStore.
+
+    Mix in before the interface class, e.g.
+    ``class StoredSmoothing(ResultStoreMixin, CiftiSmoothing): pass``.
+    Results are stored after every successful run and placed at the paths
+    ``_list_outputs`` gives when the same inputs come up again.
+    """
+
+    def _run_interface(self, runtime):
+        store = ResultStore()
+        if store.budget <= 0:
+            return super()._run_interface(runtime)
+        hardlink = os.environ.get('NIPYPE_WB_STORE_LINK') == 'hardlink'
+        key = result_key(self)
+        hit = store.fetch(key, self._list_outputs(), hardlink)
+        if hit is not None:
+            iflogger.info('%s: using stored result %s', self.__class__.__name__, key)
+            runtime.stdout, runtime.stderr = hit
+            runtime.returncode = 0
+            return runtime
+        runtime = super()._run_interface(runtime)
+        if not runtime.returncode:
+            store.put(key, self._list_outputs(), getattr(runtime, 'stdout', ''),
+                      getattr(runtime, 'stderr', ''), hardlink)
+        return runtime
+
+
+def stored_results(cls):
+    """
+    Class decorator opting a WBCommand subclass into the result store::
+
+        @stored_results
+        class StoredParcellate(Parcellate):
+            pass
+    """
+    return type(cls.__name__, (ResultStoreMixin, cls),
+                {'__module__': cls.__module__, '__qualname__': cls.__qualname__,
+                 '__doc__': cls.__doc__})
@@ -1,4 +1,3 @@
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     BaseInterface, 
     BaseInterfaceInputSpec, 
@@ -11,7 +10,13 @@ from nipype.interfaces.base import (
 from traits.api import List
 import os
 
-class SurfaceVertexAreasInputSpec(CommandLineInputSpec):
+from .base import WBEngineInputSpec, WBEngineCommand
+
+# engine='numpy' computes the areas in-process (a third of each triangle's
+# area goes to each of its vertices) and keeps the resulting metric in the
+# cache keyed by the surface's content, so a template surface is only
+# measured once.
+class SurfaceVertexAreasInputSpec(WBEngineInputSpec):
     surface=File(
         argstr='%s',
         position=0,
@@ -31,12 +36,29 @@ class SurfaceVertexAreasOutputSpec(TraitedSpec):
         desc="The output metric file"
     )
 
-class SurfaceVertexAreas(wb.WBCommand):
+class SurfaceVertexAreas(WBEngineCommand):
     input_spec = SurfaceVertexAreasInputSpec
     output_spec = SurfaceVertexAreasOutputSpec
 
     _cmd = 'wb_command -surface-vertex-areas'
 
+    def _run_numpy(self, runtime):
+        import shutil
+        import nibabel as nib
+        from . import cache
+        from .geometry import load_geometry
+        from .gifti_io import save_metric, structure_meta
+
+        def _build(path):
+            geometry = load_geometry(self.inputs.surface)
+            save_metric(geometry['areas'][None], path,
+                        meta=structure_meta(nib.load(self.inputs.surface)))
+
+        key = cache.hash_key('vertex-areas-v1', cache.file_hash(self.inputs.surface))
+        shutil.copyfile(cache.cached_file('vertex_areas', key, '.func.gii', _build),
+                        self._gen_filename('out_file'))
+        return runtime
+
     def _gen_filename(self, name):
         import os
 
@@ -53,7 +75,12 @@ class SurfaceVertexAreas(wb.WBCommand):
         return outputs
 
 
-class SurfaceDistortionInputSpec(CommandLineInputSpec):
+# engine='numpy' implements every method with vectorized numpy over triangles
+# and edges, and applies -smooth with a geodesic kernel cached per surface (the
+# reference surface's kernel also on disk). A list of distorted surfaces is
+# compared against the reference in one in-process run that reads the
+# reference once, with one output per distorted surface in out_files.
+class SurfaceDistortionInputSpec(WBEngineInputSpec):
     surface_reference=File(
         argstr='%s',
         position=0,
@@ -61,11 +88,13 @@ class SurfaceDistortionInputSpec(CommandLineInputSpec):
         desc="the reference surface"
     )
 
-    surface_distorted=File(
+    surface_distorted=traits.Either(
+        File(exists=True),
+        traits.List(File(exists=True)),
         argstr='%s',
         position=1,
-        exists=True,
-        desc="the distorted surface"
+        desc="the distorted surface. A list of surfaces is compared against "
+             "surface_reference in one in-process run, writing out_files"
     )
 
     out_file=File(
@@ -120,12 +149,118 @@ class SurfaceDistortionOutputSpec(TraitedSpec):
         desc="The output metric file"
     )
 
-class SurfaceDistortionAreas(wb.WBCommand):
+    out_files=traits.List(File(exists=True),
+        desc="The output metric files, one per distorted surface (batch mode only)"
+    )
+
+class SurfaceDistortionAreas(WBEngineCommand):
     input_spec = SurfaceDistortionInputSpec
     output_spec = SurfaceDistortionOutputSpec
 
     _cmd = 'wb_command -surface-distortion'
 
+    def _batch(self):
+        return isinstance(self.inputs.surface_distorted, list)
+
+    def _use_numpy(self):
+        return super()._use_numpy() or self._batch()
+
+    def _check_mandatory_inputs(self):
+        super()._check_mandatory_inputs()
+        if self._batch() and isdefined(self.inputs.out_file):
+            raise ValueError('out_file cannot be set with a list of distorted surfaces, '
+                             'their outputs are named after each surface')
+
+    def _sigma(self):
+        from .smoothing import fwhm_to_sigma
+
+        if not isdefined(self.inputs.smooth) or self.inputs.smooth <= 0:
+            return None
+        return fwhm_to_sigma(self.inputs.smooth) if self.inputs.fwhm else self.inputs.smooth
+
+    def _smooth(self, values, surface, use_disk):
+        from .smoothing import geodesic_kernel, apply_operator
+
+        sigma = self._sigma()
+        if sigma is None:
+            return values
+        kernel = geodesic_kernel(surface, sigma, area_weighted=False, use_disk=use_disk)
+        return apply_operator(kernel, values[:, None])[:, 0]
+
+    def _distortion(self, reference, distorted, distorted_file):
+        # (columns, vertices) distortion of one surface against the reference
+        import numpy as np
+        from .geometry import (triangle_areas, vertex_mean, local_affine_stretches, edges)
+
+        triangles = np.asarray(reference['triangles'])
+        n = len(reference['coords'])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.inputs.local_affine_method:
+                stretches = local_affine_stretches(reference['coords'], distorted['coords'],
+                                                   triangles)
+                columns = np.stack([stretches[:, 0] * stretches[:, 1],
+                                    stretches[:, 0] / stretches[:, 1]])
+                if self.inputs.log2:
+                    columns = np.log2(columns)
+                return np.stack([vertex_mean(c, triangles, n) for c in columns])
+            if self.inputs.edge_method:
+                first, second = edges(reference)
+                ref_coords = np.asarray(reference['coords'], dtype=np.float64)
+                dist_coords = np.asarray(distorted['coords'], dtype=np.float64)
+                ratio = np.abs(np.log2(
+                    np.linalg.norm(ref_coords[first] - ref_coords[second], axis=1) /
+                    np.linalg.norm(dist_coords[first] - dist_coords[second], axis=1)))
+                return (np.bincount(first, weights=ratio, minlength=n) /
+                        np.bincount(first, minlength=n))[None]
+            if self.inputs.caret5_method:
+                ratio = np.log2(triangle_areas(distorted['coords'], triangles) /
+                                self._reference_areas)
+                return self._smooth(vertex_mean(ratio, triangles, n),
+                                    self.inputs.surface_reference, True)[None]
+            if self._reference_vertex_areas is None:
+                self._reference_vertex_areas = self._smooth(
+                    np.asarray(reference['areas']), self.inputs.surface_reference, True)
+            ref_areas = self._reference_vertex_areas
+            dist_areas = self._smooth(np.asarray(distorted['areas']), distorted_file, False)
+            return np.log2(dist_areas / ref_areas)[None]
+
+    def _run_numpy(self, runtime):
+        import nibabel as nib
+        from .geometry import load_geometry, triangle_areas
+        from .gifti_io import save_metric, structure_meta
+
+        reference = load_geometry(self.inputs.surface_reference)
+        # shared by every distorted surface of a batch
+        self._reference_areas = triangle_areas(reference['coords'], reference['triangles'])
+        self._reference_vertex_areas = None
+        meta = structure_meta(nib.load(self.inputs.surface_reference))
+        names = None
+        if self.inputs.local_affine_method:
+            names = ['area ratio', 'anisotropic stretch']
+        for distorted_file, out_file in zip(self._distorted(), self._out_files()):
+            # subject surfaces are rarely seen again, keep them out of the disk cache
+            distorted = load_geometry(distorted_file, use_disk=False)
+            if len(distorted['coords']) != len(reference['coords']):
+                raise ValueError('{} does not have the same number of vertices as {}'.format(
+                    distorted_file, self.inputs.surface_reference))
+            save_metric(self._distortion(reference, distorted, distorted_file), out_file,
+                        names=names, meta=meta)
+        return runtime
+
+    def _distorted(self):
+        if self._batch():
+            return list(self.inputs.surface_distorted)
+        return [self.inputs.surface_distorted]
+
+    def _out_files(self):
+        import os
+        from .base import unique_stems
+
+        if not self._batch():
+            return [self._gen_filename('out_file')]
+        return [os.path.join(os.getcwd(), stem + '_distortion.func.gii')
+                for stem in unique_stems(self.inputs.surface_distorted)]
+
     def _gen_filename(self, name):
         import os
 
@@ -138,7 +273,9 @@ class SurfaceDistortionAreas(wb.WBCommand):
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
-        if 'out_file' not in outputs or not isdefined(outputs['out_file']):
+        if self._batch():
+            outputs['out_files'] = self._out_files()
+        elif 'out_file' not in outputs or not isdefined(outputs['out_file']):
             outputs['out_file'] = self._gen_filename('out_file')
 
         return outputs
@@ -0,0 +1,200 @@
+# Opt-in timing and resource records for every WBCommand of this package.
+# Developer Notes:
+# Set $NIPYPE_WB_TELEMETRY to a file and every run() appends one JSON line to
+# it with how long each phase took: checking inputs, building the command line
+# (_format_arg, _gen_filename, ...), executing (wb_command or the in-process
+# engine), and collecting/checking outputs. Alongside are the CPU time and
+# peak RSS of this process and of waited-for children (getrusage), and the
+# bytes read and written (/proc/self/io, which includes reaped children on
+# Linux). The children's peak RSS is the peak of any child so far, so it is
+# only reported when the run raised it. summarize() aggregates a telemetry
+# file by interface and input size; `python -m nipype_workbench_ext.telemetry
+# FILE` prints that table.
+
+import json
+import os
+import socket
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PHASES = ('inputs', 'cmdline', 'execute', 'outputs', 'total')
+
+
+def telemetry_file():
+    """The JSONL file records go to ($NIPYPE_WB_TELEMETRY), or None if disabled."""
+    return os.environ.get('NIPYPE_WB_TELEMETRY') or None
+
+
+def _io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _usage():
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+class Recorder(object):
+    """Accumulates the phases and resource usage of one run()."""
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.phases = defaultdict(float)
+        self._start = time.perf_counter()
+        self._usage = _usage()
+        self._io = _io_bytes()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def start_execute(self):
+        self._execute = time.perf_counter()
+
+    def stop_execute(self):
+        self.phases['execute'] += time.perf_counter() - self._execute
+        self._outputs = time.perf_counter()
+
+    def record(self, cwd, error=None):
+        from nipype.interfaces.base import isdefined
+        from .resources import input_bytes
+
+        self_usage, child_usage = _usage()
+        io = _io_bytes()
+        phases = dict(self.phases)
+        if getattr(self, '_outputs', None) is not None:
+            phases['outputs'] = time.perf_counter() - self._outputs
+        # command line building happens inside the execution phase
+        if 'execute' in phases:
+            phases['execute'] = max(phases['execute'] - phases.get('cmdline', 0.0), 0.0)
+        phases['total'] = time.perf_counter() - self._start
+        inputs = self.interface.inputs
+        try:
+            data_bytes = input_bytes(inputs)
+        except Exception:
+            data_bytes = None
+        record = dict(
+            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            interface=self.interface.__class__.__name__,
+            module=self.interface.__class__.__module__,
+            engine=getattr(inputs, 'engine', 'wb_command'),
+            num_threads=inputs.num_threads if isdefined(inputs.num_threads) else None,
+            hostname=socket.gethostname(),
+            pid=os.getpid(),
+            cwd=cwd,
+            phases=phases,
+            cpu_self_s=(self_usage.ru_utime + self_usage.ru_stime -
+                        self._usage[0].ru_utime - self._usage[0].ru_stime),
+            cpu_children_s=(child_usage.ru_utime + child_usage.ru_stime -
+                            self._usage[1].ru_utime - self._usage[1].ru_stime),
+            maxrss_self_kb=self_usage.ru_maxrss,
+            maxrss_children_kb=(child_usage.ru_maxrss
+                                if child_usage.ru_maxrss > self._usage[1].ru_maxrss else None),
+            read_bytes=None if io[0] is None else io[0] - self._io[0],
+            write_bytes=None if io[1] is None else io[1] - self._io[1],
+            input_bytes=data_bytes,
+            error=None if error is None else '{}: {}'.format(error.__class__.__name__, error),
+        )
+        with open(telemetry_file(), 'a') as f:
+            # one write per line so concurrent processes do not interleave
+            f.write(json.dumps(record) + '\n')
+        return record
+
+
+def load(filename):
+    """The records of a telemetry file, skipping unreadable lines."""
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def size_bucket(n_bytes):
+    """Label of the power-of-ten size range ``n_bytes`` falls in, e.g. '1MB-10MB'."""
+    import math
+
+    if not n_bytes:
+        return 'unknown'
+    units = ['B', 'kB', 'MB', 'GB', 'TB', 'PB']
+    exponent = min(int(math.log10(n_bytes)), 3 * len(units) - 2)
+
+    def _label(e):
+        return '{}{}'.format(10 ** (e % 3), units[e // 3])
+
+    return '{}-{}'.format(_label(exponent), _label(exponent + 1))
+
+
+def summarize(records):
+    """
+    Aggregate records (or a telemetry file) by interface and input size.
+    Returns a list of dicts with the number of runs, failures, and the mean
+    and maximum of every phase, CPU time and bytes read/written.
+    """
+    import numpy as np
+
+    if isinstance(records, str):
+        records = load(records)
+    groups = defaultdict(list)
+    for record in records:
+        groups[(record['interface'], record.get('engine'),
+                size_bucket(record.get('input_bytes')))].append(record)
+
+    def _stats(values):
+        values = [v for v in values if v is not None]
+        if not values:
+            return None, None
+        return float(np.mean(values)), float(np.max(values))
+
+    rows = []
+    for (interface, engine, size), group in sorted(groups.items()):
+        row = dict(interface=interface, engine=engine, input_size=size, runs=len(group),
+                   failed=sum(r.get('error') is not None for r in group))
+        for phase in PHASES:
+            row[phase + '_mean_s'], row[phase + '_max_s'] = _stats(
+                [r['phases'].get(phase) for r in group])
+        for field in ('cpu_self_s', 'cpu_children_s', 'read_bytes', 'write_bytes'):
+            row[field + '_mean'], row[field + '_max'] = _stats([r.get(field) for r in group])
+        row['maxrss_children_kb_max'] = _stats([r.get('maxrss_children_kb') for r in group])[1]
+        rows.append(row)
+    return rows
+
+
+def format_summary(rows):
+    """A text table of summarize() rows: mean seconds per phase."""
+    header = ['interface', 'engine', 'input size', 'runs', 'failed'] + list(PHASES) + \
+        ['cpu children', 'read MB', 'written MB']
+    lines = [header]
+    for row in rows:
+        def _num(value, scale=1.0):
+            return '-' if value is None else '{:.3f}'.format(value / scale)
+        lines.append([row['interface'], str(row['engine']), row['input_size'], str(row['runs']),
+                      str(row['failed'])] +
+                     [_num(row[phase + '_mean_s']) for phase in PHASES] +
+                     [_num(row['cpu_children_s_mean']), _num(row['read_bytes_mean'], 2 ** 20),
+                      _num(row['write_bytes_mean'], 2 ** 20)])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths))
+                     for line in lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        sys.exit('usage: python -m nipype_workbench_ext.telemetry TELEMETRY.jsonl')
+    print(format_summary(summarize(sys.argv[1])))
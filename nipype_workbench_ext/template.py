@@ -0,0 +1,369 @@
+# Template indices for mapping data onto the brainordinates of a template
+# cifti, as wb_command -cifti-create-dense-from-template and
+# -cifti-convert -from-nifti do.
+# Developer Notes:
+# Parsing a cifti header means parsing XML and building a BrainModelAxis, which
+# for a 91k grayordinate template takes about as long as copying a run of data.
+# template_index() does that once per header and caches what the engines need
+# as plain arrays: where each structure starts and stops, the vertex or (nifti
+# order) voxel of every brainordinate, the volume geometry, the map names and
+# label tables, and the serialized MatrixIndicesMaps. The key is the hash of
+# the header bytes only (everything before the payload), so files written
+# against the same template share one entry whatever their data. Outputs are
+# then written with cifti_io.create_cifti_xml from the cached XML and filled
+# by copying blocks of maps, so no axis is built again.
+
+import numpy as np
+
+from .dense import _cifti_name
+
+
+def header_hash(filename):
+    """sha256 of the nifti header and extensions of a cifti file, i.e. all but its payload."""
+    import hashlib
+    import struct
+    from nibabel.openers import ImageOpener
+
+    with ImageOpener(filename) as f:
+        start = f.read(540)
+        for order in '<>':
+            size = struct.unpack(order + 'i', start[:4])[0]
+            if size == 540:
+                vox_offset = struct.unpack(order + 'q', start[168:176])[0]
+                break
+            if size == 348:
+                vox_offset = int(struct.unpack(order + 'f', start[108:112])[0])
+                break
+        else:
+            raise ValueError('{} is not a nifti file'.format(filename))
+        rest = f.read(max(vox_offset - len(start), 0))
+    return hashlib.sha256(start + rest).hexdigest()
+
+
+def _bytes(array):
+    return np.asarray(array).tobytes()
+
+
+def template_index(filename, use_disk=True):
+    """
+    Cached description of a cifti file's header. Returns a dict of arrays:
+    the serialized ``maps_xml``/``columns_xml`` mappings, ``shape``,
+    ``intent_code``, the ``map_kind`` (axis class), ``map_names``, label
+    tables (``label_map``, ``label_key``, ``label_name``, ``label_rgba``)
+    and ``series`` start/step and ``series_unit`` of the maps and, if the
+    columns are brain models (``dense``), the ``structures`` with their
+    ``start``/``stop`` brainordinates, ``surface`` flags and ``n_vertices``,
+    the ``vertex`` and dense to volume lookup ``voxel_flat`` (nifti order
+    voxel index) of every brainordinate (-1 where it does not apply) and the
+    volume ``affine`` and ``volume_shape``. Without ``use_disk`` the entry
+    is only kept in memory, for files that are not templates.
+    """
+    from . import cache
+
+    def _build():
+        import nibabel as nib
+        from nibabel.cifti2 import cifti2_axes
+        from .cifti_io import mapping_xml
+
+        img = nib.load(filename)
+        if not isinstance(img, nib.Cifti2Image) or len(img.shape) != 2:
+            raise ValueError('{} is not a two dimensional cifti file'.format(filename))
+        maps, columns = img.header.get_axis(0), img.header.get_axis(1)
+        entry = dict(maps_xml=np.frombuffer(mapping_xml(maps, 0), dtype=np.uint8),
+                     columns_xml=np.frombuffer(mapping_xml(columns, 1), dtype=np.uint8),
+                     shape=np.array(img.shape), intent_code=int(img.nifti_header['intent_code']),
+                     map_names=np.array(getattr(maps, 'name', [''] * len(maps)), dtype=str),
+                     map_kind=type(maps).__name__,
+                     series=np.array([getattr(maps, 'start', 0.0), getattr(maps, 'step', 1.0)]),
+                     series_unit=getattr(maps, 'unit', 'SECOND'))
+        label_map, label_key, label_name, label_rgba = [], [], [], []
+        for i, table in enumerate(getattr(maps, 'label', [])):
+            for key, (name, rgba) in sorted(table.items()):
+                label_map.append(i)
+                label_key.append(key)
+                label_name.append(name)
+                label_rgba.append(rgba)
+        entry.update(label_map=np.array(label_map, dtype=np.int64),
+                     label_key=np.array(label_key, dtype=np.int64),
+                     label_name=np.array(label_name, dtype=str),
+                     label_rgba=np.array(label_rgba, dtype=np.float64).reshape(-1, 4))
+
+        entry['dense'] = isinstance(columns, cifti2_axes.BrainModelAxis)
+        if not entry['dense']:
+            return entry
+        # the slice of the last structure is open ended
+        structures = [(name, slice(*s.indices(len(columns))[:2]), bm)
+                      for name, s, bm in columns.iter_structures()]
+        volume_shape = columns.volume_shape or (0, 0, 0)
+        voxel_flat = np.full(len(columns), -1, dtype=np.int64)
+        if columns.volume_mask.any():
+            voxel_flat[columns.volume_mask] = np.ravel_multi_index(
+                tuple(columns.voxel[columns.volume_mask].T), volume_shape, order='F')
+        entry.update(
+            structures=np.array([name for name, _, _ in structures], dtype=str),
+            start=np.array([s.start for _, s, _ in structures], dtype=np.int64),
+            stop=np.array([s.stop for _, s, _ in structures], dtype=np.int64),
+            surface=np.array([bool(bm.surface_mask.all()) for _, _, bm in structures]),
+            n_vertices=np.array([columns.nvertices.get(name, 0) for name, _, _ in structures],
+                                dtype=np.int64),
+            vertex=np.asarray(columns.vertex, dtype=np.int64),
+            voxel_flat=voxel_flat,
+            affine=columns.affine if columns.affine is not None else np.eye(4),
+            volume_shape=np.array(volume_shape, dtype=np.int64))
+        return entry
+
+    key = cache.hash_key('template-index-v2', header_hash(filename))
+    return cache.load_or_build('template_index', key, _build, use_disk=use_disk)
+
+
+def label_tables(index):
+    """The label table ({key: (name, rgba)}) of every map of a template_index()."""
+    tables = [dict() for _ in range(int(index['shape'][0]))]
+    for i, key, name, rgba in zip(index['label_map'], index['label_key'],
+                                  index['label_name'], index['label_rgba']):
+        tables[int(i)][int(key)] = (str(name), tuple(float(c) for c in rgba))
+    return tables
+
+
+def _structure(index, name):
+    # position of a structure in a dense index, or None
+    found = np.flatnonzero(np.asarray(index['structures']).astype(str) == name)
+    return int(found[0]) if len(found) else None
+
+
+def _match(keys, source_keys):
+    # positions in source_keys of each of keys (-1 where missing)
+    if not len(source_keys):
+        return np.full(len(keys), -1)
+    order = np.argsort(source_keys, kind='stable')
+    found = np.minimum(np.searchsorted(source_keys[order], keys), len(source_keys) - 1)
+    return np.where(source_keys[order][found] == keys, order[found], -1)
+
+
+def _same_label(a, b):
+    return a[0] == b[0] and np.allclose(a[1], b[1], atol=1e-6)
+
+
+def merge_label_tables(parts, label_collision='ERROR'):
+    """
+    Merge the label tables of ``parts``, a list of (is surface data, tables
+    with one {key: (name, rgba)} per map). Returns the merged tables and,
+    per part, one {old key: new key} per map for keys that were renumbered.
+
+    ERROR refuses a key with different names/colors in two inputs. LEGACY
+    keeps the first definition of every key, as wb_command 1.4.2 and earlier
+    did, so later inputs can end up with the wrong name. SURFACES_FIRST takes
+    the surface inputs first and gives conflicting labels of later inputs the
+    key the same label already has, or a new unused key.
+    """
+    n_maps = len(parts[0][1])
+    merged = [dict() for _ in range(n_maps)]
+    remaps = [[dict() for _ in range(n_maps)] for _ in parts]
+    order = list(range(len(parts)))
+    if label_collision == 'SURFACES_FIRST':
+        order.sort(key=lambda p: not parts[p][0])
+    for p in order:
+        for i, table in enumerate(parts[p][1]):
+            for key, label in sorted(table.items()):
+                if key not in merged[i]:
+                    merged[i][key] = label
+                elif _same_label(merged[i][key], label) or label_collision == 'LEGACY':
+                    continue
+                elif label_collision == 'ERROR':
+                    raise ValueError('label key {} is {} in one input and {} in another, '
+                                     'see label_collision'.format(key, merged[i][key][0],
+                                                                  label[0]))
+                else:
+                    same = [k for k, l in merged[i].items() if _same_label(l, label)]
+                    new = same[0] if same else max(merged[i]) + 1
+                    merged[i][new] = label
+                    remaps[p][i][key] = new
+    return merged, remaps
+
+
+def _remap(block, remaps):
+    # renumber label keys of a (maps, brainordinates) block in place
+    for row, remap in zip(block, remaps):
+        if not remap:
+            continue
+        old = np.array(sorted(remap))
+        new = np.array([remap[k] for k in old])
+        keys = np.rint(row).astype(np.int64)
+        found = np.minimum(np.searchsorted(old, keys), len(old) - 1)
+        hit = old[found] == keys
+        row[hit] = new[found[hit]]
+
+
+def create_from_template(out_file, template, cifti=(), metric=(), label=(), volume_all=None,
+                         series=None, series_unit='SECOND', label_collision='ERROR',
+                         block_mb=256):
+    """
+    Write a dscalar (a dtseries with ``series`` = (step, start), a dlabel
+    for label inputs) with the brainordinates of ``template``, filled from
+    ``cifti`` files (matched by structure and vertex/voxel), ``metric`` and
+    ``label`` (structure, gifti) pairs and ``volume_all``, which provides
+    every voxel. Brainordinates no input covers are 0 (unlabeled).
+    """
+    from nibabel.cifti2 import cifti2_axes
+    from .cifti_io import load_cifti, create_cifti_xml, mapping_xml, rows_per_block, flush
+    from .gifti_io import load_metric, load_label, column_names
+    from .volume_io import load_volume, label_table
+
+    index = template_index(template)
+    if not index['dense']:
+        raise ValueError('{} does not have brain models along its columns'.format(template))
+    structures = np.asarray(index['structures']).astype(str)
+    starts, stops = index['start'], index['stop']
+    # (description, surface, columns, data, rows, tables or None, map names)
+    parts = []
+    covered = dict()
+
+    def _cover(s, source):
+        if structures[s] in covered:
+            raise ValueError('{} is provided by both {} and {}'.format(
+                structures[s], covered[structures[s]], source))
+        covered[structures[s]] = source
+
+    for filename in cifti:
+        source = template_index(filename)
+        if not source['dense']:
+            raise ValueError('{} does not have brain models along its columns'.format(filename))
+        _, data = load_cifti(filename)
+        tables = label_tables(source) if len(source['label_key']) else None
+        names = [str(n) for n in source['map_names']]
+        for j, name in enumerate(np.asarray(source['structures']).astype(str)):
+            s = _structure(index, name)
+            if s is None:
+                continue
+            if index['surface'][s]:
+                if source['n_vertices'][j] != index['n_vertices'][s]:
+                    raise ValueError('{} of {} does not have the vertices of the template'.format(
+                        name, filename))
+                keys, source_keys = 'vertex', 'vertex'
+            else:
+                if tuple(source['volume_shape']) != tuple(index['volume_shape']) or \
+                        not np.allclose(source['affine'], index['affine']):
+                    raise ValueError('{} does not have the volume space of the template'.format(
+                        filename))
+                keys, source_keys = 'voxel_flat', 'voxel_flat'
+            _cover(s, filename)
+            found = _match(index[keys][starts[s]:stops[s]],
+                           source[source_keys][source['start'][j]:source['stop'][j]])
+            columns = starts[s] + np.flatnonzero(found >= 0)
+            rows = source['start'][j] + found[found >= 0]
+            parts.append((filename, bool(index['surface'][s]), columns, data, rows, tables, names))
+
+    for kind, pairs in (('metric', metric), ('label', label)):
+        for structure, filename in pairs:
+            s = _structure(index, _cifti_name(structure))
+            if s is None or not index['surface'][s]:
+                raise ValueError('{} is not a surface structure of {}'.format(structure,
+                                                                              template))
+            img, data = load_label(filename) if kind == 'label' else load_metric(filename)
+            if data.shape[1] != index['n_vertices'][s]:
+                raise ValueError('{} does not have the vertices of the template {}'.format(
+                    filename, structure))
+            _cover(s, filename)
+            tables = None
+            if kind == 'label':
+                table = {int(l.key): (l.label, tuple(l.rgba)) for l in img.labeltable.labels}
+                tables = [table] * data.shape[0]
+            parts.append((filename, True, np.arange(starts[s], stops[s]), data,
+                          index['vertex'][starts[s]:stops[s]], tables, column_names(img)))
+
+    if volume_all is not None:
+        img, data = load_volume(volume_all)
+        if tuple(img.shape[:3]) != tuple(index['volume_shape']):
+            raise ValueError('{} does not have the volume space of the template'.format(
+                volume_all))
+        for s in np.flatnonzero(~index['surface']):
+            _cover(s, volume_all)
+        columns = np.flatnonzero(index['voxel_flat'] >= 0)
+        try:
+            tables = [label_table(img, i) for i in range(data.shape[0])]
+        except ValueError:
+            tables = None
+        parts.append((volume_all, False, columns, data, index['voxel_flat'][columns], tables,
+                      [''] * data.shape[0]))
+
+    if not parts:
+        raise ValueError('no input covers a structure of {}'.format(template))
+    counts = {data.shape[0] for _, _, _, data, _, _, _ in parts}
+    if len(counts) != 1:
+        raise ValueError('the inputs do not have the same number of maps')
+    n_maps = counts.pop()
+    labels = [tables is not None for _, _, _, _, _, tables, _ in parts]
+    if any(labels) and not all(labels):
+        raise ValueError('label and non-label inputs cannot be combined')
+    if any(labels) and series is not None:
+        raise ValueError('series cannot be used with label inputs')
+    names = next((n for _, _, _, _, _, _, n in parts if any(n)), [''] * n_maps)
+
+    remaps = [[dict()] * n_maps] * len(parts)
+    if all(labels):
+        tables, remaps = merge_label_tables([(surface, tables) for _, surface, _, _, _, tables, _
+                                             in parts], label_collision)
+        map_axis = cifti2_axes.LabelAxis(names, tables)
+        intent = 'NIFTI_INTENT_CONNECTIVITY_DENSE_LABELS'
+    elif series is not None:
+        step, start = series
+        map_axis = cifti2_axes.SeriesAxis(start, step, n_maps, series_unit)
+        intent = 'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES'
+    else:
+        map_axis = cifti2_axes.ScalarAxis(names)
+        intent = 'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS'
+
+    n_columns = int(index['shape'][1])
+    out = create_cifti_xml(out_file, [mapping_xml(map_axis, 0), _bytes(index['columns_xml'])],
+                           (n_maps, n_columns), intent)
+    step = rows_per_block(n_columns * 4, block_mb)
+    for start in range(0, n_maps, step):
+        stop = min(start + step, n_maps)
+        block = np.zeros((stop - start, n_columns), dtype=np.float32)
+        for (_, _, columns, data, rows, _, _), remap in zip(parts, remaps):
+            values = np.asarray(data[start:stop])[:, rows].astype(np.float32)
+            _remap(values, remap[start:stop])
+            block[:, columns] = values
+        out[start:stop] = block
+    flush(out)
+    del out
+
+
+def nifti_to_cifti(nifti_in, template, out_file, reset_scalars=False, block_mb=256):
+    """
+    Convert a nifti written by wb_command -cifti-convert -to-nifti back to
+    cifti with the header of ``template``: brainordinates are the voxels in
+    nifti order (padding voxels at the end are dropped), maps the volumes.
+    With ``reset_scalars`` the maps become unnamed scalars of any number.
+    """
+    import nibabel as nib
+    from nibabel.cifti2 import cifti2_axes
+    from .cifti_io import create_cifti_xml, mapping_xml, rows_per_block, flush
+
+    index = template_index(template)
+    img = nib.load(nifti_in, mmap='r')
+    data = np.asanyarray(img.dataobj)
+    n_voxels = int(np.prod(data.shape[:3]))
+    data = data.reshape((n_voxels, -1), order='F').T
+    n_maps, n_columns = data.shape[0], int(index['shape'][1])
+    if n_voxels < n_columns:
+        raise ValueError('{} has fewer voxels than {} has brainordinates'.format(
+            nifti_in, template))
+    if reset_scalars:
+        maps_xml = mapping_xml(cifti2_axes.ScalarAxis([''] * n_maps), 0)
+        intent = 'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS' if index['dense'] else \
+            'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SCALAR'
+    else:
+        if n_maps != int(index['shape'][0]):
+            raise ValueError('{} has {} maps but {} has {}, see reset_scalars'.format(
+                nifti_in, n_maps, template, int(index['shape'][0])))
+        maps_xml = _bytes(index['maps_xml'])
+        intent = int(index['intent_code']) or 'NIFTI_INTENT_CONNECTIVITY_UNKNOWN'
+    out = create_cifti_xml(out_file, [maps_xml, _bytes(index['columns_xml'])],
+                           (n_maps, n_columns), intent)
+    step = rows_per_block(n_columns * 4, block_mb)
+    for start in range(0, n_maps, step):
+        stop = min(start + step, n_maps)
+        out[start:stop] = data[start:stop, :n_columns]
+    flush(out)
+    del out
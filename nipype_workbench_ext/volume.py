@@ -1,6 +1,5 @@
 import os
 
-from nipype.interfaces.workbench import base as wb
 from nipype.interfaces.base import (
     traits, 
     File, 
@@ -11,12 +10,16 @@ from nipype.interfaces.base import (
 )
 from traits.api import List
 
+from .base import WBInputSpec, WBCommand, WBEngineInputSpec, WBEngineCommand
+
 # Note: this is another quick and dirty implementation. The dirt comes down to
-# specifications of suboptions to -var, which can take -select x y -repeat type
+# specifications of suboptions to -var, which can take -subvolume x -repeat type
 # option. If you want to pass something like that implement a Function interface
 # that takes your input file name as input and returns a string that includes
-# that filename and the subsequent modifiers.
-class VolumeMathInputSpec(CommandLineInputSpec):
+# that filename and the subsequent modifiers, e.g. 'bold.nii.gz -subvolume 1 -repeat'.
+# Both engines understand that form. engine='numpy' compiles the expression once
+# (see mathexpr.py) and evaluates it in voxel blocks over memory-mapped inputs.
+class VolumeMathInputSpec(WBEngineInputSpec):
     expression=Str(
         argstr='"%s"',
         position=0,
@@ -37,6 +40,9 @@ class VolumeMathInputSpec(CommandLineInputSpec):
         mandatory=True,
         position=2
     )
+    block_mb=traits.Float(256,
+        usedefault=True,
+        desc="approximate memory (MB) of inputs to hold at once with engine='numpy'")
 
 class VolumeMathOutputSpec(TraitedSpec):
     out_file=File(
@@ -44,12 +50,47 @@ class VolumeMathOutputSpec(TraitedSpec):
         desc="the output volume file"
     )
 
-class VolumeMath(wb.WBCommand):
+class VolumeMath(WBEngineCommand):
     input_spec = VolumeMathInputSpec
     output_spec = VolumeMathOutputSpec
 
     _cmd = 'wb_command -volume-math'
 
+    def _variables(self):
+        from .volume_io import load_volume
+        from .mathexpr import Variable, parse_var, ExpressionError
+
+        variables, images = [], []
+        for name, spec in self.inputs.in_vars:
+            filename, options = parse_var(spec)
+            img, data = load_volume(filename)
+            map_index = None
+            if '-subvolume' in options:
+                subvolume = options['-subvolume'][0]
+                if not subvolume.isdigit() or not 1 <= int(subvolume) <= data.shape[0]:
+                    raise ExpressionError('{} has no subvolume {}'.format(filename, subvolume))
+                map_index = int(subvolume) - 1
+            variables.append(Variable(name, data, map_index, None, '-repeat' in options))
+            images.append(img)
+        return variables, images
+
+    def _run_numpy(self, runtime):
+        from .volume_io import create_volume, finish_volume
+        from .mathexpr import Expression, output_shape, evaluate_blocks
+
+        expression = Expression(self.inputs.expression)
+        variables, images = self._variables()
+        n_maps, _ = output_shape(variables)
+        for img in images[1:]:
+            if img.shape[:3] != images[0].shape[:3]:
+                raise ValueError('volume variables must have the same dimensions')
+
+        out_file = self._gen_filename('out_file')
+        out = create_volume(out_file, images[0], n_maps)
+        evaluate_blocks(expression, variables, out, self.inputs.block_mb)
+        finish_volume(out, out_file, images[0])
+        return runtime
+
 
     def _gen_filename(self, name):
         import os
@@ -67,7 +108,7 @@ class VolumeMath(wb.WBCommand):
 
 
 # This interface was drafted by chatGPT
-class VolumeLabelExportTableInputSpec(CommandLineInputSpec):
+class VolumeLabelExportTableInputSpec(WBInputSpec):
     label_in = File(
         exists=True,
         mandatory=True,
@@ -100,7 +141,7 @@ class VolumeLabelExportTableOutputSpec(TraitedSpec):
     )
 
 
-class VolumeLabelExportTable(wb.WBCommand):
+class VolumeLabelExportTable(WBCommand):
     """
     Export a volume label table from a CIFTI dlabel.nii file.
 
@@ -148,7 +189,7 @@ class VolumeLabelExportTable(wb.WBCommand):
 
 
 # this interface was also drafted by chatgpt
-class VolumeLabelImportTableInputSpec(CommandLineInputSpec):
+class VolumeLabelImportTableInputSpec(WBInputSpec):
     in_file = File(
         exists=True,
         mandatory=True,
@@ -209,7 +250,7 @@ class VolumeLabelImportTableOutputSpec(TraitedSpec):
     )
 
 
-class VolumeLabelImportTable(wb.WBCommand):
+class VolumeLabelImportTable(WBCommand):
     """
     Import a label volume into Workbench format from an integer-valued volume file.
 
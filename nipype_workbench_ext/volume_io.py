@@ -0,0 +1,122 @@
+# nibabel helpers for volume files used by the in-process engines.
+# Developer Notes:
+# Volumes are handled as (subvolumes, voxels) arrays to match the
+# (maps, brainordinates) convention of cifti_io, with voxels in nifti (column
+# major) order so the arrays are views of the memory-mapped file.
+
+import numpy as np
+import nibabel as nib
+
+from .cifti_io import flush
+
+
+def load_volume(filename):
+    """Return the image and a (subvolumes, voxels) view of its data."""
+    img = nib.load(filename, mmap='r')
+    data = np.asanyarray(img.dataobj)
+    n_voxels = int(np.prod(data.shape[:3]))
+    return img, data.reshape((n_voxels, -1), order='F').T
+
+
+def _mapped_name(filename):
+    # compressed volumes are written uncompressed next to their target first
+    import os
+
+    if str(filename).endswith('.gz'):
+        return '{}.{}.tmp.nii'.format(filename, os.getpid())
+    return filename
+
+
+def label_table_extension(table, name=''):
+    """
+    The XML "caret" nifti extension wb_command keeps the label table
+    ``table`` ({key: (name, (r, g, b, a))}) of a one-subvolume label volume in.
+    """
+    import xml.etree.ElementTree as ET
+    from nibabel.nifti1 import Nifti1Extension
+
+    root = ET.Element('CaretExtension', Version='1.0')
+    info = ET.SubElement(root, 'VolumeInformation', Index='0')
+    labels = ET.SubElement(info, 'LabelTable')
+    for key, (label, rgba) in sorted(table.items()):
+        element = ET.SubElement(labels, 'Label', Key=str(key),
+                                **dict(zip(('Red', 'Green', 'Blue', 'Alpha'),
+                                           ['{:g}'.format(c) for c in rgba])))
+        element.text = label
+    md = ET.SubElement(ET.SubElement(info, 'MetaData'), 'MD')
+    ET.SubElement(md, 'Name').text = 'Name'
+    ET.SubElement(md, 'Value').text = name
+    return Nifti1Extension(30, ET.tostring(root, encoding='UTF-8'))
+
+
+def create_volume(filename, template, n_maps, dtype=np.float32, label_table=None):
+    """
+    Preallocate a volume with the geometry of ``template`` and return a
+    writable, memory-mapped (subvolumes, voxels) view. Compressed outputs
+    are mapped from an uncompressed temporary file that ``finish_volume``
+    compresses, so no output is ever held in memory whole. With
+    ``label_table`` the volume is a workbench label volume.
+    """
+    shape = tuple(template.shape[:3]) + ((n_maps,) if n_maps > 1 else ())
+    img = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype), shape),
+                          template.affine, template.header)
+    img.update_header()
+    header = img.header
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+    if label_table is not None:
+        header.set_intent('NIFTI_INTENT_LABEL')
+        header.extensions.append(label_table_extension(label_table))
+    header['vox_offset'] = 0
+    filename = _mapped_name(filename)
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        offset = header.get_data_offset()
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    out = np.memmap(filename, dtype=header.get_data_dtype(), mode='r+', offset=offset,
+                    shape=shape, order='F')
+    return out.reshape((int(np.prod(shape[:3])), -1), order='F').T
+
+
+def finish_volume(data, filename, template):
+    """
+    Complete a volume started with ``create_volume``: flush the memmap, and
+    for compressed outputs stream the temporary file into ``filename``.
+    """
+    import gzip
+    import os
+    import shutil
+
+    flush(data)
+    mapped = _mapped_name(filename)
+    if mapped == filename:
+        return
+    try:
+        with open(mapped, 'rb') as src, gzip.open(filename, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 16 * 2 ** 20)
+    finally:
+        os.remove(mapped)
+
+
+def label_table(img, subvolume=0):
+    """
+    {key: (name, (r, g, b, a))} of a workbench label volume, read from the
+    XML "caret" nifti extension wb_command keeps label tables in.
+    """
+    import xml.etree.ElementTree as ET
+
+    for ext in img.header.extensions:
+        if ext.get_code() != 30:
+            continue
+        # nibabel >= 5.2 has .content, get_content() is older (and now means the object)
+        content = ext.content if hasattr(ext, 'content') else ext.get_content()
+        root = ET.fromstring(content.rstrip(b'\x00'))
+        infos = root.findall('VolumeInformation')
+        if len(infos) <= subvolume:
+            continue
+        table = dict()
+        for label in infos[subvolume].iter('Label'):
+            rgba = tuple(float(label.get(c, 0)) for c in ('Red', 'Green', 'Blue', 'Alpha'))
+            table[int(label.get('Key'))] = ((label.text or '').strip(), rgba)
+        return table
+    raise ValueError('{} has no workbench label table'.format(img.get_filename()))
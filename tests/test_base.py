@@ -0,0 +1,17 @@
+import copy
+
+from nipype_workbench_ext.cifti import CiftiStats
+
+
+def test_num_threads_sets_omp_when_run():
+    stats = CiftiStats(num_threads=2)
+    assert stats._get_environ()['OMP_NUM_THREADS'] == '2'
+    assert 'OMP_NUM_THREADS' not in stats.inputs.environ
+    stats.inputs.num_threads = 3
+    assert copy.deepcopy(stats)._get_environ()['OMP_NUM_THREADS'] == '3'
+
+
+def test_user_omp_num_threads_is_kept():
+    stats = CiftiStats(environ={'OMP_NUM_THREADS': '4'})
+    assert stats._get_environ()['OMP_NUM_THREADS'] == '4'
+    assert stats.inputs.environ == {'OMP_NUM_THREADS': '4'}
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+from nibabel.cifti2 import cifti2_axes as axes
+
+from nipype_workbench_ext.batch import run_batched
+from nipype_workbench_ext.cifti import CiftiStats
+
+
+@pytest.fixture
+def in_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    brain = axes.BrainModelAxis.from_mask(np.ones(4, dtype=bool), name='CORTEX_LEFT')
+    data = np.arange(8, dtype=np.float32).reshape(2, 4)
+    nib.Cifti2Image(data, (axes.ScalarAxis(['a', 'b']), brain)).to_filename('in.dscalar.nii')
+    return 'in.dscalar.nii'
+
+
+def _interfaces(in_file):
+    return [CiftiStats(in_file=in_file, reduce='MEAN', engine='numpy'),
+            CiftiStats(in_file='missing.dscalar.nii', reduce='MEAN', engine='numpy'),
+            CiftiStats(in_file=in_file, reduce='MAX', engine='numpy')]
+
+
+def test_in_process_failure_does_not_stop_the_batch(in_file):
+    results = run_batched(_interfaces(in_file), raise_on_error=False)
+    assert results[0].outputs.value == [1.5, 5.5]
+    assert results[1].outputs is None
+    assert results[1].runtime.returncode == 1
+    assert 'missing.dscalar.nii' in results[1].runtime.stderr
+    assert results[2].outputs.value == [3.0, 7.0]
+
+
+def test_in_process_failure_is_raised_at_the_end(in_file):
+    with pytest.raises(RuntimeError, match='1 of 3 batched calls failed: 1'):
+        run_batched(_interfaces(in_file))
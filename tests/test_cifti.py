@@ -0,0 +1,12 @@
+from nipype_workbench_ext.cifti import CiftiSeparate
+
+
+def test_separate_volume_all_only_when_set(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'in.dtseries.nii').touch()
+    metric = CiftiSeparate(in_file='in.dtseries.nii', direction='COLUMN',
+                           metric=['CORTEX_LEFT']).cmdline
+    assert metric.endswith('-metric CORTEX_LEFT {}'.format(tmp_path / 'in_CORTEX_LEFT.func.gii'))
+    volume = CiftiSeparate(in_file='in.dtseries.nii', direction='COLUMN',
+                           volume_all=True).cmdline
+    assert '-volume-all {} -roi'.format(tmp_path / 'in_volume_all.nii.gz') in volume
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+from nibabel.cifti2 import cifti2_axes as axes
+
+from nipype_workbench_ext.export import export_cifti
+
+
+@pytest.fixture
+def in_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    brain = axes.BrainModelAxis.from_mask(np.ones(50, dtype=bool), name='CORTEX_LEFT')
+    data = np.random.default_rng(0).normal(size=(3, 50)).astype(np.float32)
+    nib.Cifti2Image(data, (axes.ScalarAxis(['a', 'b', 'c']), brain)).to_filename('in.dscalar.nii')
+    return data
+
+
+def test_text(in_file):
+    export_cifti('in.dscalar.nii', 'out.txt', 'text', block_mb=1e-3, n_workers=2)
+    np.testing.assert_array_equal(np.loadtxt('out.txt', dtype=np.float32), in_file.T)
+
+
+def test_npy(in_file):
+    export_cifti('in.dscalar.nii', 'out.npy', 'npy', block_mb=1e-3)
+    np.testing.assert_array_equal(np.load('out.npy'), in_file.T)
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd'])
+def test_parquet(in_file, compression):
+    pq = pytest.importorskip('pyarrow.parquet')
+    export_cifti('in.dscalar.nii', 'out.parquet', 'parquet', chunks=(20, 3),
+                 compression=compression)
+    f = pq.ParquetFile('out.parquet')
+    assert f.metadata.num_row_groups == 3
+    if compression:
+        assert f.metadata.row_group(0).column(0).compression == 'ZSTD'
+    table = f.read()
+    assert table.column_names == ['a', 'b', 'c']
+    np.testing.assert_array_equal(np.stack([c.to_numpy() for c in table.columns], 1), in_file.T)
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd'])
+def test_arrow(in_file, compression):
+    pa = pytest.importorskip('pyarrow')
+    export_cifti('in.dscalar.nii', 'out.arrow', 'arrow', chunks=(20, 3),
+                 compression=compression)
+    with pa.ipc.open_file('out.arrow') as f:
+        assert f.num_record_batches == 3
+        table = f.read_all()
+    assert table.column_names == ['a', 'b', 'c']
+    np.testing.assert_array_equal(np.stack([c.to_numpy() for c in table.columns], 1), in_file.T)
+
+
+@pytest.mark.parametrize('chunks, compression', [(None, None), ((10, 3), None), (None, 'gzip')])
+def test_hdf5(in_file, chunks, compression):
+    h5py = pytest.importorskip('h5py')
+    export_cifti('in.dscalar.nii', 'out.h5', 'hdf5', chunks=chunks, compression=compression,
+                 block_mb=1e-3)
+    with h5py.File('out.h5', 'r') as f:
+        np.testing.assert_array_equal(f['data'][:], in_file.T)
+        assert list(f['data'].attrs['map_names']) == ['a', 'b', 'c']
+        if chunks:
+            assert f['data'].chunks == chunks
+        assert f['data'].compression == compression
+
+
+@pytest.mark.parametrize('chunks, compression', [(None, None), ((10, 3), 'zstd'),
+                                                 (None, 'gzip')])
+def test_zarr(in_file, chunks, compression):
+    zarr = pytest.importorskip('zarr')
+    export_cifti('in.dscalar.nii', 'out.zarr', 'zarr', chunks=chunks, compression=compression,
+                 block_mb=1e-3)
+    out = zarr.open_array('out.zarr', mode='r')
+    np.testing.assert_array_equal(out[:], in_file.T)
+    assert list(out.attrs['map_names']) == ['a', 'b', 'c']
+    if chunks:
+        assert out.chunks == chunks
+
+
+def test_unknown_zarr_compression(in_file):
+    zarr = pytest.importorskip('zarr')
+    if int(zarr.__version__.split('.')[0]) < 3:
+        pytest.skip('zarr 2 takes any numcodecs codec')
+    with pytest.raises(ValueError, match='unknown zarr compression'):
+        export_cifti('in.dscalar.nii', 'out.zarr', 'zarr', compression='snappy')
+
+
+def test_convert_text_formats(in_file):
+    pytest.importorskip('h5py')
+    from nipype_workbench_ext.cifti import CiftiConvertText
+
+    result = CiftiConvertText(in_file='in.dscalar.nii', out_format='hdf5').run()
+    assert result.outputs.out_file.endswith('in.h5')
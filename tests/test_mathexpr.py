@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from nipype_workbench_ext.mathexpr import (Expression, ExpressionChain, ExpressionError, Variable,
+                                           evaluate_blocks, output_shape, parse_var)
+
+
+def _eval(text, **env):
+    return Expression(text)({k: np.asarray(v, dtype=np.float64) for k, v in env.items()})
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('1 + 2 * 3', 7),
+    ('(1 + 2) * 3', 9),
+    ('2 ^ 3 ^ 2', 512),
+    ('-2 ^ 2', -4),
+    ('10 - 4 - 3', 3),
+    ('8 / 4 / 2', 1),
+    ('1 + 2 > 2', 1),
+    ('1 < 2 == 1', 1),
+    ('0 || 1 && 0', 0),
+    ('!0 + 1', 2),
+    ('0 ? 1 : 2', 2),
+    ('1 ? 0 ? 3 : 4 : 5', 4),
+    ('1 > 2 ? 3 : 4 + 1', 5),
+    ('clamp(5, 0, 1) + max(2, 3) + mod(-1, 3)', 6),
+    ('round(-2.5) + round(2.5)', 0),
+    ('PI - 4 * atan(1)', 0),
+])
+def test_constant_expressions(text, expected):
+    assert np.isclose(_eval(text), expected)
+
+
+def test_elementwise_with_variables():
+    x = np.array([-1.0, 0.0, 0.5, 2.0])
+    y = np.array([1.0, 1.0, 2.0, 2.0])
+    out = _eval('x > 0 ? x * y : -x', x=x, y=y)
+    np.testing.assert_allclose(out, [1.0, 0.0, 1.0, 4.0])
+    assert Expression('x * y + z / PI').variables == ['x', 'y', 'z']
+
+
+def test_comparisons_use_relative_tolerance():
+    one = np.float64(np.float32(1 + 3e-8))
+    np.testing.assert_array_equal(_eval('x == 1', x=[one, 1.001, 0.0]), [1, 0, 0])
+    np.testing.assert_array_equal(_eval('x != 1', x=[one, 1.001]), [0, 1])
+    np.testing.assert_array_equal(_eval('x >= 1', x=[1 - 1e-9, 0.9]), [1, 0])
+    np.testing.assert_array_equal(_eval('x <= 1', x=[1 + 1e-9, 1.1]), [1, 0])
+    assert _eval('x == 0', x=1e-12) == 0
+
+
+@pytest.mark.parametrize('text', ['', '1 +', '(1 + 2', '1 2', 'x ? 1', 'foo(x)', 'min(1)',
+                                  'x $ y'])
+def test_parse_errors(text):
+    with pytest.raises(ExpressionError):
+        Expression(text)
+
+
+def test_missing_variable():
+    with pytest.raises(ExpressionError):
+        Expression('x + y')({'x': np.zeros(2)})
+
+
+def test_parse_var():
+    assert parse_var('run.dtseries.nii -select 1 5 -repeat') == (
+        'run.dtseries.nii', {'-select': ['1', '5'], '-repeat': []})
+    with pytest.raises(ExpressionError):
+        parse_var('a.nii -select 1')
+    with pytest.raises(ExpressionError):
+        parse_var('a.nii -bogus')
+
+
+def test_select_and_repeat_blocks():
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    x = Variable('x', data)
+    # the second map, repeated over the maps of x
+    m = Variable('m', data, map_index=1, repeat=True)
+    # the last element of every map
+    e = Variable('e', data, element_index=3)
+    variables = [x, m, e]
+    assert output_shape(variables) == (3, 4)
+    out = evaluate_blocks(Expression('x - m + e'), variables, np.empty((3, 4)), block_mb=1e-5)
+    np.testing.assert_allclose(out, data - data[1] + data[:, 3:])
+
+
+def test_output_shape_mismatch():
+    with pytest.raises(ExpressionError):
+        output_shape([Variable('a', np.zeros((2, 4))), Variable('b', np.zeros((3, 4)))])
+    with pytest.raises(ExpressionError):
+        output_shape([Variable('a', np.zeros((2, 4))), Variable('b', np.zeros((2, 4)),
+                                                                repeat=True)])
+
+
+def test_chain_matches_separate_steps():
+    x = np.linspace(-2, 2, 9)
+    chain = ExpressionChain([('x - 1', 'a'), ('a * a', 'b'), ('b > 1 ? b : 0', 'c')])
+    assert chain.variables == ['x']
+    a = x - 1
+    np.testing.assert_allclose(chain({'x': x}), np.where(a * a > 1, a * a, 0))
+
+
+def test_cifti_math_numpy_engine(tmp_path, monkeypatch):
+    nib = pytest.importorskip('nibabel')
+    from nibabel.cifti2 import cifti2_axes as axes
+    from nipype_workbench_ext.cifti import CiftiMath
+
+    monkeypatch.chdir(tmp_path)
+    data = np.arange(15, dtype=np.float32).reshape(3, 5)
+    brain = axes.BrainModelAxis.from_mask(np.ones(5, dtype=bool), name='CORTEX_LEFT')
+    nib.Cifti2Image(data, (axes.ScalarAxis(['a', 'b', 'c']), brain)).to_filename('x.dscalar.nii')
+    result = CiftiMath(expression='x > 6 ? x - first : 0',
+                       in_vars=[('x', 'x.dscalar.nii'),
+                                ('first', 'x.dscalar.nii -select 1 1 -repeat')],
+                       out_file='out.dscalar.nii', engine='numpy').run()
+    out = nib.load(result.outputs.out_file).get_fdata()
+    np.testing.assert_allclose(out, np.where(data > 6, data - data[0], 0))
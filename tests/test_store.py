@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+from nibabel.cifti2 import cifti2_axes as axes
+
+from nipype_workbench_ext import store
+from nipype_workbench_ext.cifti import CiftiStats
+
+
+def _dscalar(filename, data):
+    brain = axes.BrainModelAxis.from_mask(np.ones(data.shape[1], dtype=bool), name='CORTEX_LEFT')
+    names = [str(i + 1) for i in range(data.shape[0])]
+    nib.Cifti2Image(data.astype(np.float32), (axes.ScalarAxis(names), brain)).to_filename(filename)
+    return filename
+
+
+@pytest.fixture
+def stored(tmp_path, monkeypatch):
+    monkeypatch.setenv('NIPYPE_WB_STORE_DIR', str(tmp_path / 'store'))
+    monkeypatch.setenv('NIPYPE_WB_STORE_MB', '100')
+    monkeypatch.chdir(tmp_path)
+    data = np.arange(12).reshape(2, 6)
+    _dscalar('in.dscalar.nii', data)
+    _dscalar('left.dscalar.nii', np.array([[1, 1, 1, 0, 0, 0]]))
+    _dscalar('right.dscalar.nii', np.array([[0, 0, 0, 1, 1, 1]]))
+    return data
+
+
+def test_nohash_inputs_keep_the_key(stored):
+    a = CiftiStats(in_file='in.dscalar.nii', reduce='MEAN', num_threads=1)
+    b = CiftiStats(in_file='in.dscalar.nii', reduce='MEAN', num_threads=4,
+                   environ={'FOO': 'bar'})
+    c = CiftiStats(in_file='in.dscalar.nii', reduce='MAX')
+    assert store.result_key(a) == store.result_key(b)
+    assert store.result_key(a) != store.result_key(c)
+
+
+def test_output_files_without_outputs():
+    assert store._output_files(None) == []
+
+
+def test_stored_multi_roi_stats(stored, monkeypatch):
+    StoredStats = store.stored_results(CiftiStats)
+    stats = StoredStats(in_file='in.dscalar.nii', reduce='MEAN', engine='numpy',
+                        roi_list=['left.dscalar.nii', 'right.dscalar.nii'])
+    expected = [[1.0, 7.0], [4.0, 10.0]]
+    assert stats.run().outputs.value == expected
+    assert len(store.ResultStore().entries()) == 1
+
+    def _not_again(self, runtime):
+        raise AssertionError('the stored result should have been used')
+
+    monkeypatch.setattr(CiftiStats, '_run_multi_roi', _not_again)
+    os.remove(stats._gen_filename('out_file'))
+    result = stats.run()
+    assert result.outputs.value == expected
+    assert os.path.isfile(result.outputs.out_file)